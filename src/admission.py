@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+from contextlib import contextmanager
+from time import time as now
+
+import pyvips
+
+from scratch import ScratchSpaceExceeded
+
+# Memory admission for image decoding.  Tiling a pyramid and reading image info both decode the
+# full image, which for sources near Image.MAX_IMAGE_PIXELS means gigabytes.  Each decode first
+# reserves its estimated cost (from the header: width x height x bands) against a container-wide
+# budget and waits until it fits.  A decode larger than the whole budget is admitted alone.
+# libvips cache and thread limits are set here too, as they bound the memory libvips holds
+# outside of any one decode.
+
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', '3072'))
+MEMORY_WAIT_SECONDS = float(os.environ.get('MEMORY_WAIT_SECONDS', '300'))
+
+# Unset values keep the libvips defaults
+VIPS_CACHE_MAX_MB = os.environ.get('VIPS_CACHE_MAX_MB')       # memory held by the operation cache
+VIPS_CACHE_MAX_OPERATIONS = os.environ.get('VIPS_CACHE_MAX_OPERATIONS')
+VIPS_CACHE_MAX_FILES = os.environ.get('VIPS_CACHE_MAX_FILES')
+VIPS_CONCURRENCY = os.environ.get('VIPS_CONCURRENCY')         # worker threads per libvips pipeline, read by libvips itself at startup
+
+class MemoryBudgetExceeded(ScratchSpaceExceeded):
+  """Raised when a decode waits too long for memory; handled like ScratchSpaceExceeded (503, retry later)"""
+  pass
+
+def configure_vips():
+  if VIPS_CACHE_MAX_MB is not None:
+    pyvips.cache_set_max_mem(int(VIPS_CACHE_MAX_MB) * 1024 * 1024)
+  if VIPS_CACHE_MAX_OPERATIONS is not None:
+    pyvips.cache_set_max(int(VIPS_CACHE_MAX_OPERATIONS))
+  if VIPS_CACHE_MAX_FILES is not None:
+    pyvips.cache_set_max_files(int(VIPS_CACHE_MAX_FILES))
+  if VIPS_CONCURRENCY is not None and hasattr(pyvips, 'concurrency_set'):
+    pyvips.concurrency_set(int(VIPS_CONCURRENCY))
+
+def decoded_bytes(width, height, bands=3, factor=1.0):
+  """Estimated memory to decode a width x height image of 8-bit bands, times factor for working copies"""
+  return int(width * height * bands * factor)
+
+class MemoryBudget(object):
+
+  def __init__(self, budget=MEMORY_BUDGET_MB*1024*1024, wait_seconds=MEMORY_WAIT_SECONDS):
+    self.budget = budget
+    self.wait_seconds = wait_seconds
+    self.reserved = 0
+    self.active = {} # label -> reserved bytes
+    self.queued = 0
+    self.admitted = 0
+    self.rejected = 0
+    self._cond = threading.Condition()
+
+  def reserve(self, nbytes, label=''):
+    """Blocks until nbytes fit within the budget; raises MemoryBudgetExceeded if the wait times out"""
+    nbytes = min(max(int(nbytes), 0), self.budget)
+    start = now()
+    with self._cond:
+      self.queued += 1
+      try:
+        while self.reserved + nbytes > self.budget:
+          remaining = self.wait_seconds - (now() - start)
+          if remaining <= 0 or not self._cond.wait(timeout=remaining):
+            if self.reserved + nbytes > self.budget:
+              self.rejected += 1
+              raise MemoryBudgetExceeded(f'{label} timed out waiting for {nbytes} bytes of memory (reserved={self.reserved} budget={self.budget})')
+      finally:
+        self.queued -= 1
+      self.reserved += nbytes
+      self.admitted += 1
+      self.active[label] = self.active.get(label, 0) + nbytes
+    if now() - start > 1:
+      logger.info(f'admission.reserve: label={label} bytes={nbytes} waited={round(now()-start,3)}')
+    return nbytes
+
+  def release(self, nbytes, label=''):
+    with self._cond:
+      self.reserved = max(self.reserved - nbytes, 0)
+      self.active[label] = self.active.get(label, 0) - nbytes
+      if self.active[label] <= 0:
+        self.active.pop(label)
+      self._cond.notify_all()
+
+  @contextmanager
+  def admit(self, nbytes, label=''):
+    nbytes = self.reserve(nbytes, label)
+    try:
+      yield nbytes
+    finally:
+      self.release(nbytes, label)
+
+  def usage(self):
+    with self._cond:
+      return {
+        'budget': self.budget,
+        'reserved': self.reserved,
+        'available': self.budget - self.reserved,
+        'active': dict(self.active),
+        'queued': self.queued,
+        'admitted': self.admitted,
+        'rejected': self.rejected
+      }
+
+configure_vips()
+memory = MemoryBudget()
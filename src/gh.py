@@ -7,6 +7,9 @@ logger = logging.getLogger(__name__)
 
 import os
 import base64
+import hashlib
+import hmac
+import re
 import json
 from time import time as now
 import datetime
@@ -17,8 +20,23 @@ from copy import deepcopy
 import requests
 logging.getLogger('requests').setLevel(logging.INFO)
 
+from expiringdict import ExpiringDict
+
+from memo import memoized
+from s3 import Bucket
+
 GH_UNSCOPED_TOKEN = os.environ.get('GH_UNSCOPED_TOKEN')
 
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader) # libyaml when available
+
+IMAGE_EXTENSIONS = ('gif', 'jpg', 'jpeg', 'png', 'tif', 'tiff')
+COMMIT_SHA = re.compile(r'^[0-9a-f]{7,40}$')
+
+head_shas = ExpiringDict(max_len=1000, max_age_seconds=60) # (acct, repo, ref) -> commit sha; how quickly pushes become visible
+repo_indexes = ExpiringDict(max_len=50, max_age_seconds=3600) # acct/repo/commit_sha -> RepoIndex, immutable once built
+index_cache = Bucket(bucket='juncture-manifests') # serialized indexes under repo-index/
+
+@memoized
 def get_gh_file_by_url(url):
   start = now()
   content = sha = None
@@ -54,6 +72,7 @@ def get_gh_last_commit(acct, repo, ref, path=None):
   logger.debug(f'get_gh_last_commit: acct={acct} repo={repo} ref={ref} path={path} resp={resp.status_code} last_commit_date={last_commit_date} elapsed={round(now()-start,3)}')
   return last_commit_date
 
+@memoized
 def gh_dir_list(acct, repo, path=None, ref=None):
   url = f'https://api.github.com/repos/{acct}/{repo}/contents/{path if path else ""}'
   if ref:
@@ -65,6 +84,225 @@ def gh_dir_list(acct, repo, path=None, ref=None):
   })
   return resp.json() if resp.status_code == 200 else []
 
+def gh_dir_tree(acct, repo, path=None, ref=None):
+  """
+  Directory listing from the git trees API as (tree sha, entries).  Entries have the contents
+  API's name, path, type ('file' or 'dir'), sha and size fields.  The tree sha changes whenever
+  anything in the directory does, so it can key caches of data derived from the listing.
+  """
+  start = now()
+  ref = ref or get_default_branch(acct, repo)
+  path = (path or '').strip('/')
+  url = f'https://api.github.com/repos/{acct}/{repo}/git/trees/{quote(f"{ref}:{path}")}'
+  resp = requests.get(url, headers={
+    'Authorization': f'Token {GH_UNSCOPED_TOKEN}',
+    'Accept': 'application/vnd.github.v3+json',
+    'User-agent': 'Juncture client'
+  })
+  if resp.status_code != 200:
+    logger.debug(f'gh_dir_tree: acct={acct} repo={repo} ref={ref} path={path} resp={resp.status_code}')
+    return None, []
+  tree = resp.json()
+  entries = [{
+    'name': item['path'],
+    'path': f'{path}/{item["path"]}' if path else item['path'],
+    'type': 'dir' if item['type'] == 'tree' else 'file',
+    'sha': item['sha'],
+    'size': item.get('size', 0)
+  } for item in tree['tree'] if item['type'] in ('tree', 'blob')]
+  logger.debug(f'gh_dir_tree: acct={acct} repo={repo} ref={ref} path={path} sha={tree["sha"]} entries={len(entries)} elapsed={round(now()-start,3)}')
+  return tree['sha'], entries
+
+def get_head_sha(acct, repo, ref):
+  """Commit sha a branch, tag or sha currently points to"""
+  if (acct, repo, ref) not in head_shas:
+    url = f'https://api.github.com/repos/{acct}/{repo}/commits/{quote(ref)}'
+    resp = requests.get(url, headers={
+      'Authorization': f'Token {GH_UNSCOPED_TOKEN}',
+      'Accept': 'application/vnd.github.sha',
+      'User-agent': 'Juncture client'
+    })
+    logger.debug(f'get_head_sha: acct={acct} repo={repo} ref={ref} resp={resp.status_code}')
+    if resp.status_code != 200:
+      return None
+    head_shas[(acct, repo, ref)] = resp.text.strip()
+  return head_shas[(acct, repo, ref)]
+
+class RepoIndex(object):
+  """
+  Every directory and file of a repo at one commit, from a single recursive git trees call.
+  Entries use the contents API fields (name, path, type, sha, size, download_url) so listings
+  can be served in place of gh_dir_list.  Sidecar YAML files are looked up by directory and
+  lowercased file stem.
+  """
+
+  def __init__(self, acct, repo, ref, commit_sha, tree_sha, entries, truncated=False):
+    self.acct = acct
+    self.repo = repo
+    self.ref = ref
+    self.commit_sha = commit_sha
+    self.truncated = truncated
+    self.entries = entries
+    self.by_path = dict([(entry['path'], entry) for entry in entries])
+    self.by_path[''] = {'name': '', 'path': '', 'type': 'dir', 'sha': tree_sha, 'size': 0}
+    self.dirs = {}
+    self.stems = {}
+    for entry in entries:
+      parent = entry['path'].rsplit('/', 1)[0] if '/' in entry['path'] else ''
+      self.dirs.setdefault(parent, []).append(entry)
+      if entry['type'] == 'file':
+        stem, _, ext = entry['name'].rpartition('.')
+        self.stems.setdefault((parent, stem.lower()), {})[ext.lower()] = entry
+
+  @classmethod
+  def build(cls, acct, repo, ref, commit_sha):
+    start = now()
+    url = f'https://api.github.com/repos/{acct}/{repo}/git/trees/{commit_sha}?recursive=1'
+    resp = requests.get(url, headers={
+      'Authorization': f'Token {GH_UNSCOPED_TOKEN}',
+      'Accept': 'application/vnd.github.v3+json',
+      'User-agent': 'Juncture client'
+    })
+    if resp.status_code != 200:
+      logger.debug(f'RepoIndex.build: acct={acct} repo={repo} sha={commit_sha} resp={resp.status_code}')
+      return None
+    tree = resp.json()
+    entries = [{
+      'name': item['path'].split('/')[-1],
+      'path': item['path'],
+      'type': 'dir' if item['type'] == 'tree' else 'file',
+      'sha': item['sha'],
+      'size': item.get('size', 0),
+      'download_url': f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}/{quote(item["path"])}' if item['type'] == 'blob' else None
+    } for item in tree['tree'] if item['type'] in ('tree', 'blob')]
+    if tree.get('truncated'):
+      logger.warning(f'RepoIndex.build: acct={acct} repo={repo} sha={commit_sha} tree truncated at {len(entries)} entries')
+    logger.debug(f'RepoIndex.build: acct={acct} repo={repo} sha={commit_sha} entries={len(entries)} elapsed={round(now()-start,3)}')
+    return cls(acct, repo, ref, commit_sha, tree['sha'], entries, tree.get('truncated', False))
+
+  def to_json(self):
+    return json.dumps({'acct': self.acct, 'repo': self.repo, 'ref': self.ref, 'commit_sha': self.commit_sha, 'tree_sha': self.tree_sha(), 'entries': self.entries, 'truncated': self.truncated})
+
+  @classmethod
+  def from_json(cls, data):
+    return cls(**json.loads(data))
+
+  def exists(self, path):
+    return path.strip('/') in self.by_path
+
+  def tree_sha(self, path=''):
+    entry = self.by_path.get(path.strip('/'))
+    return entry['sha'] if entry and entry['type'] == 'dir' else None
+
+  def dir_list(self, path=''):
+    path = path.strip('/')
+    if path not in self.dirs and self.truncated:
+      return gh_dir_tree(self.acct, self.repo, path, self.commit_sha)[1]
+    return self.dirs.get(path, [])
+
+  def subdirs(self, path=''):
+    return [entry['name'] for entry in self.dir_list(path) if entry['type'] == 'dir']
+
+  def sidecar(self, path):
+    """The YAML metadata file next to an image, if there is one"""
+    parent, _, name = path.strip('/').rpartition('/')
+    entry = self.stems.get((parent, name.rpartition('.')[0].lower()), {}).get('yaml')
+    return entry['path'] if entry else None
+
+  def images(self, path=''):
+    """Images in a directory, plus YAML files that do not describe an image in the same directory"""
+    path = path.strip('/')
+    files = [entry for entry in self.dir_list(path) if entry['type'] == 'file']
+    images = [entry for entry in files if entry['name'].split('.')[-1].lower() in IMAGE_EXTENSIONS]
+    for entry in files:
+      stem, _, ext = entry['name'].rpartition('.')
+      if ext.lower() == 'yaml' and 'iiif-props' not in entry['name']:
+        siblings = self.stems.get((path, stem.lower()), {})
+        if not any(sibling_ext in IMAGE_EXTENSIONS for sibling_ext in siblings):
+          images.append(entry)
+    return images
+
+def repo_index(acct, repo, ref=None):
+  """RepoIndex for the commit ref currently points to, from memory, the index bucket, or GitHub"""
+  ref = ref or get_default_branch(acct, repo)
+  commit_sha = get_head_sha(acct, repo, ref) if ref else None
+  if not commit_sha:
+    return None
+  key = f'{acct}/{repo}/{commit_sha}'
+  index = repo_indexes.get(key)
+  if index is None:
+    stored = index_cache.get(f'repo-index/{key}.json')
+    if stored:
+      index = RepoIndex.from_json(stored)
+    else:
+      index = RepoIndex.build(acct, repo, ref, commit_sha)
+      if index is None:
+        return None
+      index_cache[f'repo-index/{key}.json'] = index.to_json()
+    repo_indexes[key] = index
+  return index
+
+def verify_signature(body, signature, secret):
+  """True when signature is the X-Hub-Signature-256 header GitHub sends for body signed with secret"""
+  if not secret:
+    return False
+  expected = 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+  return hmac.compare_digest(expected, signature or '')
+
+def push_head(payload):
+  """(acct, repo, branch, after sha) of a GitHub push event to a branch, else None"""
+  if not payload.get('ref', '').startswith('refs/heads/') or payload.get('deleted'):
+    return None
+  repository = payload['repository']
+  acct, repo = repository['owner'].get('login') or repository['owner'].get('name'), repository['name']
+  return acct, repo, payload['ref'][len('refs/heads/'):], payload['after']
+
+def push_targets(payload):
+  """
+  Items affected by a GitHub push event, one dict per image (or standalone YAML) path with its
+  manifest ids, identity url, a download url pinned to the pushed commit (raw.githubusercontent
+  caches branch URLs for several minutes), and whether the image itself changed or was removed.
+  Changes to a sidecar YAML map to the image it describes.
+  """
+  head = push_head(payload)
+  if head is None:
+    return []
+  acct, repo, branch, after = head
+  repository = payload['repository']
+
+  changes = {} # path -> last action in the push
+  for commit in payload.get('commits', []):
+    for action in ('added', 'modified', 'removed'):
+      for path in commit.get(action, []):
+        changes[path] = action
+
+  index = repo_index(acct, repo, after) if any(path.lower().endswith('.yaml') for path in changes) else None
+  targets = {}
+  for path, action in changes.items():
+    parent, _, name = path.rpartition('/')
+    stem, _, ext = name.rpartition('.')
+    if ext.lower() in IMAGE_EXTENSIONS:
+      image_path = path
+    elif ext.lower() == 'yaml' and 'iiif-props' not in name:
+      siblings = index.stems.get((parent, stem.lower()), {}) if index else {}
+      image_path = next((sibling['path'] for sibling_ext, sibling in siblings.items() if sibling_ext in IMAGE_EXTENSIONS), path)
+    else:
+      continue
+    target = targets.setdefault(image_path, {
+      'path': image_path,
+      'manifestids': ([f'gh:{acct}/{repo}/{image_path}'] if branch == repository.get('default_branch') else []) + [f'gh:{acct}/{repo}/{branch}/{image_path}'],
+      'url': f'https://raw.githubusercontent.com/{acct}/{repo}/{branch}/{image_path}',
+      'download_url': f'https://raw.githubusercontent.com/{acct}/{repo}/{after}/{image_path}',
+      'image_changed': False,
+      'removed': False
+    })
+    if image_path == path:
+      target['image_changed'] = True
+      target['removed'] = action == 'removed'
+  logger.debug(f'push_targets: acct={acct} repo={repo} branch={branch} after={after} changes={len(changes)} targets={len(targets)}')
+  return list(targets.values())
+
+@memoized
 def gh_repo_info(acct, repo):
   start = now()
   url = f'https://api.github.com/repos/{acct}/{repo}'
@@ -78,6 +316,7 @@ def gh_repo_info(acct, repo):
   logger.debug(f'gh_repo_info: acct={acct} repo={repo} elapsed={round(now()-start,3)}')
   return repo_info
 
+@memoized
 def gh_user_info(login=None, acct=None, repo=None):
   start = now()
   if not login:
@@ -99,6 +338,7 @@ def get_default_branch(acct, repo):
   logger.debug(f'get_default_branch: acct={acct} repo={repo} elapsed={round(now()-start,3)}')
   return repo_info['default_branch'] if repo_info else None
 
+@memoized
 def get_branches(acct, repo):
   url = f'https://api.github.com/repos/{acct}/{repo}/branches'
   resp = requests.get(url, headers={
@@ -138,6 +378,11 @@ licenses = {
   'NKC': {'label': 'NO KNOWN COPYRIGHT', 'url': 'http://rightsstatements.org/vocab/NKC/1.0/'}
 }
 
+@memoized
+def parse_yaml(text):
+  """Parsed YAML document (the C loader when libyaml is installed), {} for empty or missing text"""
+  return yaml.load(text or '', Loader=YAML_LOADER) or {}
+
 def get_entity_labels(qids, lang='en'):
   values = ' '.join([f'(<http://www.wikidata.org/entity/{qid}>)' for qid in qids])
   query = f'SELECT ?item ?label WHERE {{ VALUES (?item) {{ {values} }} ?item rdfs:label ?label . FILTER (LANG(?label) = "{lang}" || LANG(?label) = "en") .}}'
@@ -151,26 +396,31 @@ def get_entity_labels(qids, lang='en'):
   )
   return dict([(rec['item']['value'].split('/')[-1],rec['label']['value']) for rec in resp.json()['results']['bindings']]) if resp.status_code == 200 else {}
 
+def is_ref(acct, repo, ref):
+  """True for a branch name or a commit sha of the repo, the refs a gh: manifestid can start with"""
+  return ref in get_branches(acct, repo) or bool(COMMIT_SHA.match(ref) and get_head_sha(acct, repo, ref))
+
+def split_ref(acct, repo, path):
+  """(ref, path) for the path segments of a gh: manifestid, where ref is a leading branch name or commit sha, else None"""
+  if len(path) > 1 and is_ref(acct, repo, path[0]):
+    return path[0], path[1:]
+  return None, path
+
 def manifestid_to_url(manifestid):
   acct, repo, *path = manifestid[3:].split('/')
-  branches = get_branches(acct, repo)
-  if path[0] in branches:
-    branch = path[0]
-    path = path[1:]
-  else:
-    branch = branches[0] if len(branches) == 1 else get_default_branch(acct, repo)
-  return f'https://raw.githubusercontent.com/{acct}/{repo}/{branch}/{"/".join(path)}'
+  ref, path = split_ref(acct, repo, path)
+  if ref is None:
+    branches = get_branches(acct, repo)
+    ref = branches[0] if len(branches) == 1 else get_default_branch(acct, repo)
+  return f'https://raw.githubusercontent.com/{acct}/{repo}/{ref}/{"/".join(path)}'
   
 def get_iiif_metadata(**kwargs):
   manifestid = kwargs.get('manifestid')
   start = now()
   acct, repo, *path = manifestid[3:].split('/')
   repo_info = gh_repo_info(acct, repo)
-  branches = get_branches(acct, repo)
-  if path[0] in branches:
-    ref = path[0]
-    path = path[1:]
-  else:
+  ref, path = split_ref(acct, repo, path)
+  if ref is None:
     ref = repo_info['default_branch']
   user_info = gh_user_info(repo_info['owner']['login'])
 
@@ -185,7 +435,11 @@ def get_iiif_metadata(**kwargs):
   
   yaml_path = deepcopy(path)
   yaml_path[-1] = '.'.join(path[-1].split('.')[:-1]) + '.yaml'
-  gh_metadata = yaml.load(get_gh_file(acct, repo, ref, '/'.join(yaml_path)) or '', Loader=yaml.FullLoader) or {}
+  yaml_path = '/'.join(yaml_path)
+  index = repo_index(acct, repo, ref)
+  if index is not None and not index.truncated:
+    yaml_path = index.sidecar('/'.join(path)) # no contents API round trip when there is no sidecar
+  gh_metadata = parse_yaml(get_gh_file(acct, repo, ref, yaml_path)) if yaml_path else {}
   logger.debug(json.dumps(gh_metadata, indent=2))
   lang = gh_metadata.get('language', 'en')
   
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import os
+import re
+import threading
+from time import time as now
+
+from expiringdict import ExpiringDict
+
+import pyvips
+logging.getLogger('pyvips').setLevel(logging.ERROR)
+
+from s3 import ByteLRU, s3_client
+
+# Minimal IIIF Image API 3 server over the tiled pyramid TIFFs written by manifest.publish.
+# Pyramids are read from LOCAL_IMAGE_DIR when set, otherwise from the juncture-images bucket
+# using ranged GETs, so only the IFDs and tiles needed for a request are fetched.
+
+BUCKET_NAME = 'juncture-images'
+LOCAL_IMAGE_DIR = os.environ.get('LOCAL_IMAGE_DIR')
+TILE_SIZE = 512
+MAX_SIZE = 4096 # longest edge of any derivative this server will produce
+
+FORMATS = {
+  'jpg': 'image/jpeg',
+  'png': 'image/png',
+  'webp': 'image/webp',
+  'tif': 'image/tiff',
+  'gif': 'image/gif'
+}
+QUALITIES = ('default', 'color', 'gray', 'bitonal')
+IDENTIFIER_PATTERN = re.compile(r'^[\w.-]+$')
+
+tile_cache = ByteLRU(
+  max_bytes=int(os.environ.get('IIIF_TILE_CACHE_MB', '128')) * 1024 * 1024,
+  max_item_bytes=4 * 1024 * 1024
+)
+_pyramids = ExpiringDict(max_len=64, max_age_seconds=900) # open pyramid handles, keyed by identifier
+
+class IIIFError(Exception):
+
+  def __init__(self, status_code, detail):
+    super().__init__(detail)
+    self.status_code = status_code
+    self.detail = detail
+
+class _S3RangeSource(object):
+  """Block cache over an S3 object, filled with ranged GETs and shared by all readers of the object"""
+
+  def __init__(self, key, block_size=256*1024, max_blocks=64):
+    self.key = key
+    self.block_size = block_size
+    self.max_blocks = max_blocks
+    self.length = s3_client().head_object(Bucket=BUCKET_NAME, Key=key)['ContentLength']
+    self._blocks = {}
+    self._lock = threading.Lock()
+
+  def _block(self, idx):
+    with self._lock:
+      if idx in self._blocks:
+        return self._blocks[idx]
+    start = idx * self.block_size
+    end = min(start + self.block_size, self.length) - 1
+    body = s3_client().get_object(Bucket=BUCKET_NAME, Key=self.key, Range=f'bytes={start}-{end}')['Body'].read()
+    with self._lock:
+      if len(self._blocks) >= self.max_blocks:
+        self._blocks.pop(next(iter(self._blocks)))
+      self._blocks[idx] = body
+    return body
+
+  def read_at(self, position, size):
+    size = min(size, self.length - position)
+    data = b''
+    while len(data) < max(size, 0):
+      idx, offset = divmod(position + len(data), self.block_size)
+      data += self._block(idx)[offset:offset + size - len(data)]
+    return data
+
+  def vips_source(self):
+    """A pyvips source with its own read position over the shared block cache"""
+    state = {'position': 0}
+    def _read(size):
+      data = self.read_at(state['position'], size)
+      state['position'] += len(data)
+      return data
+    def _seek(offset, whence):
+      state['position'] = offset if whence == 0 else state['position'] + offset if whence == 1 else self.length + offset
+      return state['position']
+    source = pyvips.SourceCustom()
+    source.on_read(_read)
+    source.on_seek(_seek)
+    return source
+
+class Pyramid(object):
+  """An opened pyramid TIFF: full resolution size plus one lazily loaded image per level"""
+
+  def __init__(self, identifier):
+    self.identifier = identifier
+    self.path = os.path.join(LOCAL_IMAGE_DIR, f'{identifier}.tif') if LOCAL_IMAGE_DIR else None
+    self._s3_source = None
+    self._levels = {}
+    self._lock = threading.Lock()
+    base = self.level(0)
+    self.width = base.width
+    self.height = base.height
+    self.num_levels = base.get('n-pages') if base.get_typeof('n-pages') else 1
+
+  def level(self, idx):
+    with self._lock:
+      if idx not in self._levels:
+        if self.path:
+          self._levels[idx] = pyvips.Image.new_from_file(self.path, page=idx, access='random')
+        else:
+          if self._s3_source is None:
+            self._s3_source = _S3RangeSource(f'{self.identifier}.tif')
+          self._levels[idx] = pyvips.Image.new_from_source(self._s3_source.vips_source(), '', page=idx, access='random')
+      return self._levels[idx]
+
+def open_pyramid(identifier):
+  if not IDENTIFIER_PATTERN.match(identifier):
+    raise IIIFError(400, f'Invalid identifier: {identifier}')
+  pyramid = _pyramids.get(identifier)
+  if pyramid is None:
+    try:
+      pyramid = Pyramid(identifier)
+    except Exception as e:
+      logger.debug(f'open_pyramid: identifier={identifier} error={e}')
+      raise IIIFError(404, f'Image not found: {identifier}')
+    _pyramids[identifier] = pyramid
+  return pyramid
+
+def invalidate(identifier):
+  """Drops the open pyramid and rendered tiles of identifier, for when its .tif is republished or removed"""
+  _pyramids.pop(identifier, None)
+  dropped = tile_cache.pop_prefix(f'{identifier}/')
+  logger.debug(f'invalidate: identifier={identifier} tiles={dropped}')
+
+def pyramid_sizes(width, height, tile_size=TILE_SIZE):
+  """
+  (width, height) of each level tiffsave(pyramid=True) writes, full resolution first.  libvips
+  halves each level, rounding down, while it is larger than one tile and both edges exceed 1px.
+  """
+  sizes = [(width, height)]
+  while (width > tile_size or height > tile_size) and width > 1 and height > 1:
+    width, height = width // 2, height // 2
+    sizes.append((width, height))
+  return sizes
+
+def info_json(service_id, width, height, num_levels=1, tile_size=TILE_SIZE, sizes=None):
+  """IIIF Image API 3 info.json for a pyramid of num_levels levels, each half the size of the previous"""
+  scale_factors = [2 ** idx for idx in range(num_levels)]
+  if sizes is None:
+    sizes = [{'width': w, 'height': h} for w, h in reversed(pyramid_sizes(width, height, tile_size)[:num_levels])]
+  info = {
+    '@context': 'http://iiif.io/api/image/3/context.json',
+    'id': service_id,
+    'type': 'ImageService3',
+    'protocol': 'http://iiif.io/api/image',
+    'profile': 'level2',
+    'width': width,
+    'height': height,
+    'sizes': sizes,
+    'tiles': [{'width': tile_size, 'height': tile_size, 'scaleFactors': scale_factors}],
+    'extraFormats': ['png', 'webp'],
+    'extraQualities': ['color', 'gray', 'bitonal'],
+    'extraFeatures': ['mirroring', 'regionByPct', 'regionSquare', 'rotationArbitrary', 'sizeByConfinedWh', 'sizeByPct', 'sizeUpscaling']
+  }
+  if width > MAX_SIZE or height > MAX_SIZE:
+    info['maxWidth'] = info['maxHeight'] = MAX_SIZE
+  return info
+
+def info(identifier, service_id):
+  pyramid = open_pyramid(identifier)
+  return info_json(service_id, pyramid.width, pyramid.height, pyramid.num_levels)
+
+def _parse_region(region, width, height):
+  if region == 'full':
+    return 0, 0, width, height
+  if region == 'square':
+    side = min(width, height)
+    return (width - side) // 2, (height - side) // 2, side, side
+  try:
+    if region.startswith('pct:'):
+      x, y, w, h = [float(v) for v in region[4:].split(',')]
+      x, y, w, h = round(x * width / 100), round(y * height / 100), round(w * width / 100), round(h * height / 100)
+    else:
+      x, y, w, h = [int(v) for v in region.split(',')]
+  except ValueError:
+    raise IIIFError(400, f'Invalid region: {region}')
+  if w <= 0 or h <= 0 or x >= width or y >= height:
+    raise IIIFError(400, f'Invalid region: {region}')
+  return x, y, min(w, width - x), min(h, height - y)
+
+def _parse_size(size, region_w, region_h):
+  upscale = size.startswith('^')
+  spec = size[1:] if upscale else size
+  try:
+    if spec == 'max':
+      w, h = region_w, region_h
+      scale = min(1, MAX_SIZE / max(w, h))
+      w, h = round(w * scale), round(h * scale)
+    elif spec.startswith('pct:'):
+      pct = float(spec[4:])
+      w, h = round(region_w * pct / 100), round(region_h * pct / 100)
+    elif spec.startswith('!'):
+      bw, bh = [int(v) for v in spec[1:].split(',')]
+      scale = min(bw / region_w, bh / region_h)
+      w, h = round(region_w * scale), round(region_h * scale)
+    else:
+      sw, sh = spec.split(',')
+      if sw and sh:
+        w, h = int(sw), int(sh)
+      elif sw:
+        w = int(sw)
+        h = round(region_h * w / region_w)
+      else:
+        h = int(sh)
+        w = round(region_w * h / region_h)
+  except ValueError:
+    raise IIIFError(400, f'Invalid size: {size}')
+  if w <= 0 or h <= 0 or max(w, h) > MAX_SIZE:
+    raise IIIFError(400, f'Invalid size: {size}')
+  if not upscale and (w > region_w or h > region_h):
+    raise IIIFError(400, f'Upscaling requires ^ size prefix: {size}')
+  return max(1, w), max(1, h)
+
+def _parse_rotation(rotation):
+  mirror = rotation.startswith('!')
+  try:
+    angle = float(rotation[1:] if mirror else rotation)
+  except ValueError:
+    raise IIIFError(400, f'Invalid rotation: {rotation}')
+  if angle < 0 or angle > 360:
+    raise IIIFError(400, f'Invalid rotation: {rotation}')
+  return mirror, angle % 360
+
+def _select_level(pyramid, region_w, region_h, out_w, out_h):
+  """Smallest pyramid level that still has at least the requested output resolution"""
+  scale = max(out_w / region_w, out_h / region_h)
+  level = 0
+  while level + 1 < pyramid.num_levels and 2 ** -(level + 1) >= scale:
+    level += 1
+  return level
+
+def render(identifier, region, size, rotation, quality, fmt):
+  """Returns (bytes, media type) for a IIIF Image API 3 image request"""
+  start = now()
+  if fmt not in FORMATS:
+    raise IIIFError(400, f'Unsupported format: {fmt}')
+  if quality not in QUALITIES:
+    raise IIIFError(400, f'Unsupported quality: {quality}')
+  cache_key = f'{identifier}/{region}/{size}/{rotation}/{quality}.{fmt}'
+  cached = tile_cache.get(cache_key)
+  if cached:
+    return cached
+
+  pyramid = open_pyramid(identifier)
+  x, y, w, h = _parse_region(region, pyramid.width, pyramid.height)
+  out_w, out_h = _parse_size(size, w, h)
+  mirror, angle = _parse_rotation(rotation)
+
+  level = _select_level(pyramid, w, h, out_w, out_h)
+  img = pyramid.level(level)
+  factor = 2 ** level
+  lx, ly = min(x // factor, img.width - 1), min(y // factor, img.height - 1)
+  # levels are rounded down (see pyramid_sizes), so the region's far edge is too
+  lw, lh = max(1, min((x + w) // factor, img.width) - lx), max(1, min((y + h) // factor, img.height) - ly)
+  img = img.crop(lx, ly, lw, lh)
+  if (lw, lh) != (out_w, out_h):
+    img = img.resize(out_w / lw, vscale=out_h / lh)
+
+  if mirror:
+    img = img.fliphor()
+  if angle in (90, 180, 270):
+    img = img.rot(f'd{int(angle)}')
+  elif angle:
+    img = img.rotate(angle, background=[255] * img.bands)
+
+  if quality == 'gray':
+    img = img.colourspace('b-w')
+  elif quality == 'bitonal':
+    img = img.colourspace('b-w') > 128
+
+  body = img.write_to_buffer(f'.{fmt}[Q=85]' if fmt in ('jpg', 'webp') else f'.{fmt}')
+  result = (body, FORMATS[fmt])
+  tile_cache.put(cache_key, *result)
+  logger.debug(f'render: {cache_key} level={level} bytes={len(body)} elapsed={round(now()-start,3)}')
+  return result
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import threading
+import traceback
+from time import time as now
+
+import boto3
+from expiringdict import ExpiringDict
+from starlette.concurrency import run_in_threadpool
+
+from s3 import Bucket
+
+# Ingest jobs run the manifest pipeline outside the request that asked for it.  Jobs are keyed by
+# url_hash, so concurrent requests for the same source share one job.  A submit with requeue set
+# (a source that changed while its job was active) runs the job again once the active run ends.  Work is done by an
+# in-process worker pool, or, when JOB_QUEUE_URL is set, sent to SQS and picked up by the
+# Lambda SQS event handler.  Job state is kept in memory and, with SQS, in the juncture-jobs
+# bucket so every container sees it.
+
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_BUCKET = os.environ.get('JOB_BUCKET', 'juncture-jobs')
+JOB_CACHE_SIZE = int(os.environ.get('JOB_CACHE_SIZE', '10000'))
+JOB_CACHE_SECONDS = int(os.environ.get('JOB_CACHE_SECONDS', str(6 * 3600))) # finished jobs are forgotten after this; with SQS the bucket still has them
+
+ACTIVE = ('queued', 'running')
+TERMINAL = ('done', 'failed')
+
+class JobStore(object):
+
+  def __init__(self, bucket=None):
+    self._jobs = ExpiringDict(max_len=JOB_CACHE_SIZE, max_age_seconds=JOB_CACHE_SECONDS)
+    self._lock = threading.Lock()
+    self.bucket = Bucket(bucket=bucket) if bucket else None
+
+  def get(self, job_id):
+    job = self._jobs.get(job_id)
+    if (job is None or job['status'] not in TERMINAL) and self.bucket:
+      stored = self.bucket.get(f'{job_id}.json', refresh=True)
+      job = json.loads(stored) if stored else job
+    return dict(job) if job else None
+
+  def put(self, job):
+    job['updated'] = now()
+    with self._lock:
+      self._jobs[job['id']] = job
+    if self.bucket:
+      self.bucket[f'{job["id"]}.json'] = json.dumps(job)
+    return job
+
+  def update(self, job_id, **fields):
+    with self._lock:
+      job = dict(self._jobs.get(job_id) or self.get(job_id) or {'id': job_id})
+      job.update(fields)
+    return self.put(job)
+
+class LocalQueue(object):
+  """In-process worker pool"""
+
+  def __init__(self, run, workers=JOB_WORKERS):
+    self.run = run
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+
+  def enqueue(self, job):
+    self.executor.submit(self.run, job)
+
+class SQSQueue(object):
+  """Jobs are sent to SQS and run by whichever container receives the SQS event"""
+
+  def __init__(self, queue_url=JOB_QUEUE_URL):
+    self.queue_url = queue_url
+    self.sqs = boto3.client('sqs')
+
+  def enqueue(self, job):
+    self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+
+class JobManager(object):
+
+  def __init__(self, handler, queue_url=JOB_QUEUE_URL):
+    """handler(job, progress) runs the job, calling progress(stage) as it goes; its return value is stored on the job"""
+    self.handler = handler
+    self.store = JobStore(bucket=JOB_BUCKET if queue_url else None)
+    self.queue = SQSQueue(queue_url) if queue_url else LocalQueue(self.run)
+    self._lock = threading.RLock() # orders submit against the end of a run, so a requeue is never missed
+
+  def submit(self, job_id, requeue=False, **params):
+    """
+    Enqueues a job unless one for the same id is already queued or running.  With requeue, an
+    active job is run again with params when it ends, as its inputs are out of date.
+    """
+    with self._lock:
+      job = self.store.get(job_id)
+      if job and job['status'] in ACTIVE:
+        if requeue:
+          job = self.store.update(job_id, requeued=params)
+          logger.debug(f'jobs.submit: id={job_id} requeued')
+        return job
+      job = self.store.put({'id': job_id, 'status': 'queued', 'stage': None, 'created': now(), 'error': None, 'result': None, **params})
+    self.queue.enqueue(job)
+    logger.debug(f'jobs.submit: id={job_id} queue={self.queue.__class__.__name__}')
+    return job
+
+  def get(self, job_id):
+    return self.store.get(job_id)
+
+  def run(self, job):
+    start = now()
+    job_id = job['id']
+    self.store.update(job_id, status='running', started=start)
+    def progress(stage):
+      logger.debug(f'jobs.progress: id={job_id} stage={stage}')
+      self.store.update(job_id, stage=stage)
+    try:
+      result = self.handler(job, progress)
+      fields = {'status': 'done', 'stage': 'done', 'result': result}
+    except Exception as e:
+      logger.error(traceback.format_exc())
+      fields = {'status': 'failed', 'error': str(e)}
+    with self._lock:
+      requeued = (self.store.get(job_id) or {}).get('requeued')
+      self.store.update(job_id, requeued=None, elapsed=round(now()-start,3), **fields)
+      if requeued:
+        self.submit(job_id, **requeued)
+
+  def process_sqs_event(self, event):
+    for record in event.get('Records', []):
+      self.run(json.loads(record['body']))
+
+  async def events(self, job_id, interval=1.0, timeout=900):
+    """Server-sent events stream of job updates, ending when the job finishes"""
+    last = None
+    start = now()
+    while now() - start < timeout:
+      job = await run_in_threadpool(self.get, job_id)
+      if job is None:
+        yield f'event: error\ndata: {json.dumps({"detail": "Job not found"})}\n\n'
+        return
+      if job != last:
+        yield f'event: {job["status"]}\ndata: {json.dumps(job)}\n\n'
+        last = job
+      if job['status'] in TERMINAL:
+        return
+      await asyncio.sleep(interval)
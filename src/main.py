@@ -8,29 +8,36 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 import argparse, os, sys, json
+import asyncio
+import concurrent.futures
 from hashlib import sha256
 from time import time as now
 from urllib.parse import quote
 import re
 import httpx
-import boto3
-from botocore.exceptions import ClientError
 import io
 from PIL import Image
 
 SCRIPT_DIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(SCRIPT_DIR)
 from typing import Tuple, Optional
+from expiringdict import ExpiringDict
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response
+from fastapi import FastAPI, Request, HTTPException, Query
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import RedirectResponse, StreamingResponse
 
 from prezi_upgrader import Upgrader
 
-from manifest import generate as get_manifest
+from manifest import generate as get_manifest, enrich_manifest, enrichable, is_provisional, manifestid_to_url, prefetch_wc, thumbnail_cache, RefreshMode
+from scratch import scratch, ScratchSpaceExceeded
+from admission import memory
+import stages
+from jobs import JobManager
 
 import requests
 logging.getLogger('requests').setLevel(logging.WARNING)
@@ -38,6 +45,7 @@ logging.getLogger('requests').setLevel(logging.WARNING)
 import gh
 import wc
 import wd
+import transforms
 
 app = FastAPI(title='IIIF Presentation API', root_path='/')
 
@@ -50,7 +58,21 @@ app.add_middleware(
 )
 
 ## IMAGE_SERVICE_BASEURL = 'https://iiif-image.juncture-digital.io'
-IMAGE_SERVICE_BASEURL = 'https://d399mwta4vjg2n.cloudfront.net'
+IMAGE_SERVICE_BASEURL = os.environ.get('IMAGE_SERVICE_BASEURL', 'https://d399mwta4vjg2n.cloudfront.net')
+
+# Serve IIIF Image API requests in-process from the generated pyramids (see image_server.py)
+LOCAL_IMAGE_SERVER = os.environ.get('LOCAL_IMAGE_SERVER', 'false').lower() == 'true'
+
+# Serve a manifest pointing at the source image while the pyramid is built in the background
+PROGRESSIVE_MANIFESTS = os.environ.get('PROGRESSIVE_MANIFESTS', 'false').lower() == 'true'
+PROVISIONAL_TTL = int(os.environ.get('PROVISIONAL_TTL', '120'))
+
+# POST manifests: maximum ids per request, and how many cache misses are generated at once
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '500'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '8'))
+
+# Shared secret of the GitHub push webhook (see gh_webhook); the endpoint rejects all requests when unset
+GH_WEBHOOK_SECRET = os.environ.get('GH_WEBHOOK_SECRET')
 
 LOCAL_WC = os.environ.get('LOCAL_WC', 'false').lower() == 'true'
 LOCAL_WC_PORT = os.environ.get('LOCAL_WC_PORT', '5173')
@@ -58,6 +80,13 @@ LOCAL_WC_PORT = os.environ.get('LOCAL_WC_PORT', '5173')
 from s3 import Bucket as Cache
 manifest_cache = Cache(bucket='juncture-manifests')
 image_cache = Cache(bucket='juncture-images')
+image_info_cache = Cache(bucket='juncture-image-info')
+provisional_manifests = ExpiringDict(max_len=1000, max_age_seconds=PROVISIONAL_TTL) # not persisted, superseded by manifest_cache
+
+@app.exception_handler(ScratchSpaceExceeded)
+async def scratch_space_exceeded(request: Request, exc: ScratchSpaceExceeded):
+  logger.warning(f'scratch space exceeded: path={request.url.path} {exc}')
+  return JSONResponse(status_code=503, content={'detail': str(exc)}, headers={'Retry-After': '30'})
 
 def _find_item(obj, type, attr=None, attr_val=None, sub_attr=None):
   if 'items' in obj and isinstance(obj['items'], list):
@@ -77,7 +106,11 @@ def _update_image_service(manifest):
   rotation = 0 if orientation == 1 else 90 if orientation == 6 else 180 if orientation == 3 else 270
   logger.debug(f'_update_image_service: width={width} rotation={rotation}')
   # if width > 512:
-  if width > 0:
+  if 'service' not in image_data:
+    manifest['thumbnail'][0]['id'] = manifest['thumbnail'][0]['id'].replace(' ', '%20')
+  elif not image_data['service'][0].get('id', '').startswith('BASEURL ADDED BY ENDPOINT HANDLER'):
+    pass # external IIIF service, used as-is
+  elif width > 0:
     image_service = image_data['service'][0]
     image_hash = image_service['id'].split('/')[-1]
     image_service['id'] = f'{IMAGE_SERVICE_BASEURL}/iiif/3/{image_hash}'
@@ -87,34 +120,13 @@ def _update_image_service(manifest):
     manifest['thumbnail'][0]['id'] =  image_data['id'].replace(' ', '%20')
   return manifest
 
-def _manifestid_to_url(manifestid):
-  logger.debug(f'_manifestid_to_url: manifestid={manifestid}')
-  if manifestid.startswith('gh:'):
-    return manifestid, gh.manifestid_to_url(manifestid)
-  elif manifestid.startswith('wc:') or manifestid.startswith('https://upload.wikimedia.org/wikipedia/commons'):
-    if manifestid.startswith('http'):
-      manifestid = f'wc:{manifestid.split("/")[-1]}'
-    return manifestid, wc.manifestid_to_url(manifestid)
-  elif manifestid.startswith('wd:'):
-    return manifestid, wd.manifestid_to_url(manifestid)
-  elif manifestid.startswith('default:'):
-    return manifestid[8:], manifestid[8:]
-  elif manifestid.startswith('http'):
-    return manifestid, manifestid
-  
 def _images_from_dir_list(dir_list):
   files = [item for item in dir_list if item['type'] == 'file']
-  images = [item for item in files if item['name'].split('.')[-1].lower() in ('gif', 'jpg', 'jpeg', 'png', 'tif', 'tiff')]
+  images = [item for item in files if item['name'].split('.')[-1].lower() in gh.IMAGE_EXTENSIONS]
+  image_bases = set(['.'.join(image['name'].split('.')[:-1]).lower() for image in images])
   for file in files:
     if file['name'].split('.')[-1].lower() in ('yaml',) and 'iiif-props' not in file['name']:
-      fname_base = '.'.join(file['name'].split('.')[:-1]).lower()
-      found = False
-      for image in images:
-        image_base = '.'.join(image['name'].split('.')[:-1]).lower()
-        if fname_base == image_base:
-          found = True
-          break
-      if not found:
+      if '.'.join(file['name'].split('.')[:-1]).lower() not in image_bases:
         images.append(file)
   return images
 
@@ -122,216 +134,321 @@ def _images_from_dir_list(dir_list):
 def docs():
   return RedirectResponse(url='/docs')
 
+def _run_manifest_job(job, progress):
+  """Ingest job handler: generates (or, for enrich jobs, patches) a manifest and writes it to the manifest cache"""
+  if job.get('kind') == 'enrich':
+    return _run_enrichment_job(job, progress)
+  if job.get('manifestid'):
+    source = {'download_url': job['download_url']} if job.get('download_url') else {}
+    manifest = get_manifest(manifestid=job['manifestid'], refresh=job.get('refresh'), enrich=True, progress=progress, **source)
+  else:
+    manifest = get_manifest(refresh=job.get('refresh'), progress=progress, **job['payload'])
+  if not manifest:
+    raise ValueError(f'Manifest could not be generated for {job.get("manifestid") or job["payload"].get("url")}')
+  manifest_cache[job['id']] = json.dumps(manifest)
+  provisional_manifests.pop(job['id'], None)
+  return {'manifestid': job.get('manifestid') or job['source']}
+
+def _run_enrichment_job(job, progress):
+  manifest = json.loads(manifest_cache.get(job['imageid'], '{}'))
+  if not manifest:
+    raise ValueError(f'No cached manifest to enrich for {job["manifestid"]}')
+  progress('enrich')
+  manifest_cache[job['imageid']] = json.dumps(enrich_manifest(manifest, job['manifestid'], job['imageid']))
+  return {'manifestid': job['manifestid']}
+
+def _enrich_later(manifestid, imageid):
+  """Queues the Wikidata enrichment of a manifest generated from core metadata"""
+  if enrichable(manifestid):
+    ingest_jobs.submit(f'{imageid}-enrich', kind='enrich', manifestid=manifestid, imageid=imageid)
+
+ingest_jobs = JobManager(handler=_run_manifest_job)
+
+def _wants_async(request: Request, async_: Optional[str] = None):
+  return async_ in ('', 'true') or 'respond-async' in request.headers.get('prefer', '')
+
+def _refresh_mode(refresh: Optional[str] = None):
+  """refresh query parameter as a RefreshMode value ('metadata', 'image', 'derivatives' or 'all'), or None"""
+  try:
+    mode = RefreshMode.parse(refresh)
+  except ValueError:
+    raise HTTPException(status_code=400, detail=f'Invalid refresh mode: {refresh}, expected one of {", ".join([mode.value for mode in RefreshMode])}')
+  return mode.value if mode else None
+
+def _wants_progressive(progressive: Optional[str] = None):
+  return progressive in ('', 'true') if progressive is not None else PROGRESSIVE_MANIFESTS
+
+def _job_resource(request: Request, job):
+  baseurl = str(request.base_url)[:-1]
+  resource = dict([(fld, job.get(fld)) for fld in ('id', 'status', 'stage', 'created', 'updated', 'elapsed', 'error')])
+  resource['self'] = f'{baseurl}/jobs/{job["id"]}'
+  resource['events'] = f'{baseurl}/jobs/{job["id"]}/events'
+  if job['status'] == 'done':
+    resource['manifest'] = f'{baseurl}/{job["result"]["manifestid"]}/manifest.json'
+  return resource
+
+def _accepted(request: Request, job):
+  resource = _job_resource(request, job)
+  return JSONResponse(status_code=202, content=resource, headers={'Location': resource['self'], 'Retry-After': '2'})
+
 @app.post('manifest/')
 @app.post('manifest')
-async def get_or_create_manifest(request: Request, refresh: Optional[str] = None):
+async def get_or_create_manifest(request: Request, refresh: Optional[str] = None, async_: Optional[str] = Query(None, alias='async')):
   start = now()
-  refresh = refresh in ('', 'true')
+  refresh = _refresh_mode(refresh)
   payload = await request.body()
-  payload = json.loads(payload)
-  _, payload['url'] = _manifestid_to_url(payload['url'])
+  # refresh and progress are set by the service, a payload cannot pass them to get_manifest a second time
+  payload = dict([(key, value) for key, value in json.loads(payload).items() if key not in ('refresh', 'progress')])
+  source = payload['url']
+  _, payload['url'] = manifestid_to_url(payload['url'])
   url = payload.get('url')
   imageid = sha256(url.encode('utf-8')).hexdigest()
   manifest = json.loads(manifest_cache.get(imageid, '{}')) if not refresh else None
   cached = manifest is not None
+  if not manifest and _wants_async(request, async_):
+    return _accepted(request, ingest_jobs.submit(imageid, source=source, payload=payload, refresh=refresh))
   if not manifest:
     manifest = get_manifest(refresh=refresh, **payload)
     manifest_cache[imageid] = json.dumps(manifest)
   logger.debug(f'manifest: url={url} cached={cached} refresh={refresh} elapsed={round(now()-start,3)}')
   return _update_image_service(manifest)
 
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(BATCH_CONCURRENCY * 2, 16), thread_name_prefix='batch')
+
+def _batch_resolve(manifestid):
+  resolved = manifestid_to_url(manifestid)
+  if not resolved or not resolved[1]:
+    raise ValueError(f'Unrecognized manifest id: {manifestid}')
+  manifestid, url = resolved
+  return manifestid, sha256(url.encode('utf-8')).hexdigest()
+
+def _generate_and_cache(manifestid, imageid, refresh=None):
+  manifest = get_manifest(manifestid=manifestid, refresh=refresh)
+  if manifest:
+    manifest_cache[imageid] = json.dumps(manifest)
+    _enrich_later(manifestid, imageid)
+  return manifest
+
+async def _batch_manifests(ids, refresh=None):
+  """
+  Yields (index, result) for each requested id as it completes.  Cache hits are read in one
+  parallel Bucket read, misses are generated at most BATCH_CONCURRENCY at a time.
+  """
+  loop = asyncio.get_running_loop()
+  resolved = await asyncio.gather(*[loop.run_in_executor(batch_executor, _batch_resolve, manifestid) for manifestid in ids], return_exceptions=True)
+  imageids = [rec[1] for rec in resolved if isinstance(rec, tuple)]
+  cached = await loop.run_in_executor(batch_executor, manifest_cache.get_many, imageids) if not refresh and imageids else {}
+  slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+  async def _item(idx):
+    if isinstance(resolved[idx], Exception):
+      return idx, {'id': ids[idx], 'status': 404, 'error': str(resolved[idx])}
+    manifestid, imageid = resolved[idx]
+    manifest = json.loads(cached[imageid]) if imageid in cached else None
+    if not manifest:
+      async with slots:
+        try:
+          manifest = await loop.run_in_executor(batch_executor, _generate_and_cache, manifestid, imageid, refresh)
+        except ScratchSpaceExceeded as e:
+          return idx, {'id': ids[idx], 'status': 503, 'error': str(e)}
+        except Exception as e:
+          logger.warning(f'batch_manifests: manifestid={manifestid} error={e}')
+          return idx, {'id': ids[idx], 'status': 500, 'error': str(e)}
+    if not manifest:
+      return idx, {'id': ids[idx], 'status': 404, 'error': 'Not found'}
+    return idx, {'id': ids[idx], 'status': 200, 'manifest': _update_image_service(manifest)}
+
+  for item in asyncio.as_completed([_item(idx) for idx in range(len(ids))]):
+    yield await item
+
+@app.post('manifests')
+async def batch_manifests(request: Request, refresh: Optional[str] = None, stream: Optional[str] = None):
+  """
+  Manifests for a list of manifest ids (a JSON array, or {"ids": [...]}).  Returns a JSON array
+  of {id, status, manifest|error} in request order or, with ?stream or Accept: application/x-ndjson,
+  one NDJSON line per item (with its index) as each completes.
+  """
+  start = now()
+  payload = json.loads(await request.body() or '[]')
+  ids = payload if isinstance(payload, list) else payload.get('ids')
+  if not isinstance(ids, list) or not ids:
+    raise HTTPException(status_code=400, detail='Expected a list of manifest ids')
+  if len(ids) > BATCH_MAX_ITEMS:
+    raise HTTPException(status_code=413, detail=f'At most {BATCH_MAX_ITEMS} manifest ids per request')
+  refresh = _refresh_mode(refresh) or (_refresh_mode(payload.get('refresh')) if isinstance(payload, dict) else None)
+
+  if stream in ('', 'true') or 'application/x-ndjson' in request.headers.get('accept', ''):
+    async def _lines():
+      async for idx, result in _batch_manifests(ids, refresh):
+        yield json.dumps({'index': idx, **result}) + '\n'
+      logger.debug(f'batch_manifests: items={len(ids)} stream=true elapsed={round(now()-start,3)}')
+    return StreamingResponse(_lines(), media_type='application/x-ndjson')
+
+  results = [None] * len(ids)
+  async for idx, result in _batch_manifests(ids, refresh):
+    results[idx] = result
+  logger.debug(f'batch_manifests: items={len(ids)} elapsed={round(now()-start,3)}')
+  return results
+
 @app.get('thumbnail/{manifestid:path}')
 async def thumbnail(manifestid: str, url: Optional[str] = None, refresh: Optional[str] = None):
-  refresh = refresh in ('', 'true')
-  manifestid, url = url or _manifestid_to_url(manifestid)
+  refresh = _refresh_mode(refresh)
+  manifestid, url = url or manifestid_to_url(manifestid)
   imageid = sha256(url.encode('utf-8')).hexdigest()
   logger.debug(f'thumbnail: imageid={imageid} exists={imageid+".tif" in image_cache}')
   manifest = json.loads(manifest_cache.get(imageid, '{}')) if not refresh else None
   if not manifest:
     manifest = get_manifest(manifestid=manifestid, refresh=refresh)
     manifest_cache[imageid] = json.dumps(manifest)
-  return RedirectResponse(url=_update_image_service(manifest)['thumbnail'][0]['id'])
-
-def s3_key_exists(bucket_name: str, key: str) -> bool:
-    """
-    Check whether a given key exists in the specified S3 bucket.
-
-    :param bucket_name: Name of the S3 bucket (e.g., "juncture-thumbnail-cache")
-    :param key:         The object key to check (e.g., "image/foo.png")
-    :return:            True if the object exists, False if it does not.
-    """
-    s3 = boto3.client('s3')
-    try:
-        s3.head_object(Bucket=bucket_name, Key=key)
-        return True
-    except ClientError as e:
-        # If a 404 Not Found error is thrown, the key does not exist.
-        if e.response["Error"]["Code"] == "404":
-            return False
-        # For any other error (403, 400, etc.), you may want to re-raise or handle differently.
-        raise
-
-def upload_image_to_s3(bucket_name: str, key: str, image_bytes: bytes, content_type: str = "image/png"):
-  """
-  Uploads an image (raw bytes) to S3.
-
-  :param bucket_name:  The target S3 bucket name (e.g. "juncture-thumbnail-cache")
-  :param key:          The S3 key/path under which to store the image (e.g. "image/foo.png")
-  :param image_bytes:  The image data as raw bytes
-  :param content_type: The MIME type of the image (e.g. "image/png" or "image/jpeg")
-  """
-  s3 = boto3.client('s3')
-  s3.put_object(
-    Bucket=bucket_name,
-    Key=key,
-    Body=image_bytes,
-    ContentType=content_type,
-    CacheControl="max-age=86400"  # optional: instruct CloudFront (and browsers) to cache for 1 day
-  )
-
-def resize_image(img: Image.Image, size: str) -> Image.Image:
-  """
-  Given a PIL Image `img` and a comma-separated `size` string "w,h",
-  return a new Image resized as follows:
-    - If both w>0 and h>0: force resize to (w, h)
-    - If h==0: scale by width only
-    - If w==0: scale by height only
-    - If both are 0: return original img unchanged
-  """
-  # 1) Parse "w,h" into two integers, blank→0
-  parts = size.split(",", 1)
-  if len(parts) < 2:
-    parts += [""] * (2 - len(parts))
-
-  # Convert blank or whitespace string to 0, else int(...)
-  target_w, target_h = [
-    int(p.strip()) if p.strip() else 0
-    for p in parts
-  ]
-  buf = io.BytesIO()  
-  
-  # Case A: both dimensions > 0 → force exact resize
-  if target_w > 0 and target_h > 0:
-    resized_img = img.resize((target_w, target_h), resample=Image.LANCZOS)
-    resized_img.save(buf, format='JPEG')
-
-  # Case B: height == 0 → scale by width only
-  if target_h == 0 and target_w > 0:
-    # Make a copy so we don't mutate original
-    resized_img = img.copy()
-    # Provide a huge max-height so only width is constrained
-    max_width = target_w
-    max_height = sys.maxsize
-    resized_img.thumbnail((max_width, max_height), resample=Image.LANCZOS)
-    resized_img.save(buf, format='JPEG')
-
-  # Case C: width == 0 → scale by height only
-  elif target_w == 0 and target_h > 0:
-    # Make a copy so we don't mutate original
-    resized_img = img.copy()
-    max_width = sys.maxsize
-    max_height = target_h
-    resized_img.thumbnail((max_width, max_height), resample=Image.LANCZOS)
-    resized_img.save(buf, format='JPEG')
-    
-  else: # Case D: both w==0 and h==0 → return original
-    img.save(buf, format='JPEG')
-  
-  return buf.getvalue()
-  
-async def _get_image(image_key, transformations: Optional[str] = '') -> Optional[bytes]:
-  # Parse transformation string like: w_300,h_200,c_fill
-  params = {}
-  for part in transformations.split(','):
-    if '_' in part:
-      key, val = part.split('_', 1)
-      params[key] = val
-  
-  if 'w' in params:
-    if 'h' in params: size = f'{params["w"]},{params["h"]}'
-    else: size = f'{params["w"]},'
-  elif 'h' in params: size = f',{params["h"]}'
-  else: 
-    transformations = 'w_1000'
-    size = '1000,'
-  
-  _, url = _manifestid_to_url(image_key)
-  imageid = sha256(url.encode('utf-8')).hexdigest()  
-  s3_key =  f'image/{image_key}/{transformations}'
-  iiif_url = f'{{IMAGE_SERVICE_BASEURL}}/iiif/3/{imageid}/full/{size}/0/default.jpg'
+    _enrich_later(manifestid, imageid)
+  manifest = _update_image_service(manifest)
+  if not manifest.get('thumbnail'):
+    raise HTTPException(status_code=404, detail='No thumbnail')
+  return RedirectResponse(url=manifest['thumbnail'][0]['id'])
+
+@app.get('derivative/{key:path}')
+async def derivative(key: str):
+  body, content_type, _ = await run_in_threadpool(thumbnail_cache.lookup, key)
+  if body is None:
+    raise HTTPException(status_code=404, detail='Not found')
+  headers = {'Cache-Control': 'max-age=86400'}
+  if isinstance(body, bytes):
+    return Response(content=body, media_type=content_type, headers=headers)
+  return StreamingResponse(body, media_type=content_type, headers=headers)
+
+async def _get_image(image_key, transformations: Optional[str] = '', accept: Optional[str] = '') -> Response:
+  # Parse transformation string like: w_300,h_200,c_fill,f_auto,dpr_2
+  try:
+    resolved = transforms.resolve(transforms.parse(transformations), accept)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  headers = {'Vary': 'Accept'} if resolved['negotiated'] else {}
+  media_type = transforms.media_type(resolved)
+
+  _, url = manifestid_to_url(image_key)
+  imageid = sha256(url.encode('utf-8')).hexdigest()
+  s3_key = f'image/{image_key}/{transforms.cache_key(resolved)}'
+
+  width = height = None
+  if resolved['c'] == 'fill':
+    image_data = _find_item(await run_in_threadpool(get_manifest_as_json, image_key), type='Annotation', attr='motivation', attr_val='painting', sub_attr='body') or {}
+    width, height = image_data.get('width'), image_data.get('height')
+  region, size, ext = transforms.iiif_request(resolved, width, height)
+  local_render = transforms.needs_local_render(resolved, width, height)
+  iiif_url = f'{IMAGE_SERVICE_BASEURL}/iiif/3/{imageid}/{region}/{size}/0/default.{ext}'
   
-  logger.info(f'_get_image: image_key={image_key} transformations={transformations} s3_key={s3_key} iiif_url={iiif_url} s3_key_exists={s3_key_exists("juncture-thumbnail-cache", s3_key)}')
+  body, content_type, origin = await run_in_threadpool(thumbnail_cache.lookup, s3_key)
+  logger.info(f'_get_image: image_key={image_key} transformations={transformations} s3_key={s3_key} iiif_url={iiif_url} local_render={local_render} cached={origin}')
 
-  if s3_key_exists('juncture-thumbnail-cache', s3_key):
-    s3_client = boto3.client('s3')
-    try:
-      resp = s3_client.get_object(Bucket='juncture-thumbnail-cache', Key=s3_key)
-    except ClientError as e:
-        # If the object does not exist, return a 404; else re‐raise
-        error_code = e.response['Error']['Code']
-        if error_code in ('NoSuchKey', '404'):
-            raise HTTPException(status_code=404, detail='Object not found in S3')
-        raise
-
-    # Read the object’s body into bytes
-    body_stream = resp['Body']
-    content = body_stream.read()
-
-    # Determine the Content-Type from the S3 response headers (default to application/octet-stream)
-    content_type = resp.get('ContentType', 'application/octet-stream')
-
-    # Return as a streaming response (suitable for large files)
-    # return StreamingResponse(io.BytesIO(content), media_type=content_type)
-    return StreamingResponse(io.BytesIO(content), media_type=content_type, headers={'X-Origin': 'Lambda'})
+  if body is not None:
+    if isinstance(body, bytes):
+      return Response(content=body, media_type=content_type, headers={'X-Origin': 'Lambda', **headers})
+    return StreamingResponse(body, media_type=content_type, headers={'X-Origin': 'Lambda', **headers})
   else:
+    client = httpx.AsyncClient()
+    iiif_response = None
+    streaming = False # once the response is handed to _tee_to_thumbnail_cache it closes the client
     try:
-      async with httpx.AsyncClient() as client:
-        iiif_response = await client.get(iiif_url)
-        if iiif_response.status_code == 200:
-          image = iiif_response.content
-          upload_image_to_s3(bucket_name='juncture-thumbnail-cache', key=s3_key, image_bytes=image, content_type='image/jpeg')
-          return RedirectResponse(url=iiif_url)
-        else:
-          manifest = get_manifest_as_json(image_key)
-          image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
-          image_response = await client.get(image_data['id'])
-          if image_response.status_code == 200:
-            image = resize_image(Image.open(io.BytesIO(image_response.content)), size=size)
-            upload_image_to_s3(bucket_name='juncture-thumbnail-cache', key=s3_key, image_bytes=image, content_type='image/jpeg')
-            return StreamingResponse(io.BytesIO(image), media_type='image/jpeg')
-          else:
-            return Response(content=f'Error fetching image: {iiif_response.status_code} - {iiif_response.text}', media_type='text/plain', status_code=iiif_response.status_code)
+      iiif_response = await client.send(client.build_request('GET', iiif_url), stream=True)
+      if iiif_response.status_code == 200:
+        if not local_render:
+          streaming = True
+          return _tee_to_thumbnail_cache(client, iiif_response, s3_key, media_type, headers)
+        image = transforms.render(Image.open(io.BytesIO(await iiif_response.aread())), resolved)
+      else:
+        await iiif_response.aread()
+        manifest = await run_in_threadpool(get_manifest_as_json, image_key)
+        image_data = _find_item(manifest, type='Annotation', attr='motivation', attr_val='painting', sub_attr='body')
+        if not image_data or not image_data.get('id'):
+          raise HTTPException(status_code=404, detail='Image not found')
+        image_response = await client.get(image_data['id'])
+        if image_response.status_code != 200:
+          return Response(content=f'Error fetching image: {image_response.status_code} - {image_response.text}', media_type='text/plain', status_code=image_response.status_code)
+        image = transforms.render(Image.open(io.BytesIO(image_response.content)), resolved)
+      background = BackgroundTask(thumbnail_cache.put, s3_key, image, content_type=media_type)
+      return Response(content=image, media_type=media_type, headers=headers, background=background)
     except httpx.RequestError as e:
       # Network or DNS issues
       raise HTTPException(status_code=502, detail=f"Network error: {str(e)}")
+    finally:
+      if not streaming:
+        if iiif_response is not None:
+          await iiif_response.aclose()
+        await client.aclose()
+
+def _tee_to_thumbnail_cache(client: httpx.AsyncClient, upstream: httpx.Response, s3_key: str, media_type: str, headers: dict) -> StreamingResponse:
+  """
+  Streams an upstream IIIF response to the client while collecting its bytes, then writes the
+  complete derivative to the thumbnail cache once the response has been sent.  Partial bodies
+  (client disconnects, upstream errors) are not cached.
+  """
+  chunks = []
+  state = {'complete': False}
+
+  async def _stream():
+    try:
+      async for chunk in upstream.aiter_bytes():
+        chunks.append(chunk)
+        yield chunk
+      state['complete'] = True
+    finally:
+      await upstream.aclose()
+      await client.aclose()
+
+  def _write_through():
+    if state['complete']:
+      thumbnail_cache.put(s3_key, b''.join(chunks), content_type=media_type)
+    else:
+      logger.warning(f'_tee_to_thumbnail_cache: incomplete upstream response, not caching s3_key={s3_key}')
+
+  return StreamingResponse(_stream(), media_type=media_type, headers={'X-Origin': 'IIIF', **headers}, background=BackgroundTask(_write_through))
 
 def is_valid_transformations(transform_str: str) -> bool:
     """
     Returns True if transform_str is a comma-separated list of key_value pairs
     where:
-      - key is one or more letters (a–z, case-insensitive)
-      - value is one or more alphanumeric characters (no commas or slashes)
+      - key is a known transformation (w, h, c, q, f, dpr)
+      - value is valid for that key (no commas or slashes)
     Examples of valid strings:
       "w_300"
       "w_300,h_200,c_fill"
+      "w_300,c_limit,q_80,f_auto,dpr_2"
     """
-    # Each segment must match `<alpha>_<alnum>`
-    segment_pattern = re.compile(r"^[A-Za-z]+_[A-Za-z0-9]+$")
-    for part in transform_str.split(","):
-        if not segment_pattern.match(part):
-            return False
-    return True
+    return transforms.is_valid(transform_str)
 
 @app.get('image/{image_key:path}/{transformations:path}')
-async def get_image_with_transformations(transformations: str, image_key: str):
+async def get_image_with_transformations(request: Request, transformations: str, image_key: str):
   if not is_valid_transformations(transformations):
     image_key += f'/{transformations}'
     transformations = ''
-  return await _get_image(image_key, transformations)
+  return await _get_image(image_key, transformations, accept=request.headers.get('accept', ''))
 
 @app.get('image/{image_key:path}')
-async def get_image_without_transformations(image_key: str):  
-  return await _get_image(image_key)
+async def get_image_without_transformations(request: Request, image_key: str):  
+  return await _get_image(image_key, accept=request.headers.get('accept', ''))
+
+if LOCAL_IMAGE_SERVER:
+  import image_server
+
+  @app.get('iiif/3/{identifier}')
+  async def iiif_image_service(identifier: str):
+    return RedirectResponse(url=f'{IMAGE_SERVICE_BASEURL}/iiif/3/{identifier}/info.json', status_code=303)
+
+  @app.get('iiif/3/{identifier}/info.json')
+  async def iiif_image_info(identifier: str):
+    try:
+      info = await run_in_threadpool(image_server.info, identifier, f'{IMAGE_SERVICE_BASEURL}/iiif/3/{identifier}')
+    except image_server.IIIFError as e:
+      raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(content=json.dumps(info), media_type='application/ld+json;profile="http://iiif.io/api/image/3/context.json"')
+
+  @app.get('iiif/3/{identifier}/{region}/{size}/{rotation}/{quality}.{fmt}')
+  async def iiif_image(identifier: str, region: str, size: str, rotation: str, quality: str, fmt: str):
+    try:
+      body, media_type = await run_in_threadpool(image_server.render, identifier, region, size, rotation, quality, fmt)
+    except image_server.IIIFError as e:
+      raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return Response(content=body, media_type=media_type, headers={'Cache-Control': 'max-age=86400'})
 
 def breadcrumb_el(acct, repo, path, baseurl='https://iiif.juncture.io'):
   el = '<sl-breadcrumb>'
@@ -389,12 +506,165 @@ async def prezi2to3(request: Request, manifest: Optional[str] = None):
 async def ghdir(path: str, filter: Optional[str] = None):
   acct, repo, *path = path.split('/')
   path = '/'.join(path)
-  dir_list = gh.gh_dir_list(acct, repo, path)
-  if filter == 'images':
-    return _images_from_dir_list(dir_list)
-  else:
-    return dir_list
+  index = await run_in_threadpool(gh.repo_index, acct, repo)
+  if index is None:
+    dir_list = await run_in_threadpool(gh.gh_dir_list, acct, repo, path)
+    return _images_from_dir_list(dir_list) if filter == 'images' else dir_list
+  return index.images(path) if filter == 'images' else index.dir_list(path)
+
+
+def _gh_collection(baseurl, acct, repo, path, manifests):
+  collection_id = f'{baseurl}/gh-collection/{acct}/{repo}{"/" if path else ""}{path}'
+  return {
+    '@context': 'http://iiif.io/api/presentation/3/context.json',
+    'id': collection_id,
+    'type': 'Collection',
+    'label': { 'none': [ path.split('/')[-1] if path else repo ] },
+    'items': [dict([(fld, manifest[fld]) for fld in ('id', 'type', 'label', 'thumbnail') if fld in manifest]) for manifest in manifests]
+  }
+
+def _gh_multi_canvas_manifest(baseurl, acct, repo, path, manifests):
+  manifest = {
+    '@context': 'http://iiif.io/api/presentation/3/context.json',
+    'id': f'{baseurl}/gh-collection/{acct}/{repo}{"/" if path else ""}{path}?type=manifest',
+    'type': 'Manifest',
+    'label': { 'none': [ path.split('/')[-1] if path else repo ] },
+    'items': [{**item['items'][0], 'label': item['label']} for item in manifests if item.get('items')]
+  }
+  if manifests and manifests[0].get('thumbnail'):
+    manifest['thumbnail'] = manifests[0]['thumbnail']
+  return manifest
 
+@app.get('gh-collection/{path:path}')
+async def gh_collection(request: Request, path: str, ref: Optional[str] = None, type: Optional[str] = None, refresh: Optional[str] = None):
+  """
+  IIIF Collection (or, with ?type=manifest, a single multi-canvas Manifest) of the images in a
+  GitHub directory.  Cached by the directory's git tree sha, so an unchanged directory is served
+  without regenerating or re-reading any of its manifests.
+  """
+  start = now()
+  refresh = _refresh_mode(refresh)
+  baseurl = str(request.base_url)[:-1]
+  acct, repo, *path = path.split('/')
+  path = '/'.join(path).strip('/')
+  kind = 'manifest' if type == 'manifest' else 'collection'
+  if ref and not await run_in_threadpool(gh.is_ref, acct, repo, ref):
+    # member manifest ids carry the ref, and only branches and commit shas resolve there (see gh.split_ref)
+    raise HTTPException(status_code=400, detail=f'ref must be a branch or commit sha: {ref}')
+  index = await run_in_threadpool(gh.repo_index, acct, repo, ref)
+  if index and index.tree_sha(path):
+    tree_sha, entries = index.tree_sha(path), index.dir_list(path)
+  else:
+    tree_sha, entries = await run_in_threadpool(gh.gh_dir_tree, acct, repo, path, ref)
+  if not tree_sha:
+    raise HTTPException(status_code=404, detail='Directory not found')
+  cache_key = f'collections/{acct}/{repo}/{path}/{tree_sha}-{kind}.json'
+  cached = None if refresh else await run_in_threadpool(manifest_cache.get, cache_key)
+  if cached:
+    logger.debug(f'gh_collection: key={cache_key} cached=True elapsed={round(now()-start,3)}')
+    return json.loads(cached)
+
+  ids = [f'gh:{acct}/{repo}/{ref + "/" if ref else ""}{item["path"]}' for item in _images_from_dir_list(entries)]
+  results = [None] * len(ids)
+  if ids:
+    async for idx, result in _batch_manifests(ids, refresh):
+      results[idx] = result
+  manifests = [result['manifest'] for result in results if result['status'] == 200]
+  collection = (_gh_multi_canvas_manifest if kind == 'manifest' else _gh_collection)(baseurl, acct, repo, path, manifests)
+  if len(manifests) == len(ids) and not LOCAL_IMAGE_SERVER: # partial results and local image service URLs are not cached
+    await run_in_threadpool(manifest_cache.__setitem__, cache_key, json.dumps(collection))
+  logger.debug(f'gh_collection: key={cache_key} cached=False items={len(manifests)}/{len(ids)} elapsed={round(now()-start,3)}')
+  return collection
+
+async def wc_category_collection(request: Request, manifestid: str, refresh: Optional[str] = None):
+  """
+  IIIF Collection of the files in a Commons category (a wc:Category:... id).  Member metadata and
+  rendition URLs are fetched in batches before the member manifests are generated concurrently,
+  and the collection is cached by its membership, so an unchanged category is served without
+  regenerating it.
+  """
+  start = now()
+  refresh = _refresh_mode(refresh)
+  baseurl = str(request.base_url)[:-1]
+  category = manifestid[3:].replace(' ','_')
+  titles = await run_in_threadpool(wc.category_titles, category, refresh=bool(refresh))
+  if not titles:
+    raise HTTPException(status_code=404, detail='Category not found or has no files')
+  membership = sha256('\n'.join(titles).encode('utf-8')).hexdigest()[:16]
+  cache_key = f'collections/wc/{category}/{membership}.json'
+  cached = None if refresh else await run_in_threadpool(manifest_cache.get, cache_key)
+  if cached:
+    logger.debug(f'wc_category_collection: key={cache_key} cached=True elapsed={round(now()-start,3)}')
+    return json.loads(cached)
+
+  await run_in_threadpool(prefetch_wc, titles)
+  ids = [f'wc:{title}' for title in titles]
+  results = [None] * len(ids)
+  async for idx, result in _batch_manifests(ids, refresh):
+    results[idx] = result
+  manifests = [result['manifest'] for result in results if result['status'] == 200]
+  collection = {
+    '@context': 'http://iiif.io/api/presentation/3/context.json',
+    'id': f'{baseurl}/{manifestid}/manifest.json',
+    'type': 'Collection',
+    'label': { 'none': [ category.split(':', 1)[1].replace('_',' ') ] },
+    'items': [dict([(fld, manifest[fld]) for fld in ('id', 'type', 'label', 'thumbnail') if fld in manifest]) for manifest in manifests]
+  }
+  if len(manifests) == len(ids) and not LOCAL_IMAGE_SERVER: # partial results and local image service URLs are not cached
+    await run_in_threadpool(manifest_cache.__setitem__, cache_key, json.dumps(collection))
+  logger.debug(f'wc_category_collection: key={cache_key} cached=False items={len(manifests)}/{len(ids)} elapsed={round(now()-start,3)}')
+  return collection
+
+def _invalidate_gh_target(target):
+  """Drops cached data for a pushed path: the manifest and its metadata always, image info and derivatives when the image changed"""
+  imageid = sha256(target['url'].encode('utf-8')).hexdigest()
+  del manifest_cache[imageid]
+  del manifest_cache[f'metadata/{imageid}.json']
+  provisional_manifests.pop(imageid, None)
+  if target['image_changed']:
+    for key in (f'{imageid}.json', f'{imageid}.info.json'):
+      del image_info_cache[key]
+    thumbnail_cache.delete_prefix(f'video/{imageid}/')
+    if LOCAL_IMAGE_SERVER:
+      image_server.invalidate(imageid)
+    for manifestid in target['manifestids']:
+      thumbnail_cache.delete_prefix(f'image/{manifestid}/')
+  return imageid
+
+@app.post('gh-webhook')
+async def gh_webhook(request: Request):
+  """
+  GitHub push webhook.  Invalidates the cached manifests, image info and derivatives of the
+  images and YAML sidecars changed by a push, then queues their regeneration so the next
+  viewer gets a fresh cache hit.  Requests must be signed with GH_WEBHOOK_SECRET.
+  """
+  start = now()
+  body = await request.body()
+  if not gh.verify_signature(body, request.headers.get('x-hub-signature-256'), GH_WEBHOOK_SECRET):
+    raise HTTPException(status_code=401, detail='Invalid signature')
+  event = request.headers.get('x-github-event')
+  if event == 'ping':
+    return {'event': event}
+  if event != 'push':
+    return JSONResponse(status_code=202, content={'event': event, 'ignored': True})
+
+  payload = json.loads(body)
+  head = gh.push_head(payload)
+  if head:
+    acct, repo, branch, after = head
+    gh.head_shas[(acct, repo, branch)] = after # branch reads see the push before the head sha cache would expire
+  targets = await run_in_threadpool(gh.push_targets, payload)
+  results = []
+  for target in targets:
+    imageid = await run_in_threadpool(_invalidate_gh_target, target)
+    job = None
+    if not target['removed']:
+      # a YAML-only change keeps the image pyramid and info, only the metadata is re-read.  A job
+      # already running for the image read the previous commit, so it is run again for this one
+      job = await run_in_threadpool(ingest_jobs.submit, imageid, requeue=True, manifestid=target['manifestids'][0], download_url=target['download_url'], refresh=RefreshMode.IMAGE.value if target['image_changed'] else RefreshMode.METADATA.value)
+    results.append({'manifestid': target['manifestids'][0], 'imageid': imageid, 'image_changed': target['image_changed'], 'removed': target['removed'], 'job': job['id'] if job else None})
+  logger.info(f'gh_webhook: targets={len(targets)} elapsed={round(now()-start,3)}')
+  return JSONResponse(status_code=202, content={'event': event, 'items': results})
 
 @app.get('gh-token')
 async def gh_token(code: Optional[str] = None, hostname: Optional[str] = None):
@@ -422,6 +692,21 @@ async def gh_token(code: Optional[str] = None, hostname: Optional[str] = None):
   logger.debug(f'gh_token: code={code} hostname={hostname} token={token}')
   return Response(status_code=status_code, content=token, media_type='text/plain')
 
+@app.get('status')
+async def status():
+  return {'scratch': scratch.usage(), 'memory': memory.usage(), 'stages': stages.stats()}
+
+@app.get('jobs/{job_id}')
+async def job_status(request: Request, job_id: str):
+  job = await run_in_threadpool(ingest_jobs.get, job_id)
+  if not job:
+    raise HTTPException(status_code=404, detail='Job not found')
+  return _job_resource(request, job)
+
+@app.get('jobs/{job_id}/events')
+async def job_events(job_id: str):
+  return StreamingResponse(ingest_jobs.events(job_id), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 def is_browser(user_agent):
     # List of common browser signatures
     browser_signatures = ['Chrome', 'Firefox', 'Safari', 'Edge', 'Opera', 'Gecko', 'WebKit']
@@ -430,27 +715,53 @@ def is_browser(user_agent):
     return any(signature in user_agent for signature in browser_signatures)
 
 @app.get('{manifestid:path}/manifest.json')
-async def manifest(manifestid: str, refresh: Optional[str] = None):
-  return get_manifest_as_json(manifestid, refresh)
+async def manifest(request: Request, manifestid: str, refresh: Optional[str] = None, async_: Optional[str] = Query(None, alias='async'), progressive: Optional[str] = None, enrich: Optional[str] = None):
+  if wc.is_category(manifestid):
+    return await wc_category_collection(request, manifestid, refresh)
+  if _wants_async(request, async_):
+    return get_manifest_or_job(request, manifestid, refresh)
+  return get_manifest_as_json(manifestid, refresh, _wants_progressive(progressive), enrich in ('', 'true'))
 
 @app.get('{manifestid:path}')
-async def image_viewer(request: Request, manifestid: str, refresh: Optional[str] = None):
+async def image_viewer(request: Request, manifestid: str, refresh: Optional[str] = None, async_: Optional[str] = Query(None, alias='async'), progressive: Optional[str] = None, enrich: Optional[str] = None):
   if is_browser(request.headers['user-agent']):
     return Response(content=get_image_viewer_html(request, manifestid), media_type='text/html')
+  elif wc.is_category(manifestid):
+    return await wc_category_collection(request, manifestid, refresh)
+  elif _wants_async(request, async_):
+    return get_manifest_or_job(request, manifestid, refresh)
   else:
-    return get_manifest_as_json(manifestid, refresh)
+    return get_manifest_as_json(manifestid, refresh, _wants_progressive(progressive), enrich in ('', 'true'))
 
-def get_manifest_as_json(manifestid: str, refresh: Optional[str] = None):
+def get_manifest_or_job(request: Request, manifestid: str, refresh: Optional[str] = None):
+  """Cached manifest if there is one, otherwise 202 Accepted with an ingest job to poll"""
+  refresh = _refresh_mode(refresh)
+  manifestid, url = manifestid_to_url(manifestid)
+  imageid = sha256(url.encode('utf-8')).hexdigest()
+  manifest = json.loads(manifest_cache.get(imageid, '{}')) if not refresh else None
+  if manifest:
+    return _update_image_service(manifest)
+  return _accepted(request, ingest_jobs.submit(imageid, manifestid=manifestid, refresh=refresh))
+
+def get_manifest_as_json(manifestid: str, refresh: Optional[str] = None, progressive: bool = False, enrich: bool = False):
     start = now()
-    refresh = refresh in ('', 'true')
-    manifestid, url = _manifestid_to_url(manifestid)
+    refresh = _refresh_mode(refresh)
+    manifestid, url = manifestid_to_url(manifestid)
     imageid = sha256(url.encode('utf-8')).hexdigest()
     manifest = json.loads(manifest_cache.get(imageid, '{}')) if not refresh else None
     cached = manifest is not None
+    if not manifest and progressive:
+      manifest = provisional_manifests.get(imageid)
     if not manifest:
-      manifest = get_manifest(manifestid=manifestid, refresh=refresh)
-      if manifest: manifest_cache[imageid] = json.dumps(manifest)
-    logger.debug(f'manifest: manifestid={manifestid} cached={cached} refresh={refresh} elapsed={round(now()-start,3)}')
+      manifest = get_manifest(manifestid=manifestid, refresh=refresh, progressive=progressive, enrich=enrich)
+      if manifest and is_provisional(manifest):
+        # the deep-zoom manifest replaces this one in manifest_cache when the ingest job finishes
+        provisional_manifests[imageid] = manifest
+        ingest_jobs.submit(imageid, manifestid=manifestid, refresh=refresh)
+      elif manifest:
+        manifest_cache[imageid] = json.dumps(manifest)
+        if not enrich: _enrich_later(manifestid, imageid)
+    logger.debug(f'manifest: manifestid={manifestid} cached={cached} refresh={refresh} progressive={progressive} elapsed={round(now()-start,3)}')
     if manifest:
       return _update_image_service(manifest)
     else:
@@ -467,7 +778,8 @@ def get_image_viewer_html(request: Request, manifestid: str):
       breadcrumbs = breadcrumb_el(acct, repo, path, baseurl=baseurl)
       viewer_html = viewer_html.replace('<div class="breadcrumbs"></div>', breadcrumbs)
       
-      dirs = [item['name'] for item in gh.gh_dir_list(acct, repo, path) if item['type'] == 'dir']
+      index = gh.repo_index(acct, repo)
+      dirs = index.subdirs(path) if index else [item['name'] for item in gh.gh_dir_list(acct, repo, path) if item['type'] == 'dir']
       gh_dirs = gh_dirs_el(acct, repo, path, dirs, baseurl=baseurl)
       viewer_html = viewer_html.replace('<div class="dirs"></div>', gh_dirs)
       
@@ -492,15 +804,29 @@ if __name__ == '__main__':
   parser.add_argument('--port', type=int, default=8088, help='HTTP port')
   parser.add_argument('--localwc', default=False, action='store_true', help='Use local web components')
   parser.add_argument('--wcport', type=int, default=5173, help='Port used by local WC server')
+  parser.add_argument('--localiiif', default=False, action='store_true', help='Serve IIIF image requests from this server')
+  parser.add_argument('--imagedir', default=None, help='Local directory for pyramid TIFFs (read and written instead of S3)')
 
   args = vars(parser.parse_args())
   
   os.environ['LOCAL_WC'] = str(args['localwc'])
   os.environ['LOCAL_WC_PORT'] = str(args['wcport'])
+  if args['localiiif']:
+    os.environ['LOCAL_IMAGE_SERVER'] = 'true'
+    os.environ['IMAGE_SERVICE_BASEURL'] = f'http://localhost:{args["port"]}'
+  if args['imagedir']:
+    os.makedirs(args['imagedir'], exist_ok=True)
+    os.environ['LOCAL_IMAGE_DIR'] = os.path.abspath(args['imagedir'])
 
-  logger.info(f'LOCAL_WC={os.environ["LOCAL_WC"]} LOCAL_WC_PORT={os.environ["LOCAL_WC_PORT"]} ')
+  logger.info(f'LOCAL_WC={os.environ["LOCAL_WC"]} LOCAL_WC_PORT={os.environ["LOCAL_WC_PORT"]} LOCAL_IMAGE_SERVER={os.environ.get("LOCAL_IMAGE_SERVER", "false")} LOCAL_IMAGE_DIR={os.environ.get("LOCAL_IMAGE_DIR")}')
 
   uvicorn.run('main:app', port=args['port'], log_level='info', reload=args['reload'])
 else:
   from mangum import Mangum
-  handler = Mangum(app, lifespan='off')
+  _mangum_handler = Mangum(app, lifespan='off')
+
+  def handler(event, context):
+    # ingest jobs queued to SQS (JOB_QUEUE_URL) are delivered to this function as SQS events
+    if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs':
+      return ingest_jobs.process_sqs_event(event)
+    return _mangum_handler(event, context)
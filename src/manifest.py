@@ -12,18 +12,27 @@ import boto3
 import concurrent.futures
 import datetime
 import enum
+import io
 import exif
 import ffmpeg
 from hashlib import sha256
 import json
 import magic
+import mimetypes
 import os
+import re
+import shutil
 from time import time as now
 from urllib.parse import unquote
 import traceback
-import yaml
 
 import gh
+import image_server
+from admission import memory, decoded_bytes
+import memo
+import stages
+from scratch import scratch, ScratchSpaceExceeded
+from s3 import DerivativeCache
 import wc
 import wd
 
@@ -38,6 +47,45 @@ logging.getLogger('requests').setLevel(logging.WARNING)
 
 BUCKET_NAME = 'juncture-images'
 
+REQUEST_HEADERS = {
+  'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36',
+  'Referer': 'https://iiif.juncture.io/'
+}
+
+POSTER_WIDTH = 1280
+PREVIEW_WIDTH = 400
+VIDEO_PREVIEW_OFFSETS = (0.25, 0.5, 0.75) # fractions of the duration
+
+PROVISIONAL_HEAD_BYTES = 256 * 1024
+
+IN_MEMORY_MAX_BYTES = int(float(os.environ.get('IN_MEMORY_MAX_MB', '8')) * 1024 * 1024) # smaller sources are converted without touching scratch
+DOWNLOAD_RESERVE_STEP = 64 * 1024 * 1024 # scratch reserved at a time while a download outgrows its Content-Length
+TILE_MEMORY_FACTOR = 1.25 # decoded source plus the half-size pyramid level built from it
+
+METADATA_BUCKET = 'juncture-manifests' # metadata halves of manifests, under metadata/
+
+# Longest edge of the Commons rendition ingested for wc: and wd: sources (0 ingests originals).
+# WC_SOURCE_MAX_DIMENSIONS overrides it per collection, as JSON mapping manifestid prefixes to
+# dimensions, e.g. {"wc:Map_of_Paris": 12000, "wd:": 3000}; the longest matching prefix wins.
+# Prefixes match the manifestid of each file, so a Commons category can only be targeted through
+# a common file-title prefix, not its Category: name.
+WC_SOURCE_MAX_DIMENSION = int(os.environ.get('WC_SOURCE_MAX_DIMENSION', '6000'))
+WC_SOURCE_MAX_DIMENSIONS = json.loads(os.environ.get('WC_SOURCE_MAX_DIMENSIONS', '{}'))
+
+# An IIIF Image API request (.../{region}/{size}/{rotation}/{quality}.{format}), used to find the service it came from
+IIIF_IMAGE_REQUEST = re.compile(r'^(?P<service>.+?)/(full|square|\d+,\d+,\d+,\d+|pct:[\d.,]+)/[^/]+/!?[\d.]+/(default|color|gray|grey|bitonal|native)\.\w+$')
+
+AV_MIME_TYPES = {
+  'mp3': 'audio/mpeg',
+  'mp4': 'video/mp4',
+  'webm': 'video/webm',
+  'oga': 'audio/ogg',
+  'ogg': 'audio/ogg',
+  'ogv': 'video/ogg'
+}
+TILE_SIZE = 512
+LOCAL_IMAGE_DIR = os.environ.get('LOCAL_IMAGE_DIR') # when set, pyramids are written here instead of S3
+
 if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
   s3 = boto3.client('s3')
 else:
@@ -46,6 +94,8 @@ else:
     aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
   ).client('s3')
 
+thumbnail_cache = DerivativeCache(bucket='juncture-thumbnail-cache')
+
 licenses = {
   # Creative Commons Licenses
   'PD': {'label': 'Public Domain', 'url': ''},
@@ -75,36 +125,110 @@ licenses = {
   'NKC': {'label': 'NO KNOWN COPYRIGHT', 'url': 'http://rightsstatements.org/vocab/NKC/1.0/'}
 }
 
-def exists(key):
-  _exists = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=key)['KeyCount'] > 0
-  logger.debug(f'exists: bucket={BUCKET_NAME} key={key} exists={_exists}')
+class RefreshMode(str, enum.Enum):
+  """What a refresh regenerates; the other parts of the manifest are rebuilt from their cached halves"""
+  METADATA = 'metadata'       # re-read metadata sources (YAML, Commons, Wikidata), keep image info and pyramid
+  IMAGE = 'image'             # re-download and convert the image, and rebuild its derivatives; keep metadata
+  DERIVATIVES = 'derivatives' # rebuild info.json, video stills and cached transforms from the existing image
+  ALL = 'all'
+
+  @classmethod
+  def parse(cls, value):
+    """RefreshMode for a refresh query parameter or job value; True, '' and 'true' mean ALL, None, False and 'false' no refresh"""
+    if value in (None, False, 'false'):
+      return None
+    if value in (True, '', 'true'):
+      return cls.ALL
+    return cls(value)
+
+  @property
+  def metadata(self):
+    return self in (RefreshMode.METADATA, RefreshMode.ALL)
+
+  @property
+  def image(self):
+    return self in (RefreshMode.IMAGE, RefreshMode.ALL)
+
+  @property
+  def derivatives(self):
+    return self in (RefreshMode.DERIVATIVES, RefreshMode.IMAGE, RefreshMode.ALL)
+
+def exists(key, bucket=BUCKET_NAME):
+  _exists = s3.list_objects_v2(Bucket=bucket, Prefix=key)['KeyCount'] > 0
+  logger.debug(f'exists: bucket={bucket} key={key} exists={_exists}')
   return _exists
 
-def download(url, url_hash):
-  start = now()
+class Source(object):
+  """An image being ingested: a scratch file at path or, below IN_MEMORY_MAX_BYTES, its bytes in data"""
+
+  def __init__(self, path=None, data=None):
+    self.path = path
+    self.data = data
+
+  @property
+  def in_memory(self):
+    return self.data is not None
+
+  @property
+  def size(self):
+    return len(self.data) if self.in_memory else os.stat(self.path).st_size
+
+  def open(self):
+    """Something PIL and exif can read: a file-like object over the bytes, else the path"""
+    return io.BytesIO(self.data) if self.in_memory else self.path
+
+  def release(self, session):
+    """Frees the scratch file, if there is one"""
+    if not self.in_memory:
+      session.remove(self.path)
+
+def fetch_url(url):
+  """The URL a source's bytes are fetched from: for a GitHub path that is not a media file, the image_url of its YAML"""
   extension = url.split('/')[-1].split('.')[-1].lower()
-  path = None
   if 'raw.githubusercontent.com' in url and extension not in ('gif', 'jpg', 'jpeg', 'mp3', 'mp4', 'ogg', 'ogv', 'png', 'tif', 'tiff', 'webm'):
     acct, repo, ref, *path = url.split('/')[3:]
     path[-1] = f'{path[-1].replace(".yaml","")}.yaml'
     logger.debug(f'get_gh_file: acct={acct} repo={repo} ref={ref} path={path}')
-    gh_metadata = yaml.load(gh.get_gh_file(acct, repo, ref, '/'.join(path)), Loader=yaml.FullLoader)
+    gh_metadata = gh.parse_yaml(gh.get_gh_file(acct, repo, ref, '/'.join(path)))
     url = gh_metadata.get('image_url', url)
     logger.debug(f'GH Metadata: {json.dumps(gh_metadata, indent=2)}')
     logger.debug(f'GH URL: {url}')
-  resp = requests.get(url, headers={
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36',
-    'Referer': 'https://iiif.juncture.io/'
-  }, verify=False)
-  if resp.status_code < 400:
-    path = f'/tmp/{url_hash}'
-    with open(path, 'wb') as fp:
-      fp.write(resp.content)
+  return url
+
+def download(url, url_hash, session):
+  """Downloads a source into scratch, or, below IN_MEMORY_MAX_BYTES, into memory, returning a Source or None"""
+  start = now()
+  source = None
+  url = fetch_url(url)
+  resp = requests.get(url, headers=REQUEST_HEADERS, verify=False, stream=True)
+  size = int(resp.headers.get('Content-Length', 0))
+  if resp.status_code < 400 and 0 < size <= IN_MEMORY_MAX_BYTES:
+    source = Source(data=resp.content)
+  elif resp.status_code < 400:
+    # reserve the advertised size up front so large downloads wait for (or are refused) scratch space,
+    # then grow the reservation ahead of the bytes written, as Content-Length may be missing or wrong
+    path = session.path(url_hash, size)
+    reserved, written = size, 0
+    try:
+      with open(path, 'wb') as fp:
+        for chunk in resp.iter_content(chunk_size=1024*1024):
+          if written + len(chunk) > reserved:
+            reserved = max(written + len(chunk), reserved + DOWNLOAD_RESERVE_STEP)
+            session.resize(path, reserved)
+          fp.write(chunk)
+          written += len(chunk)
+    except ScratchSpaceExceeded:
+      resp.close()
+      session.remove(path)
+      logger.warning(f'download aborted: url={url} written={written} reserved={reserved}')
+      raise
+    session.resize(path, written)
+    source = Source(path=path)
   else:
     logger.warning(f'download failed: url={url} code={resp.status_code} msg={resp.text}')
-    path = None
-  logger.debug(f'download: url={url} url_hash={url_hash} elapsed={round(now()-start,3)}')
-  return path
+  resp.close()
+  logger.debug(f'download: url={url} url_hash={url_hash} in_memory={source.in_memory if source else None} elapsed={round(now()-start,3)}')
+  return source
 
 def _decimal_coords(coords, ref):
   decimal_degrees = coords[0] + coords[1] / 60 + coords[2] / 3600
@@ -131,26 +255,44 @@ def exif_data(img):
   logger.debug(json.dumps(data, indent=2))
   return data
 
-def av_info(path):
-  return ffmpeg.probe(path)['streams'][0]
+def av_info(url):
+  # ffprobe reads remote media over HTTP and seeks with range requests, so only the container
+  # headers and index are fetched, never the whole file
+  return ffmpeg.probe(url, user_agent=REQUEST_HEADERS['User-Agent'], headers=f'Referer: {REQUEST_HEADERS["Referer"]}\r\n')
+
+def _remote_head(url, nbytes=4096):
+  """Returns (size, mime, head bytes) for a remote file using a single ranged GET of its first bytes"""
+  resp = requests.get(url, headers={**REQUEST_HEADERS, 'Range': f'bytes=0-{nbytes-1}'}, stream=True, verify=False)
+  try:
+    if resp.status_code >= 400:
+      return None, None, b''
+    head = resp.raw.read(nbytes, decode_content=True) # servers that ignore Range still only send what is read here
+    content_range = resp.headers.get('Content-Range', '')
+    size = int(content_range.split('/')[-1]) if '/' in content_range and not content_range.endswith('*') else int(resp.headers.get('Content-Length', 0)) or None
+    return size, magic.from_buffer(head, mime=True), head
+  finally:
+    resp.close()
 
-def image_info(url_hash, refresh=False):
+def image_info(url_hash, source, refresh=False):
+  """Image info and EXIF of a downloaded Source"""
   s3_key = f'{url_hash}.json'
-  info = json.loads(s3.get_object(Bucket='juncture-image-info', Key=s3_key)['Body'].read()) if not refresh and exists(s3_key) else {}
+  info = json.loads(s3.get_object(Bucket='juncture-image-info', Key=s3_key)['Body'].read()) if not refresh and exists(s3_key, bucket='juncture-image-info') else {}
   if info: return info
   try:
-    path = f'/tmp/{url_hash}'
-    img = Image.open(path)
+    img = Image.open(source.open())
+    # tobytes decodes the whole image and then copies it
+    with memory.admit(decoded_bytes(img.width, img.height, len(img.getbands()), 2), label=f'image-info/{url_hash[:12]}'):
+      checksum = sha256(img.tobytes()).hexdigest()[0:8]
     info.update({
       'type': 'Image',
       'format': Image.MIME[img.format],
       'width': img.width,
       'height': img.height,
-      'size': os.stat(path).st_size,
-      'id': sha256(img.tobytes()).hexdigest()[0:8]
+      'size': source.size,
+      'id': checksum
     })
     if 'exif' in info: return info
-    _exif = exif_data(path)
+    _exif = exif_data(source.open())
     info.update({'exif': _exif})
     logger.debug(json.dumps(_exif, indent=2, sort_keys=True))
     if 'orientation' in _exif:
@@ -169,6 +311,8 @@ def image_info(url_hash, refresh=False):
       info['mode'] = f"{_exif['exposure_mode']}, {_exif['exposure_program']}"
     # info['size'] = f"{info['width']} x {info['height']} {info['format'].split('/')[-1]}"
     s3.put_object(Bucket='juncture-image-info', Key=s3_key, Body=json.dumps(info, indent=2))
+  except ScratchSpaceExceeded:
+    raise
   except:
     logger.error(traceback.format_exc())
   logger.debug(json.dumps(info, indent=2))
@@ -178,84 +322,429 @@ def hms_to_secs(time_str):
     h, m, s = time_str.split(':')
     return int(h) * 3600 + int(m) * 60 + int(float(s))
   
-def media_info(path):
+def media_info(url, url_hash):
+  start = now()
   _media_info = {}
-  mime = magic.from_file(path, mime=True)
-  _type = mime.split('/')[0]
-  logger.debug(f'media_info: path={path} mime={mime} type={_type}')
-  if _type in ('audio', 'video'):
-    _av_info = av_info(path)
-    if _av_info:
-      logger.debug(json.dumps(_av_info, indent=2))
-      if 'display_aspect_ratio' in _av_info:
-        wh = [int(v) for v in _av_info['display_aspect_ratio'].split(':')]
-        aspect = wh[0]/wh[1]
-        _av_info['width'] = round(_av_info['height'] * aspect)
-      _media_info = {
-        'type': _type.replace('audio', 'sound').capitalize(),
-        'format': mime,
-        'size': os.stat(path).st_size
-      }
-      for fld in ('duration', 'height', 'width'):
-        if fld in _av_info:
-          _media_info[fld] = _av_info[fld]
-      if 'tags' in _av_info and 'DURATION' in _av_info['tags']:
-        _media_info['duration'] = hms_to_secs(_av_info['tags']['DURATION'])
-        
-      if 'duration' in _media_info:
-        _media_info['duration'] = round(float(_media_info['duration']), 1)
+  size, mime, _ = _remote_head(url)
+  try:
+    probe = av_info(url)
+  except ffmpeg.Error as e:
+    logger.warning(f'media_info: url={url} probe failed: {e.stderr.decode("utf-8", "ignore") if e.stderr else e}')
+    return _media_info
+  streams = probe.get('streams', [])
+  video = [st for st in streams if st.get('codec_type') == 'video' and not st.get('disposition', {}).get('attached_pic')]
+  audio = [st for st in streams if st.get('codec_type') == 'audio']
+  _av_info = (video or audio or [None])[0]
+  _type = 'video' if video else 'audio'
+  if not mime or mime.split('/')[0] not in ('audio', 'video'):
+    mime = AV_MIME_TYPES.get(url.split('.')[-1].lower(), f'{_type}/octet-stream')
+  logger.debug(f'media_info: url={url} mime={mime} type={_type}')
+  if _av_info:
+    logger.debug(json.dumps(_av_info, indent=2))
+    if 'display_aspect_ratio' in _av_info:
+      wh = [int(v) for v in _av_info['display_aspect_ratio'].split(':')]
+      if wh[0] and wh[1]:
+        _av_info['width'] = round(_av_info['height'] * wh[0]/wh[1])
+    _media_info = {
+      'type': _type.replace('audio', 'sound').capitalize(),
+      'format': mime,
+      'size': int(probe.get('format', {}).get('size', 0)) or size
+    }
+    for fld in ('duration', 'height', 'width'):
+      if fld in _av_info:
+        _media_info[fld] = _av_info[fld]
+    if 'tags' in _av_info and 'DURATION' in _av_info['tags']:
+      _media_info['duration'] = hms_to_secs(_av_info['tags']['DURATION'])
+    if 'duration' not in _media_info and 'duration' in probe.get('format', {}):
+      _media_info['duration'] = probe['format']['duration']
+      
+    if 'duration' in _media_info:
+      _media_info['duration'] = round(float(_media_info['duration']), 1)
+  logger.debug(f'media_info: url={url} elapsed={round(now()-start,3)}')
   return _media_info
 
-def convert(url_hash, quality=50, refresh=False, **kwargs):
+def video_frame(url, offset, width):
+  """
+  Extracts a single JPEG frame near offset seconds.  Input seeking (-ss before -i) jumps to the
+  nearest keyframe using the container index and -skip_frame nokey decodes keyframes only, so
+  only a small byte range of the remote file is read and no full decode happens.
+  """
+  out, _ = (
+    ffmpeg
+      .input(url, ss=offset, skip_frame='nokey', user_agent=REQUEST_HEADERS['User-Agent'], headers=f'Referer: {REQUEST_HEADERS["Referer"]}\r\n')
+      .output('pipe:', vframes=1, format='image2', vcodec='mjpeg', vf=f'scale={width}:-2', **{'q:v': 3})
+      .run(capture_stdout=True, capture_stderr=True)
+  )
+  return out
+
+def video_derivatives(url, url_hash, _media_info):
+  """Poster frame and preview stills for a video, stored in the thumbnail cache"""
   start = now()
+  duration = float(_media_info.get('duration') or 0)
+  width = min(POSTER_WIDTH, _media_info.get('width') or POSTER_WIDTH)
+  height = round(width * _media_info['height'] / _media_info['width']) if _media_info.get('width') and _media_info.get('height') else None
+  frames = [('poster', min(duration * 0.1, 10.0), width)]
+  frames += [(f'preview-{idx+1}', round(duration * fraction, 1), min(PREVIEW_WIDTH, width)) for idx, fraction in enumerate(VIDEO_PREVIEW_OFFSETS) if duration]
+
+  def _extract(name, offset, frame_width):
+    key = f'video/{url_hash}/{name}.jpg'
+    try:
+      thumbnail_cache.put(key, video_frame(url, offset, frame_width), content_type='image/jpeg')
+    except ffmpeg.Error as e:
+      logger.warning(f'video_derivatives: url={url} offset={offset} failed: {e.stderr.decode("utf-8", "ignore")[-500:] if e.stderr else e}')
+      return None
+    return {'key': key, 'offset': offset, 'width': frame_width, 'height': round(height * frame_width / width) if height else None}
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(frames)) as executor:
+    results = list(executor.map(lambda frame: _extract(*frame), frames))
+  derivatives = {'poster': results[0], 'previews': [result for result in results[1:] if result]}
+  logger.debug(f'video_derivatives: url={url} frames={len(frames)} elapsed={round(now()-start,3)}')
+  return derivatives
+
+def pyramid_exists(url_hash):
   dest = f'{url_hash}.tif'
-  _exists = exists(dest)
-  logger.debug(f'convert: url_hash={url_hash} exists={_exists} refresh={refresh} quality={quality} elapsed={round(now()-start,3)}')
-  if _exists and not refresh:
-    return
+  return os.path.exists(os.path.join(LOCAL_IMAGE_DIR, dest)) if LOCAL_IMAGE_DIR else exists(dest)
 
-  try:
-    img = pyvips.Image.new_from_file(f'/tmp/{url_hash}')
+def tile_buffer(url_hash, data, quality=50):
+  """Tiled pyramid TIFF of an image held in memory, returning (pyramid Source, width, height, num_levels)"""
+  img = pyvips.Image.new_from_buffer(data, '')
+  with memory.admit(decoded_bytes(img.width, img.height, img.bands, TILE_MEMORY_FACTOR), label=f'tile/{url_hash[:12]}'):
+    pyramid = img.tiffsave_buffer(
+      tile=True,
+      compression='jpeg',
+      pyramid=True, 
+      Q=quality,
+      tile_width=TILE_SIZE,
+      tile_height=TILE_SIZE
+    )
+  written = pyvips.Image.new_from_buffer(pyramid, '')
+  num_levels = written.get('n-pages') if written.get_typeof('n-pages') else 1
+  return Source(data=pyramid), img.width, img.height, num_levels
+
+def tile(url_hash, source, session, quality=50):
+  """Writes the tiled pyramid TIFF of a downloaded Source, in memory or to scratch like the source, returning (pyramid Source, width, height, num_levels)"""
+  if source.in_memory:
+    return tile_buffer(url_hash, source.data, quality)
+  path = source.path
+  img = pyvips.Image.new_from_file(path)
+  # JPEG tiles at Q50 plus the smaller levels typically come to well under a byte per pixel
+  dest_path = session.path(f'{url_hash}.tif', img.width * img.height * img.bands // 4)
+  with memory.admit(decoded_bytes(img.width, img.height, img.bands, TILE_MEMORY_FACTOR), label=f'tile/{url_hash[:12]}'):
     img.tiffsave(
-      f'/tmp/{dest}',
+      dest_path,
       tile=True,
       compression='jpeg',
       pyramid=True, 
       Q=quality,
-      tile_width=512,
-      tile_height=512
+      tile_width=TILE_SIZE,
+      tile_height=TILE_SIZE
     )
-    save_to_s3(dest)
-    os.remove(f'/tmp/{dest}')
-  except Exception as e:
-    logger.error(f'convert: url_hash={url_hash} error={e}')
+  pyramid = pyvips.Image.new_from_file(dest_path)
+  num_levels = pyramid.get('n-pages') if pyramid.get_typeof('n-pages') else 1
+  return Source(path=dest_path), img.width, img.height, num_levels
+
+def publish(url_hash, tiled, session):
+  """Uploads a pyramid written by tile, frees its scratch space and saves its info.json"""
+  pyramid, width, height, num_levels = tiled
+  save_to_s3(pyramid, f'{url_hash}.tif')
+  image_server.invalidate(url_hash)
+  pyramid.release(session)
+  return save_iiif_info(url_hash, width, height, num_levels)
+
+def pyramid_levels(width, height, tile_size=TILE_SIZE):
+  """Number of levels vips writes for a tiled pyramid, see image_server.pyramid_sizes"""
+  return len(image_server.pyramid_sizes(width, height, tile_size))
+
+def save_iiif_info(url_hash, width, height, num_levels, sizes=None):
+  info = image_server.info_json(f'BASEURL ADDED BY ENDPOINT HANDLER/{url_hash}', width, height, num_levels, TILE_SIZE, sizes)
+  s3.put_object(Bucket='juncture-image-info', Key=f'{url_hash}.info.json', Body=json.dumps(info, indent=2), ContentType='application/json')
+  return info
+
+def iiif_info(url_hash, width, height, refresh=False):
+  """The IIIF info.json generated at ingest, rebuilt from the image dimensions if it was never written"""
+  s3_key = f'{url_hash}.info.json'
+  if not refresh and exists(s3_key, bucket='juncture-image-info'):
+    return json.loads(s3.get_object(Bucket='juncture-image-info', Key=s3_key)['Body'].read())
+  return save_iiif_info(url_hash, width, height, pyramid_levels(width, height))
+
+def save_to_s3(source, key):
+  """Saves a Source to the images bucket (or LOCAL_IMAGE_DIR)"""
+  if LOCAL_IMAGE_DIR:
+    logger.debug(f'save_to_s3: dir={LOCAL_IMAGE_DIR} key={key}')
+    if source.in_memory:
+      with open(os.path.join(LOCAL_IMAGE_DIR, key), 'wb') as fp:
+        fp.write(source.data)
+    else:
+      shutil.copy(source.path, os.path.join(LOCAL_IMAGE_DIR, key))
+    return
+  logger.debug(f'save_to_s3: bucket={BUCKET_NAME} key={key}')
+  if source.in_memory:
+    s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=source.data, ContentType='image/tiff')
+  else:
+    s3.upload_file(source.path, BUCKET_NAME, key)
+
+def iiif_service_info(url, probe=False):
+  """
+  info.json of the IIIF Image service a source URL belongs to, else None.  info.json and image
+  request URLs are recognized from their form; a bare service id is only tried when probe is set
+  (an 'iiif' hint in the request), as most extensionless URLs are not services.
+  """
+  if url.endswith('/info.json'):
+    info_url = url
+  elif IIIF_IMAGE_REQUEST.match(url):
+    info_url = f'{IIIF_IMAGE_REQUEST.match(url)["service"]}/info.json'
+  elif probe:
+    info_url = f'{url.rstrip("/")}/info.json'
+  else:
+    return None
+  status = None
+  try:
+    resp = requests.get(info_url, headers=REQUEST_HEADERS, timeout=10)
+    status = resp.status_code
+    info = resp.json() if resp.status_code == 200 else {}
+  except (requests.RequestException, ValueError):
+    info = {}
+  logger.debug(f'iiif_service_info: url={info_url} status={status}')
+  return info if info.get('width') and info.get('height') and (info.get('id') or info.get('@id')) else None
+
+def external_image_info(info):
+  """image_info for an image served by an existing IIIF Image service, referencing the service rather than a local pyramid"""
+  service_id = (info.get('id') or info.get('@id')).rstrip('/')
+  v3 = info.get('type') == 'ImageService3' or 'image/3' in json.dumps(info.get('@context', ''))
+  profile = info.get('profile', 'level0')
+  profile = next((p for p in profile if isinstance(p, str)), 'level0') if isinstance(profile, list) else profile
+  profile = re.sub(r'^.*/(level\d)\.json$', r'\1', profile)
+  service = {'id': service_id, 'type': 'ImageService3', 'profile': profile} if v3 else {'@id': service_id, '@type': 'ImageService2', 'profile': profile}
+  for fld in ('width', 'height', 'sizes', 'tiles'):
+    if fld in info:
+      service[fld] = info[fld]
+  return {
+    'type': 'Image',
+    'format': 'image/jpeg',
+    'width': info['width'],
+    'height': info['height'],
+    'url': f'{service_id}/full/{"max" if v3 else "full"}/0/default.jpg',
+    'service': service
+  }
+
+def commons_image_info(url, title=None):
+  """Image type, format, size and dimensions of a Wikimedia Commons original (url, or file title) from the Commons API, else None"""
+  if title is None:
+    if not url.startswith('https://upload.wikimedia.org/wikipedia/commons/') or '/thumb/' in url:
+      return None
+    title = url.split('/')[-1]
+  imageinfo = wc.get_imageinfo(title)
+  if not imageinfo or not imageinfo.get('width') or not imageinfo.get('mime', '').startswith('image/'):
+    return None
+  return {
+    'type': 'Image',
+    'format': imageinfo['mime'],
+    'width': imageinfo['width'],
+    'height': imageinfo['height'],
+    'size': imageinfo.get('size'),
+    'url': url
+  }
+
+def source_max_dimension(manifestid, max_dimension=None):
+  """Rendition size policy for a Commons-backed manifest, max_dimension (a per-use override) taking precedence"""
+  if max_dimension is not None:
+    return int(max_dimension)
+  prefixes = sorted([prefix for prefix in WC_SOURCE_MAX_DIMENSIONS if (manifestid or '').startswith(prefix)], key=len)
+  return int(WC_SOURCE_MAX_DIMENSIONS[prefixes[-1]]) if prefixes else WC_SOURCE_MAX_DIMENSION
 
-def save_to_s3(url_hash):
-  logger.debug(f'save_to_s3: bucket={BUCKET_NAME} url_hash={url_hash}')
-  s3.upload_file(f'/tmp/{url_hash}', BUCKET_NAME, url_hash)
+def prefetch_wc(titles):
+  """Fetches the imageinfo, MediaInfo entities and rendition URLs of many Commons files in batches, ahead of generating their manifests"""
+  wc.prefetch_metadata(titles)
+  wc.prefetch_renditions(dict([(title, source_max_dimension(f'wc:{title}')) for title in titles]))
+
+def _progress(kwargs, stage):
+  """Reports a pipeline stage to the caller's progress callback, if any (see jobs.py)"""
+  if kwargs.get('progress'):
+    kwargs['progress'](stage)
+
+def image_stages(pipeline, session, **kwargs):
+  """
+  Adds the stages that produce a source's image info to pipeline, returning the name of the
+  final stage.  The pyramid is tiled and uploaded while the image info (EXIF, checksum) is read
+  from the same download.
+  """
+  mode = RefreshMode.parse(kwargs.get('refresh'))
+  refresh = bool(mode and mode.image)
+  url = kwargs['url']
+  url_hash = sha256(url.encode('utf-8')).hexdigest()
+  extension = url.split('.')[-1].lower()
+
+  def _cached():
+    _media_info = json.loads(s3.get_object(Bucket='juncture-image-info', Key=f'{url_hash}.json')['Body'].read()) if not refresh and exists(f'{url_hash}.json', bucket='juncture-image-info') else {}
+    if _media_info and mode == RefreshMode.DERIVATIVES and _media_info.get('type') == 'Video':
+      _progress(kwargs, 'derivatives')
+      _media_info['derivatives'] = video_derivatives(url, url_hash, _media_info)
+      s3.put_object(Bucket='juncture-image-info', Key=f'{url_hash}.json', Body=json.dumps(_media_info, indent=2))
+    return _media_info
+  pipeline.add('cached-info', _cached)
+
+  if extension in AV_MIME_TYPES:
+    def _probe(cached):
+      if cached:
+        return cached
+      _progress(kwargs, 'probe')
+      _media_info = media_info(url, url_hash)
+      if _media_info.get('type') == 'Video':
+        _progress(kwargs, 'derivatives')
+        _media_info['derivatives'] = video_derivatives(url, url_hash, _media_info)
+      if _media_info:
+        s3.put_object(Bucket='juncture-image-info', Key=f'{url_hash}.json', Body=json.dumps(_media_info, indent=2))
+      return _media_info
+    pipeline.add('media-info', _probe, ['cached-info'])
+    sources = ['media-info']
+
+  else:
+    # existing tiled IIIF services are referenced as-is, anything else is downloaded and converted
+    def _service(cached):
+      return None if cached else iiif_service_info(url, probe=bool(kwargs.get('iiif')))
+
+    def _download(cached, service):
+      if cached or (service and service.get('tiles')):
+        return None
+      _progress(kwargs, 'download')
+      return download(external_image_info(service)['url'] if service else kwargs.get('download_url') or url, url_hash, session)
+
+    def _tile(source):
+      if not source or (pyramid_exists(url_hash) and not refresh):
+        return None
+      _progress(kwargs, 'convert')
+      try:
+        return tile(url_hash, source, session, kwargs.get('quality') or 50)
+      except ScratchSpaceExceeded:
+        raise
+      except Exception as e:
+        logger.error(f'convert: url_hash={url_hash} error={e}')
+
+    def _publish(tiled):
+      if tiled:
+        try:
+          publish(url_hash, tiled, session)
+        except Exception as e:
+          logger.error(f'convert: url_hash={url_hash} error={e}')
+
+    def _image_info(source):
+      if not source:
+        return {}
+      _progress(kwargs, 'image-info')
+      return image_info(url_hash, source, refresh)
+
+    def _resolve(cached, service, info, _):
+      if cached:
+        return cached
+      if service and service.get('tiles'):
+        info = external_image_info(service)
+        s3.put_object(Bucket='juncture-image-info', Key=f'{url_hash}.json', Body=json.dumps(info, indent=2))
+      return info
+
+    pipeline.add('iiif-service', _service, ['cached-info'])
+    pipeline.add('download', _download, ['cached-info', 'iiif-service'])
+    pipeline.add('tile', _tile, ['download'], pool='cpu')
+    pipeline.add('publish', _publish, ['tile'])
+    pipeline.add('image-info', _image_info, ['download'], pool='cpu')
+    pipeline.add('media-info', _resolve, ['cached-info', 'iiif-service', 'image-info', 'publish'])
+    sources = ['media-info', 'publish']
+
+  def _image_data(_media_info, *_):
+    # info.json is read (or rebuilt) only once the pyramid has been published
+    if _media_info.get('type') == 'Image' and _media_info.get('width') and 'service' not in _media_info:
+      _iiif_info = iiif_info(url_hash, _media_info['width'], _media_info['height'], bool(mode and mode.derivatives))
+      _media_info['iiif'] = dict([(fld, _iiif_info[fld]) for fld in ('width', 'height', 'sizes', 'tiles') if fld in _iiif_info])
+    if 'service' not in _media_info:
+      # url is only the identity (the imageid is its hash) and may not be fetchable, see wc.identity_url
+      _media_info['url'] = kwargs.get('download_url') or fetch_url(url)
+    return _media_info
+  return pipeline.add('image-data', _image_data, sources)
+
+def _raise_scratch_errors(pipeline):
+  """Scratch space exhaustion is reported to the caller (as a 503) rather than treated as a failed source"""
+  for error in pipeline.errors.values():
+    if isinstance(error, ScratchSpaceExceeded):
+      raise error
 
 def get_image_data(**kwargs):
   start = now()
-  refresh = kwargs.get('refresh', False)
   url = kwargs['url']
   url_hash = sha256(url.encode('utf-8')).hexdigest()
-  
-  extension = url.split('.')[-1].lower()
-  _media_info = json.loads(s3.get_object(Bucket='juncture-image-info', Key=f'{url_hash}.json')['Body'].read()) if not refresh and exists(f'{url_hash}.json') else {}
-  if not _media_info:
-    path = download(url, url_hash)
-    if path:
-      _type = 'av' if extension in ('mp3', 'mp4', 'webm', 'oga', 'ogg', 'ogv') else 'image'
-      if _type == 'av':
-        _media_info = media_info(path)
-      else:
-        convert(url_hash, **kwargs)
-        _media_info = image_info(url_hash, refresh)
-        os.remove(f'/tmp/{url_hash}')
-  _media_info['url'] = url
+  with scratch.session(url_hash[:12]) as session:
+    pipeline = stages.Pipeline(f'image-data:{url_hash[:12]}')
+    final = image_stages(pipeline, session, **kwargs)
+    pipeline.run()
+  _raise_scratch_errors(pipeline)
   logger.debug(f'get_image_data: url={url} elapsed={round(now()-start,3)}')
+  return pipeline.result(final)
+
+def provisional_image_data(**kwargs):
+  """
+  Image type, format and dimensions read from the first bytes of the source (JPEG, PNG, GIF and
+  most TIFF headers fit), for a manifest that can be served before the pyramid exists.  Returns
+  None when the header does not yield dimensions.
+  """
+  start = now()
+  url = kwargs['url']
+  _iiif_service = iiif_service_info(url, probe=bool(kwargs.get('iiif')))
+  if _iiif_service and _iiif_service.get('tiles'):
+    return get_image_data(**kwargs) # no conversion needed, so nothing to be provisional about
+  manifestid = kwargs.get('manifestid') or ''
+  # wc: SVG and TIFF identity URLs are not fetchable (see wc.identity_url), so Commons files are looked up by title
+  _media_info = commons_image_info(url, manifestid[3:] if manifestid.startswith('wc:') else None)
+  source = kwargs.get('download_url') or fetch_url(url)
+  if _media_info:
+    logger.debug(f'provisional_image_data: url={url} source=commons elapsed={round(now()-start,3)}')
+    width, height = _media_info['width'], _media_info['height']
+    rendition = re.search(r'/(\d+)px-[^/]+$', source) if '/thumb/' in source else None
+    if rendition:
+      # a Commons rendition is scaled to its width
+      width, height = int(rendition.group(1)), max(1, round(height * int(rendition.group(1)) / width))
+    return {**_media_info, 'url': source, 'width': width, 'height': height, 'format': mimetypes.guess_type(source)[0] or _media_info['format'], 'provisional': True}
+  size, _, head = _remote_head(source, nbytes=PROVISIONAL_HEAD_BYTES)
+  try:
+    img = Image.open(io.BytesIO(head))
+    _media_info = {
+      'type': 'Image',
+      'format': Image.MIME[img.format],
+      'width': img.width,
+      'height': img.height,
+      'size': size or len(head),
+      'url': source,
+      'provisional': True
+    }
+  except Exception as e:
+    logger.debug(f'provisional_image_data: url={url} header unreadable: {e}')
+    _media_info = None
+  logger.debug(f'provisional_image_data: url={url} elapsed={round(now()-start,3)}')
   return _media_info
 
+def is_provisional(manifest):
+  """True for manifests whose image has no IIIF image service yet (see provisional_image_data)"""
+  body = manifest['items'][0]['items'][0]['items'][0]['body']
+  return body.get('type') == 'Image' and 'service' not in body
+
+def _nav_place(location, url_hash, lang, baseurl):
+  nav_place = {
+    'id' : f'{baseurl}/{url_hash}/iiif/feature-collection/2',
+    'type' : 'FeatureCollection',
+    'features':[{
+      'id': f'{baseurl}/{url_hash}/iiif/feature/2',
+      'type': 'Feature',
+      'geometry': {
+        'type': 'Point',
+        'coordinates': location['coords']
+      }
+    }]
+  }
+  if location.get('label'): 
+    nav_place['features'][0]['properties'] = {
+      'label': { lang: [ location['label'] ] },
+      'description': { lang: [ location['description'] ] },
+      'id': { lang: [ location['id'] ] }
+    }
+  return nav_place
+
 def make_manifest(manifestid, url_hash, image_info, image_metadata, baseurl='https://iiif.juncture.io'):
   manifestid = manifestid or url_hash
   lang = image_metadata.get('language', 'none')
@@ -303,16 +792,39 @@ def make_manifest(manifestid, url_hash, image_info, image_metadata, baseurl='htt
     canvas['height'] = image_info['height']
     annotation_body['width'] = image_info['width']
     annotation_body['height'] = image_info['height']
-  if _type == 'image':
+  if _type == 'image' and image_info.get('provisional'):
+    manifest['thumbnail'] = [{
+      'id': image_info['url'],
+      'type': 'Image',
+      'format': image_info.get('format', '')
+    }]
+  elif _type == 'image' and image_info.get('service'):
+    service_id = image_info['service'].get('id') or image_info['service'].get('@id')
+    annotation_body['service'] = [image_info['service']]
+    manifest['thumbnail'] = [{
+      'id': f'{service_id}/full/400,/0/default.jpg',
+      'type': 'Image',
+      'format': 'image/jpeg'
+    }]
+  elif _type == 'image':
     annotation_body['service'] = [{
       'id': f'BASEURL ADDED BY ENDPOINT HANDLER/{url_hash}',
       'profile': 'level2',
-      'type': 'ImageService3'
+      'type': 'ImageService3',
+      **image_info.get('iiif', {}) # embedded info.json fields so viewers can skip the info.json request
     }]
     manifest['thumbnail'] = [{
       'id': f'BASEURL ADDED BY ENDPOINT HANDLER/{url_hash}',
       'type': 'Image'
     }]
+  if _type == 'video' and image_info.get('derivatives', {}).get('poster'):
+    def _still(derivative):
+      still = {'id': f'{baseurl}/derivative/{derivative["key"]}', 'type': 'Image', 'format': 'image/jpeg', 'width': derivative['width']}
+      if derivative.get('height'): still['height'] = derivative['height']
+      return still
+    manifest['thumbnail'] = [_still(image_info['derivatives']['poster'])]
+    if image_info['derivatives'].get('previews'):
+      canvas['thumbnail'] = [_still(preview) for preview in image_info['derivatives']['previews']]
   
   if 'summary' in image_metadata: manifest['summary'] = { lang: [ image_metadata['summary'] ] }
   if 'rights' in image_metadata: manifest['rights'] = image_metadata['rights']
@@ -320,25 +832,7 @@ def make_manifest(manifestid, url_hash, image_info, image_metadata, baseurl='htt
   if 'metadata' in image_metadata: manifest['metadata'] = image_metadata['metadata']
   if 'created' in image_metadata or 'created' in image_info: manifest['navDate'] = image_metadata.get('created', image_info.get('created'))
   if 'location' in image_metadata or 'location' in image_info:
-    location = image_metadata.get('location', image_info.get('location'))
-    manifest['navPlace'] = {
-      'id' : f'{baseurl}/{url_hash}/iiif/feature-collection/2',
-      'type' : 'FeatureCollection',
-      'features':[{
-        'id': f'{baseurl}/{url_hash}/iiif/feature/2',
-        'type': 'Feature',
-        'geometry': {
-          'type': 'Point',
-          'coordinates': location['coords']
-        }
-      }]
-    }
-    if location.get('label'): 
-      manifest['navPlace']['features'][0]['properties'] = {
-        'label': { lang: [ location['label'] ] },
-        'description': { lang: [ location['description'] ] },
-        'id': { lang: [ location['id'] ] }
-      }
+    manifest['navPlace'] = _nav_place(image_metadata.get('location', image_info.get('location')), url_hash, lang, baseurl)
 
   existing_metadata_keys = [m['label'][lang][0] for m in manifest['metadata']]
   for key in ('camera', 'exposure', 'mode', 'orientation'):   
@@ -389,7 +883,90 @@ def metadata_from_obj(**kwargs):
   logger.debug(json.dumps(metadata, indent=2))
   return metadata
 
+def load_metadata(url_hash, with_enriched=False):
+  """
+  The metadata half of a manifest, as returned by its metadata function, or None.  With
+  with_enriched, (metadata, enriched) where enriched is whether the Wikidata enrichment is in it.
+  """
+  key = f'metadata/{url_hash}.json'
+  metadata, enriched = None, False
+  if exists(key, bucket=METADATA_BUCKET):
+    obj = s3.get_object(Bucket=METADATA_BUCKET, Key=key)
+    metadata, enriched = json.loads(obj['Body'].read()), obj.get('Metadata', {}).get('enriched') == 'true'
+  return (metadata, enriched) if with_enriched else metadata
+
+def save_metadata(url_hash, metadata, enriched=False):
+  s3.put_object(Bucket=METADATA_BUCKET, Key=f'metadata/{url_hash}.json', Body=json.dumps(metadata, indent=2), Metadata={'enriched': 'true' if enriched else 'false'})
+
+def get_metadata(metadata_fn, url_hash, **kwargs):
+  """
+  Cached metadata half unless refreshing metadata; metadata built from the request payload itself
+  is never cached.  With enrich, a cached half without the enrichment has it applied and saved.
+  """
+  if metadata_fn == metadata_from_obj:
+    return metadata_fn(**kwargs)
+  mode = RefreshMode.parse(kwargs.get('refresh'))
+  manifestid = kwargs.get('manifestid')
+  metadata, enriched = load_metadata(url_hash, with_enriched=True) if not (mode and mode.metadata) else (None, False)
+  if metadata is None:
+    _progress(kwargs, 'metadata')
+    metadata = metadata_fn(**kwargs)
+    if metadata:
+      save_metadata(url_hash, metadata, enriched=bool(kwargs.get('enrich')))
+  elif kwargs.get('enrich') and not enriched and enrichable(manifestid):
+    _progress(kwargs, 'enrich')
+    metadata = wc.apply_enrichment(metadata, get_enrichment(manifestid))
+    save_metadata(url_hash, metadata, enriched=True)
+  return metadata
+
+def enrichable(manifestid):
+  """True for sources whose metadata has a deferred Wikidata enrichment phase (see enrich_manifest)"""
+  return bool(manifestid) and manifestid.startswith(('wc:', 'wd:'))
+
+def get_enrichment(manifestid):
+  """Wikidata enrichment of a wc: or wd: source, see wc.get_enrichment"""
+  if manifestid.startswith('wc:'):
+    return wc.get_enrichment(manifestid[3:])
+  return wc.get_enrichment(wd.manifestid_to_url(manifestid).split('/')[-1])
+
+def enrich_manifest(manifest, manifestid, url_hash, baseurl='https://iiif.juncture.io'):
+  """Patches a manifest built from core metadata with the source's Wikidata enrichment"""
+  start = now()
+  if not enrichable(manifestid):
+    return manifest
+  enrichment = get_enrichment(manifestid)
+  lang = next(iter(manifest['label'])) if manifest.get('label') else 'none'
+  manifest['metadata'] = wc.apply_enrichment({'metadata': manifest.get('metadata', [])}, enrichment)['metadata']
+  metadata = load_metadata(url_hash)
+  if metadata:
+    save_metadata(url_hash, wc.apply_enrichment(metadata, enrichment), enriched=True)
+  if 'navPlace' not in manifest and enrichment.get('location'):
+    manifest['navPlace'] = _nav_place(enrichment['location'], url_hash, lang, baseurl)
+  logger.debug(f'enrich_manifest: manifestid={manifestid} elapsed={round(now()-start,3)}')
+  return manifest
+
+def manifestid_to_url(manifestid):
+  """(manifestid, source url) for a gh:, wc:, wd:, default: or http id, the manifestid normalized as generate expects it"""
+  logger.debug(f'manifestid_to_url: manifestid={manifestid}')
+  if manifestid.startswith('gh:'):
+    return manifestid, gh.manifestid_to_url(manifestid)
+  elif manifestid.startswith('wc:') or manifestid.startswith('https://upload.wikimedia.org/wikipedia/commons'):
+    if manifestid.startswith('http'):
+      manifestid = f'wc:{manifestid.split("/")[-1]}'
+    return manifestid, wc.manifestid_to_url(manifestid)
+  elif manifestid.startswith('wd:'):
+    return manifestid, wd.manifestid_to_url(manifestid)
+  elif manifestid.startswith('default:'):
+    return manifestid[8:], manifestid[8:]
+  elif manifestid.startswith('http'):
+    return manifestid, manifestid
+
 def generate(**kwargs):
+  """Builds a manifest; upstream fetches repeated within the build are made once (see memo.py)"""
+  with memo.request_scope(kwargs.get('manifestid') or kwargs.get('url')):
+    return _generate(**kwargs)
+
+def _generate(**kwargs):
   start = now()
   metadata_fn = metadata_from_obj
 
@@ -411,26 +988,43 @@ def generate(**kwargs):
       url = wd.manifestid_to_url(manifestid)
       metadata_fn = wd.get_iiif_metadata
 
+    if manifestid.startswith(('wc:', 'wd:')) and url:
+      # url stays the manifest's identity, the rendition is only what gets downloaded and converted
+      title = manifestid[3:] if manifestid.startswith('wc:') else url.split('/')[-1]
+      kwargs['download_url'] = wc.rendition_url(title, source_max_dimension(manifestid, kwargs.get('max_dimension')))
+
   if metadata_fn:
     url_hash = sha256(url.encode('utf-8')).hexdigest()
     kwargs['url'] = url
 
-    manifest_data = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-      futures = {
-        executor.submit(metadata_fn, **kwargs): 'metadata',
-        executor.submit(get_image_data, **kwargs): 'image-info'
-      }
-      
-      for future in concurrent.futures.as_completed(futures):
-        try:
-          manifest_data[futures[future]] = future.result()
-        except Exception as exc:
-          logger.error(traceback.format_exc())
+    # progressive: until the image has been ingested, serve a manifest built from the source header
+    image_data_fn = get_image_data
+    mode = RefreshMode.parse(kwargs.get('refresh'))
+    if kwargs.get('progressive') and url.split('.')[-1].lower() not in AV_MIME_TYPES and ((mode and mode.image) or not exists(f'{url_hash}.json', bucket='juncture-image-info')):
+      image_data_fn = provisional_image_data
+    if mode and mode.derivatives and manifestid:
+      thumbnail_cache.delete_prefix(f'image/{manifestid}/')
+
+    # metadata is fetched while the image is downloaded and converted, see image_stages
+    with scratch.session(url_hash[:12]) as session:
+      pipeline = stages.Pipeline(f'generate:{manifestid or url_hash[:12]}')
+      pipeline.add('metadata', lambda: get_metadata(metadata_fn, url_hash, **kwargs))
+      if image_data_fn == provisional_image_data:
+        image_stage = pipeline.add('image-data', lambda: provisional_image_data(**kwargs))
+      else:
+        image_stage = image_stages(pipeline, session, **kwargs)
+      pipeline.run()
+      logger.debug(f'generate: scratch={json.dumps(scratch.usage())}')
+    _raise_scratch_errors(pipeline)
+    manifest_data = {'metadata': pipeline.result('metadata'), 'image-info': pipeline.result(image_stage)}
+
+    if image_data_fn == provisional_image_data and not manifest_data.get('image-info'):
+      manifest_data['image-info'] = get_image_data(**kwargs)
   
   logger.debug(json.dumps(manifest_data, indent=2))
   
-  if manifest_data['image-info'].get('size') and manifest_data['metadata']:
+  if ((manifest_data.get('image-info') or {}).get('size') or (manifest_data.get('image-info') or {}).get('service')) and manifest_data.get('metadata'):
+    _progress(kwargs, 'manifest')
     manifest = make_manifest(manifestid, url_hash, manifest_data['image-info'], manifest_data['metadata'])
   else:
     manifest = None
@@ -442,6 +1036,6 @@ if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='IIIF Manifest Generator')
   parser.add_argument('url', help='Image URL')
   parser.add_argument('--quality', help='Image quality', type=int, default=50)
-  parser.add_argument('--refresh', default=False, action='store_true', help='Force refresh if exists')
+  parser.add_argument('--refresh', nargs='?', const='all', default=None, choices=[mode.value for mode in RefreshMode], help='Force refresh if exists (metadata, image, derivatives or all)')
 
   logger.debug(json.dumps(generate(**vars(parser.parse_args()))))
\ No newline at end of file
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import concurrent.futures
+import contextvars
+import copy
+import functools
+import threading
+from contextlib import contextmanager
+from time import time as now
+
+# Request-scoped memo for upstream fetches and parses.  Inside a request_scope, calls to a
+# @memoized function with the same arguments share the first call's result (concurrent
+# callers wait for it rather than fetching again).  Each caller gets its own copy, so callers
+# may modify what they get.  A call that raises is not remembered: callers already waiting
+# see the error, later ones call again.  Outside a scope the functions behave as before.
+# Worker threads only see the scope when submitted through in_scope/submit.
+
+_scope = contextvars.ContextVar('fetch_memo', default=None)
+
+class FetchMemo(object):
+
+  def __init__(self, label=''):
+    self.label = label
+    self.calls = 0
+    self.fetches = 0
+    self._results = {}
+    self._lock = threading.Lock()
+
+  def call(self, key, fn, args, kwargs):
+    with self._lock:
+      self.calls += 1
+      future = self._results.get(key)
+      owner = future is None
+      if owner:
+        future = self._results[key] = concurrent.futures.Future()
+        self.fetches += 1
+    if owner:
+      try:
+        future.set_result(fn(*args, **kwargs))
+      except Exception as e:
+        with self._lock:
+          self._results.pop(key, None)
+        future.set_exception(e)
+    return copy.deepcopy(future.result())
+
+  def stats(self):
+    return {'calls': self.calls, 'fetches': self.fetches, 'avoided': self.calls - self.fetches}
+
+@contextmanager
+def request_scope(label=''):
+  """Memoizes @memoized calls until the block exits, then logs how many duplicate calls were avoided"""
+  start = now()
+  memo = FetchMemo(label)
+  token = _scope.set(memo)
+  try:
+    yield memo
+  finally:
+    _scope.reset(token)
+    if memo.calls:
+      logger.info(f'request_scope: label={label} {" ".join([f"{k}={v}" for k, v in memo.stats().items()])} elapsed={round(now()-start,3)}')
+
+def memoized(fn):
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    memo = _scope.get()
+    if memo is None:
+      return fn(*args, **kwargs)
+    return memo.call((fn.__module__, fn.__qualname__, args, tuple(sorted(kwargs.items()))), fn, args, kwargs)
+  return wrapper
+
+def in_scope(fn):
+  """Binds fn to the caller's context, so it shares the request scope when run on another thread"""
+  ctx = contextvars.copy_context()
+  return functools.partial(ctx.run, fn)
+
+def submit(executor, fn, *args, **kwargs):
+  return executor.submit(in_scope(fn), *args, **kwargs)
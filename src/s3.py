@@ -5,9 +5,12 @@ import logging
 logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s')
 logger = logging.getLogger()
 
+import concurrent.futures
 import os
 import sys
 import getopt
+import threading
+from collections import OrderedDict
 
 from expiringdict import ExpiringDict
 
@@ -16,18 +19,27 @@ from botocore.exceptions import ClientError
 
 DEFAULT_BUCKET_NAME = 'juncture-manifests'
 
-class Bucket(object):
-    
-    def __init__(self, bucket=DEFAULT_BUCKET_NAME, **kwargs):
-        self.bucket_name = bucket
-        self._local_cache = ExpiringDict(max_len=100, max_age_seconds=3600) # cache content for 60 minutes
+_s3_client = None
+
+def s3_client():
+    """Returns a process-wide S3 client, created on first use (boto3 clients are thread-safe)"""
+    global _s3_client
+    if _s3_client is None:
         if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
-            self.s3 = boto3.client('s3')
+            _s3_client = boto3.client('s3')
         else:
-            self.s3 = boto3.Session(
+            _s3_client = boto3.Session(
                 aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
                 aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
             ).client('s3')
+    return _s3_client
+
+class Bucket(object):
+    
+    def __init__(self, bucket=DEFAULT_BUCKET_NAME, **kwargs):
+        self.bucket_name = bucket
+        self._local_cache = ExpiringDict(max_len=100, max_age_seconds=3600) # cache content for 60 minutes
+        self.s3 = s3_client()
         self.s3_paginator = self.s3.get_paginator('list_objects_v2')
 
     def __contains__(self, key):
@@ -55,7 +67,19 @@ class Bucket(object):
         except KeyError:
             return default
 
+    def get_many(self, keys, max_workers=16):
+        """Returns {key: content} for the keys that exist, reading the uncached ones with parallel GETs"""
+        found = dict([(key, self._local_cache[key]) for key in keys if key in self._local_cache])
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+                for key, content in zip(missing, executor.map(self.get, missing)):
+                    if content is not None:
+                        found[key] = content
+        return found
+
     def __delitem__(self, key):
+        self._local_cache.pop(key, None)
         return self.s3.delete_object(Bucket=self.bucket_name, Key=key)
 
     def __iter__(self, prefix='/', delimiter='/', start_after=''):
@@ -76,6 +100,158 @@ class Bucket(object):
     def dir(self, prefix=None):
         return self.keys(prefix)
 
+class ByteLRU(object):
+    """Thread-safe LRU of (bytes, content_type) values bounded by total body size"""
+
+    def __init__(self, max_bytes=64*1024*1024, max_item_bytes=2*1024*1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_item_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._bytes -= len(self._items.pop(key)[0])
+            self._items[key] = (body, content_type)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes and self._items:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._items:
+                self._bytes -= len(self._items.pop(key)[0])
+
+    def pop_prefix(self, prefix):
+        """Drops every item whose key starts with prefix, returning how many were dropped"""
+        with self._lock:
+            keys = [key for key in self._items if key.startswith(prefix)]
+            for key in keys:
+                self._bytes -= len(self._items.pop(key)[0])
+        return len(keys)
+
+    def stats(self):
+        return {'items': len(self._items), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+class DerivativeCache(object):
+    """
+    Read-through cache for image derivatives (thumbnails, transformed images) stored in S3.
+
+    A lookup is a single GET; NoSuchKey is treated as a miss.  Hot derivatives are kept in an
+    in-process LRU bounded by total bytes, and an existence index remembers recent hits and
+    misses so repeated lookups for missing keys do not go to S3 at all.  Bodies that are not
+    in the LRU are streamed from S3 in chunks rather than read fully into memory.
+    """
+
+    def __init__(self, bucket='juncture-thumbnail-cache', max_bytes=64*1024*1024, max_item_bytes=2*1024*1024,
+                 cache_control='max-age=86400', **kwargs):
+        self.bucket_name = bucket
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.cache_control = cache_control
+        self.s3 = s3_client()
+        self._lru = ByteLRU(max_bytes=max_bytes, max_item_bytes=max_item_bytes)
+        self._exists = ExpiringDict(max_len=10000, max_age_seconds=3600)
+        self._missing = ExpiringDict(max_len=10000, max_age_seconds=60) # short TTL, other instances may write the key
+
+    def __contains__(self, key):
+        if key in self._lru or key in self._exists:
+            return True
+        if key in self._missing:
+            return False
+        try:
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+            self._exists[key] = True
+            return True
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                self._missing[key] = True
+                return False
+            raise
+
+    def lookup(self, key, chunk_size=64*1024):
+        """
+        Returns (body, content_type, origin) for a cached derivative or (None, None, None) on a miss.
+        body is bytes for in-process hits and an iterator of byte chunks for S3 hits.
+        """
+        hit = self._lru.get(key)
+        if hit:
+            logger.debug(f'DerivativeCache.lookup: key={key} origin=memory')
+            return hit[0], hit[1], 'memory'
+        if key in self._missing:
+            logger.debug(f'DerivativeCache.lookup: key={key} origin=negative-index')
+            return None, None, None
+        try:
+            resp = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+                self._missing[key] = True
+                logger.debug(f'DerivativeCache.lookup: key={key} origin=miss')
+                return None, None, None
+            raise
+        self._exists[key] = True
+        content_type = resp.get('ContentType', 'application/octet-stream')
+        logger.debug(f'DerivativeCache.lookup: key={key} origin=s3 size={resp.get("ContentLength")}')
+        return self._iter_body(key, resp, content_type, chunk_size), content_type, 's3'
+
+    def _iter_body(self, key, resp, content_type, chunk_size):
+        cacheable = (resp.get('ContentLength') or self.max_item_bytes + 1) <= self.max_item_bytes
+        chunks = []
+        try:
+            for chunk in resp['Body'].iter_chunks(chunk_size=chunk_size):
+                if cacheable:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            resp['Body'].close()
+        if cacheable:
+            self._lru.put(key, b''.join(chunks), content_type)
+
+    def put(self, key, body, content_type='application/octet-stream'):
+        logger.debug(f'DerivativeCache.put: bucket={self.bucket_name} key={key} size={len(body)}')
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=body, ContentType=content_type, CacheControl=self.cache_control)
+        self._exists[key] = True
+        self._missing.pop(key, None)
+        self._lru.put(key, body, content_type)
+
+    def __delitem__(self, key):
+        self.forget(key)
+        return self.s3.delete_object(Bucket=self.bucket_name, Key=key)
+
+    def delete_prefix(self, prefix):
+        """Deletes every derivative whose key starts with prefix, returning how many were deleted"""
+        deleted = 0
+        for page in self.s3.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix):
+            keys = [content['Key'] for content in page.get('Contents', ())]
+            if keys:
+                self.s3.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+                for key in keys:
+                    self.forget(key)
+                deleted += len(keys)
+        logger.debug(f'DerivativeCache.delete_prefix: bucket={self.bucket_name} prefix={prefix} deleted={deleted}')
+        return deleted
+
+    def forget(self, key):
+        """Drops a key from the in-process LRU and existence index without touching S3"""
+        self._lru.pop(key)
+        self._exists.pop(key, None)
+        self._missing.pop(key, None)
+
 def usage():
     print('%s [hl:b:edup:] [keys]' % sys.argv[0])
     print('   -h --help            Print help message')
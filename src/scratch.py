@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import os
+import threading
+import uuid
+from time import time as now
+
+# Ephemeral storage (/tmp on Lambda) shared by all concurrent ingests in a container.  Every
+# temp file is allocated through a ScratchSession, which reserves its estimated size against a
+# global budget and deletes everything it allocated when the session ends, on success or failure.
+
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', '/tmp')
+SCRATCH_BUDGET_MB = int(os.environ.get('SCRATCH_BUDGET_MB', '2048'))
+SCRATCH_WAIT_SECONDS = float(os.environ.get('SCRATCH_WAIT_SECONDS', '60'))
+
+class ScratchSpaceExceeded(Exception):
+  pass
+
+class ScratchSpace(object):
+
+  def __init__(self, root=SCRATCH_DIR, budget=SCRATCH_BUDGET_MB*1024*1024, wait_seconds=SCRATCH_WAIT_SECONDS):
+    self.root = root
+    self.budget = budget
+    self.wait_seconds = wait_seconds
+    self.reserved = 0
+    self.sessions = {}
+    self.rejected = 0
+    self._cond = threading.Condition()
+
+  def reserve(self, nbytes, label=''):
+    """Blocks until nbytes fit within the budget; raises ScratchSpaceExceeded if they never can or the wait times out"""
+    nbytes = max(int(nbytes), 0)
+    if nbytes > self.budget:
+      self.rejected += 1
+      raise ScratchSpaceExceeded(f'{label} needs {nbytes} bytes, scratch budget is {self.budget}')
+    start = now()
+    with self._cond:
+      while self.reserved + nbytes > self.budget:
+        remaining = self.wait_seconds - (now() - start)
+        if remaining <= 0 or not self._cond.wait(timeout=remaining):
+          if self.reserved + nbytes > self.budget:
+            self.rejected += 1
+            raise ScratchSpaceExceeded(f'{label} timed out waiting for {nbytes} bytes of scratch space (reserved={self.reserved} budget={self.budget})')
+      self.reserved += nbytes
+    if now() - start > 1:
+      logger.info(f'scratch.reserve: label={label} bytes={nbytes} waited={round(now()-start,3)}')
+    return nbytes
+
+  def release(self, nbytes):
+    with self._cond:
+      self.reserved = max(self.reserved - nbytes, 0)
+      self._cond.notify_all()
+
+  def session(self, label=''):
+    return ScratchSession(self, label)
+
+  def usage(self):
+    with self._cond:
+      return {
+        'root': self.root,
+        'budget': self.budget,
+        'reserved': self.reserved,
+        'available': self.budget - self.reserved,
+        'sessions': dict([(session_id, session.usage()) for session_id, session in self.sessions.items()]),
+        'rejected': self.rejected
+      }
+
+class ScratchSession(object):
+  """Temp files for one request; use as a context manager so they are always cleaned up"""
+
+  def __init__(self, space, label=''):
+    self.space = space
+    self.label = label
+    self.id = uuid.uuid4().hex[:12]
+    self.files = {} # path -> reserved bytes
+
+  def __enter__(self):
+    with self.space._cond:
+      self.space.sessions[self.id] = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.cleanup()
+    with self.space._cond:
+      self.space.sessions.pop(self.id, None)
+    logger.debug(f'scratch.session: label={self.label} closed error={exc_type.__name__ if exc_type else None} reserved={self.space.reserved}')
+    return False
+
+  def path(self, name, size_estimate=0):
+    """Reserves size_estimate bytes and returns a path for a new temp file"""
+    path = os.path.join(self.space.root, f'{self.id}-{name}')
+    self.space.reserve(size_estimate, label=f'{self.label}/{name}')
+    self.files[path] = self.files.get(path, 0) + int(size_estimate)
+    return path
+
+  def resize(self, path, nbytes):
+    """Adjusts the reservation for path to its actual (or better estimated) size"""
+    delta = int(nbytes) - self.files.get(path, 0)
+    if delta > 0:
+      self.space.reserve(delta, label=f'{self.label}/{os.path.basename(path)}')
+    else:
+      self.space.release(-delta)
+    self.files[path] = int(nbytes)
+
+  def remove(self, path):
+    if os.path.exists(path):
+      os.remove(path)
+    self.space.release(self.files.pop(path, 0))
+
+  def cleanup(self):
+    for path in list(self.files):
+      try:
+        self.remove(path)
+      except OSError as e:
+        logger.warning(f'scratch.cleanup: path={path} error={e}')
+        self.space.release(self.files.pop(path, 0))
+
+  def usage(self):
+    return {'label': self.label, 'files': len(self.files), 'reserved': sum(self.files.values())}
+
+scratch = ScratchSpace()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import concurrent.futures
+import contextvars
+import os
+import threading
+import traceback
+from time import time as now
+
+# A Pipeline is a dependency graph of named stages.  Each stage runs as soon as the stages it
+# depends on have succeeded, on one of two long-lived pools shared by every pipeline in the
+# process: 'io' for network and S3 work, 'cpu' for decoding and tiling.  A global budget bounds
+# how many stages run at once across both pools.  Stages run in the context of the thread that
+# built the pipeline, so they share its memo.request_scope.  A pipeline run from inside a stage
+# runs its stages inline on that thread, so stages never wait on the pools they occupy.  A run
+# that times out is cancelled: stages not yet started never run, and the run only raises once
+# the running ones have finished, so callers can free what the stages use (scratch files).
+
+STAGE_IO_WORKERS = int(os.environ.get('STAGE_IO_WORKERS', '16'))
+STAGE_CPU_WORKERS = int(os.environ.get('STAGE_CPU_WORKERS', str(os.cpu_count() or 2)))
+STAGE_CONCURRENCY = int(os.environ.get('STAGE_CONCURRENCY', '16'))
+STAGE_TIMEOUT_SECONDS = float(os.environ.get('STAGE_TIMEOUT_SECONDS', '900')) # longest a pipeline run waits for its stages
+
+pools = {
+  'io': concurrent.futures.ThreadPoolExecutor(max_workers=STAGE_IO_WORKERS, thread_name_prefix='stage-io'),
+  'cpu': concurrent.futures.ThreadPoolExecutor(max_workers=STAGE_CPU_WORKERS, thread_name_prefix='stage-cpu')
+}
+budget = threading.BoundedSemaphore(STAGE_CONCURRENCY)
+
+_local = threading.local()
+_totals = {} # stage name -> {'runs', 'failures', 'seconds'}
+_totals_lock = threading.Lock()
+
+class StageSkipped(Exception):
+  """Recorded for a stage that did not run because a stage it depends on failed"""
+  pass
+
+class StageCancelled(StageSkipped):
+  """Recorded for a stage that did not run because its pipeline was cancelled"""
+  pass
+
+def _record(name, elapsed, failed):
+  with _totals_lock:
+    totals = _totals.setdefault(name, {'runs': 0, 'failures': 0, 'seconds': 0.0})
+    totals['runs'] += 1
+    totals['failures'] += 1 if failed else 0
+    totals['seconds'] = round(totals['seconds'] + elapsed, 3)
+
+def stats():
+  with _totals_lock:
+    return {
+      'io_workers': STAGE_IO_WORKERS,
+      'cpu_workers': STAGE_CPU_WORKERS,
+      'concurrency': STAGE_CONCURRENCY,
+      'stages': dict([(name, dict(totals)) for name, totals in _totals.items()])
+    }
+
+class Pipeline(object):
+
+  def __init__(self, label=''):
+    self.label = label
+    self.stages = {} # name -> (fn, deps, pool)
+    self.results = {}
+    self.errors = {}
+    self.timings = {}
+    self._started = set()
+    self._finished = set()
+    self._lock = threading.Lock()
+    self._done = threading.Event()
+    self._context = contextvars.copy_context()
+    self._futures = []
+    self._cancelled = threading.Event()
+    self._running = 0 # stages submitted to a pool that have not finished
+    self._drained = threading.Condition()
+
+  def add(self, name, fn, deps=(), pool='io'):
+    """Adds a stage; fn is called with the results of deps, in order, once they have all succeeded"""
+    if pool not in pools:
+      raise ValueError(f'Unknown stage pool: {pool}')
+    self.stages[name] = (fn, tuple(deps), pool)
+    return name
+
+  def result(self, name, default=None):
+    return self.results.get(name, default)
+
+  @property
+  def cancelled(self):
+    """True once the run has been abandoned; long stages may check it and return early"""
+    return self._cancelled.is_set()
+
+  def _schedule(self):
+    """Stages whose dependencies have all finished, marking those with a failed dependency as skipped"""
+    ready = []
+    changed = True
+    while changed:
+      changed = False
+      for name, (_, deps, _) in self.stages.items():
+        if name in self._started or not all(dep in self._finished for dep in deps):
+          continue
+        self._started.add(name)
+        failed = [dep for dep in deps if dep in self.errors]
+        if failed:
+          self.errors[name] = StageSkipped(f'{name}: {failed[0]} failed')
+          self._finished.add(name)
+          changed = True
+        else:
+          ready.append(name)
+    if len(self._finished) == len(self.stages):
+      self._done.set()
+    return ready
+
+  def _execute(self, name, acquire=True):
+    fn, deps, _ = self.stages[name]
+    if self._cancelled.is_set():
+      self.errors[name] = StageCancelled(f'{name}: pipeline {self.label} cancelled')
+      return
+    if acquire:
+      budget.acquire()
+    start = now()
+    nested = getattr(_local, 'in_stage', False)
+    _local.in_stage = True
+    try:
+      self.results[name] = fn(*[self.results[dep] for dep in deps])
+    except Exception as e:
+      self.errors[name] = e
+      if not isinstance(e, StageSkipped):
+        logger.error(f'pipeline: label={self.label} stage={name}\n{traceback.format_exc()}')
+    finally:
+      _local.in_stage = nested
+      if acquire:
+        budget.release()
+    self.timings[name] = round(now() - start, 3)
+    _record(name, self.timings[name], name in self.errors)
+
+  def _run_stage(self, name):
+    try:
+      self._execute(name)
+    finally:
+      with self._lock:
+        self._finished.add(name)
+        ready = self._schedule()
+      for other in ready:
+        self._submit(other)
+      self._stage_done()
+
+  def _stage_done(self):
+    with self._drained:
+      self._running -= 1
+      self._drained.notify_all()
+
+  def _submit(self, name):
+    with self._drained:
+      self._running += 1
+    self._futures.append(pools[self.stages[name][2]].submit(self._context.copy().run, self._run_stage, name))
+
+  def cancel(self):
+    """Stops scheduling stages, drops those queued on the pools and returns once the running ones have finished"""
+    start = now()
+    self._cancelled.set()
+    for future in list(self._futures):
+      if future.cancel():
+        self._stage_done()
+    with self._drained:
+      while self._running:
+        if not self._drained.wait(timeout=60):
+          logger.warning(f'pipeline: label={self.label} cancelled, waiting for {self._running} running stages waited={round(now()-start,3)}')
+
+  def run(self, timeout=STAGE_TIMEOUT_SECONDS):
+    """Runs every stage and returns the results of those that succeeded; failures are in self.errors"""
+    start = now()
+    if getattr(_local, 'in_stage', False):
+      ready = self._schedule()
+      while ready:
+        for name in ready:
+          self._execute(name, acquire=False)
+          self._finished.add(name)
+        ready = self._schedule()
+    else:
+      with self._lock:
+        ready = self._schedule()
+      for name in ready:
+        self._submit(name)
+      if not self._done.wait(timeout):
+        self.cancel()
+        raise concurrent.futures.TimeoutError(f'pipeline {self.label} did not finish in {timeout}s, pending={sorted(set(self.stages) - self._finished)}')
+    logger.debug(f'pipeline: label={self.label} {" ".join([f"{name}={elapsed}" for name, elapsed in self.timings.items()])} elapsed={round(now()-start,3)}')
+    return self.results
@@ -0,0 +1,81 @@
+import hashlib
+import hmac
+import json
+import os
+
+import pytest
+
+pytest.importorskip('boto3')
+pytest.importorskip('requests')
+gh = pytest.importorskip('gh')
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'gh_push.json')
+SECRET = 'webhook-test-secret'
+AFTER = '9a8b7c6d5e4f3a2b1c0d9e8f7a6b5c4d3e2f1a0b'
+
+@pytest.fixture
+def body():
+  with open(FIXTURE, 'rb') as fp:
+    return fp.read()
+
+@pytest.fixture
+def index(monkeypatch):
+  """Repo index at the pushed commit, in place of the git trees API"""
+  entries = [
+    {'name': name, 'path': path, 'type': 'file', 'sha': f'{idx:040x}', 'size': 100}
+    for idx, (path, name) in enumerate([(path, path.split('/')[-1]) for path in (
+      'README.md', 'docs/notes.yaml', 'images/Harbor.PNG', 'images/Harbor.yaml', 'images/Sunset.jpg', 'images/iiif-props.yaml'
+    )])
+  ] + [{'name': name, 'path': name, 'type': 'dir', 'sha': f'{idx:040x}', 'size': 0} for idx, name in enumerate(('docs', 'images'), 100)]
+  repo_index = gh.RepoIndex('jstor-labs', 'media', AFTER, AFTER, 'f' * 40, entries)
+  calls = []
+  def _repo_index(acct, repo, ref=None):
+    calls.append((acct, repo, ref))
+    return repo_index
+  monkeypatch.setattr(gh, 'repo_index', _repo_index)
+  return calls
+
+def _sign(body, secret=SECRET):
+  return 'sha256=' + hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+def test_signature_accepts_signed_body(body):
+  assert gh.verify_signature(body, _sign(body), SECRET)
+
+def test_signature_rejects_tampered_body_wrong_secret_and_missing_header(body):
+  assert not gh.verify_signature(body.replace(b'Sunset', b'Sunrise'), _sign(body), SECRET)
+  assert not gh.verify_signature(body, _sign(body, 'other-secret'), SECRET)
+  assert not gh.verify_signature(body, None, SECRET)
+
+def test_signature_rejects_everything_without_a_secret(body):
+  assert not gh.verify_signature(body, _sign(body, ''), '')
+  assert not gh.verify_signature(body, _sign(body), None)
+
+def test_push_head(body):
+  assert gh.push_head(json.loads(body)) == ('jstor-labs', 'media', 'main', AFTER)
+
+def test_push_targets(body, index):
+  head_shas = dict(gh.head_shas)
+  targets = dict([(target['path'], target) for target in gh.push_targets(json.loads(body))])
+  assert dict(gh.head_shas) == head_shas # recording the pushed head is left to the webhook route
+  assert index == [('jstor-labs', 'media', AFTER)]
+
+  # README.md is not an image and iiif-props.yaml is not a sidecar
+  assert sorted(targets) == ['docs/notes.yaml', 'images/Harbor.PNG', 'images/Old_scan.tif', 'images/Sunset.jpg']
+
+  sunset = targets['images/Sunset.jpg']
+  assert sunset['manifestids'] == ['gh:jstor-labs/media/images/Sunset.jpg', 'gh:jstor-labs/media/main/images/Sunset.jpg']
+  assert sunset['url'] == 'https://raw.githubusercontent.com/jstor-labs/media/main/images/Sunset.jpg'
+  assert sunset['download_url'] == f'https://raw.githubusercontent.com/jstor-labs/media/{AFTER}/images/Sunset.jpg'
+  assert (sunset['image_changed'], sunset['removed']) == (True, False)
+
+  # a sidecar change regenerates the image it describes, keeping its pyramid
+  assert (targets['images/Harbor.PNG']['image_changed'], targets['images/Harbor.PNG']['removed']) == (False, False)
+  assert (targets['images/Old_scan.tif']['image_changed'], targets['images/Old_scan.tif']['removed']) == (True, True)
+  # a YAML file without an image is a manifest of its own
+  assert targets['docs/notes.yaml']['image_changed'] is True
+
+def test_push_targets_ignores_tags_and_deleted_branches(body):
+  payload = json.loads(body)
+  assert gh.push_targets({**payload, 'ref': 'refs/tags/v1.0'}) == []
+  assert gh.push_targets({**payload, 'deleted': True}) == []
+  assert gh.push_head({**payload, 'ref': 'refs/tags/v1.0'}) is None
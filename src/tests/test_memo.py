@@ -0,0 +1,43 @@
+import pytest
+
+import memo
+
+calls = []
+
+@memo.memoized
+def _parse(text):
+  calls.append(text)
+  return {'text': text, 'items': [1, 2]}
+
+attempts = []
+
+@memo.memoized
+def _flaky(key):
+  attempts.append(key)
+  if len(attempts) == 1:
+    raise IOError('transient')
+  return len(attempts)
+
+def test_results_are_shared_but_not_by_reference():
+  del calls[:]
+  with memo.request_scope('test') as scope:
+    first = _parse('a')
+    first['extra'] = True
+    first['items'].append(3)
+    assert _parse('a') == {'text': 'a', 'items': [1, 2]}
+  assert calls == ['a']
+  assert scope.stats() == {'calls': 2, 'fetches': 1, 'avoided': 1}
+
+def test_errors_are_not_memoized():
+  del attempts[:]
+  with memo.request_scope('test'):
+    with pytest.raises(IOError):
+      _flaky('a')
+    assert _flaky('a') == 2
+    assert _flaky('a') == 2
+
+def test_no_scope_calls_through():
+  del calls[:]
+  _parse('b')
+  _parse('b')
+  assert calls == ['b', 'b']
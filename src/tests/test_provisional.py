@@ -0,0 +1,26 @@
+import pytest
+
+for module in ('boto3', 'pyvips', 'PIL', 'magic', 'exif', 'requests'):
+  pytest.importorskip(module)
+manifest = pytest.importorskip('manifest')
+wc = manifest.wc
+
+TITLE = 'Flag_of_Paris.svg'
+
+def _no_fetch(*args, **kwargs):
+  raise AssertionError('provisional data must not fetch or ingest the source')
+
+@pytest.fixture
+def commons(monkeypatch):
+  monkeypatch.setattr(wc, 'get_imageinfo', lambda title: {'width': 900, 'height': 600, 'mime': 'image/svg+xml', 'size': 2048} if title == TITLE else None)
+  monkeypatch.setattr(manifest, 'get_image_data', _no_fetch)
+  monkeypatch.setattr(manifest, '_remote_head', _no_fetch)
+
+def test_wc_svg_is_provisional_without_ingest(commons):
+  download_url = wc.wc_title_to_url(TITLE, width=1280)
+  info = manifest.provisional_image_data(manifestid=f'wc:{TITLE}', url=wc.identity_url(TITLE), download_url=download_url)
+  assert info['provisional'] is True
+  # the rendition that will be ingested, not the historical identity URL
+  assert info['url'] == download_url
+  assert info['format'] == 'image/png'
+  assert (info['width'], info['height']) == (1280, 853)
@@ -0,0 +1,29 @@
+import pytest
+
+pyvips = pytest.importorskip('pyvips')
+pytest.importorskip('boto3')
+image_server = pytest.importorskip('image_server')
+
+# level sizes libvips tiffsave(pyramid=True, tile_width=512) writes
+@pytest.mark.parametrize('width,height,levels', [
+  (512, 512, [(512, 512)]),
+  (1025, 1025, [(1025, 1025), (512, 512)]),
+  (1301, 901, [(1301, 901), (650, 450), (325, 225)]),
+  (2049, 100, [(2049, 100), (1024, 50), (512, 25)]),
+  (5000, 3, [(5000, 3), (2500, 1)])
+])
+def test_pyramid_sizes(width, height, levels):
+  assert image_server.pyramid_sizes(width, height, 512) == levels
+
+def test_info_json_matches_pyramid():
+  info = image_server.info_json('https://example.org/iiif/3/abc', 1301, 901, 3, 512)
+  assert info['sizes'] == [{'width': 325, 'height': 225}, {'width': 650, 'height': 450}, {'width': 1301, 'height': 901}]
+  assert info['tiles'] == [{'width': 512, 'height': 512, 'scaleFactors': [1, 2, 4]}]
+
+@pytest.mark.parametrize('width,height', [(1301, 901), (1025, 1025), (2049, 100), (777, 1283)])
+def test_pyramid_sizes_match_tiffsave(tmp_path, width, height):
+  path = str(tmp_path / 'pyramid.tif')
+  pyvips.Image.black(width, height, bands=3).cast('uchar').tiffsave(path, tile=True, compression='jpeg', pyramid=True, tile_width=512, tile_height=512)
+  pages = pyvips.Image.new_from_file(path).get('n-pages')
+  written = [(level.width, level.height) for level in [pyvips.Image.new_from_file(path, page=page) for page in range(pages)]]
+  assert image_server.pyramid_sizes(width, height, 512) == written
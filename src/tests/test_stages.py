@@ -0,0 +1,40 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+import stages
+
+def test_run_returns_results_and_skips_dependents_of_failures():
+  pipeline = stages.Pipeline('test')
+  pipeline.add('a', lambda: 1)
+  pipeline.add('b', lambda a: a + 1, ['a'])
+  pipeline.add('c', lambda: 1 / 0)
+  pipeline.add('d', lambda c: c, ['c'])
+  results = pipeline.run(timeout=10)
+  assert results == {'a': 1, 'b': 2}
+  assert isinstance(pipeline.errors['c'], ZeroDivisionError)
+  assert isinstance(pipeline.errors['d'], stages.StageSkipped)
+
+def test_timeout_cancels_pending_stages_and_waits_for_running_ones():
+  release = threading.Event()
+  finished, ran = [], []
+  def _slow():
+    release.wait(1)
+    time.sleep(0.2)
+    finished.append('slow')
+  pipeline = stages.Pipeline('test-timeout')
+  pipeline.add('slow', _slow)
+  pipeline.add('next', lambda _: ran.append('next'), ['slow'])
+  timer = threading.Timer(0.2, release.set)
+  timer.start()
+  with pytest.raises(concurrent.futures.TimeoutError):
+    pipeline.run(timeout=0.1)
+  # the running stage finished before run raised, and the stage after it never ran
+  assert finished == ['slow']
+  assert ran == []
+  assert pipeline.cancelled
+  assert isinstance(pipeline.errors['next'], stages.StageCancelled)
+  # no budget slots are left held by the abandoned run
+  assert stages.budget._value == stages.STAGE_CONCURRENCY
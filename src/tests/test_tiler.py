@@ -0,0 +1,44 @@
+import pytest
+
+pyvips = pytest.importorskip('pyvips')
+tiler = pytest.importorskip('tiler')
+from scratch import ScratchSpace
+
+TILE_SIZE = 256
+QUALITY = 50
+
+def _source(path, width, height, bands):
+  """Gradients plus noise, so tiles compress like a photograph rather than a flat fill"""
+  xy = pyvips.Image.xyz(width, height)
+  img = (xy[0] * (255 / width)).bandjoin([xy[1] * (255 / height), (xy[0] + xy[1]) * (127 / (width + height))])
+  img = (img + pyvips.Image.gaussnoise(width, height, sigma=24, mean=0)).cast('uchar')
+  (img if bands == 3 else img[0]).jpegsave(path, Q=90)
+
+@pytest.fixture
+def session(tmp_path):
+  with ScratchSpace(root=str(tmp_path), budget=512 * 1024 * 1024).session('test') as session:
+    yield session
+
+def test_off_by_default(monkeypatch):
+  monkeypatch.setattr(tiler, 'PARALLEL_TILE_MIN_MEGAPIXELS', 0)
+  assert not tiler.eligible(pyvips.Image.black(20000, 20000, bands=3).cast('uchar'))
+
+# odd sizes, so every level has partial edge tiles and odd edges to repeat
+@pytest.mark.parametrize('width,height,bands', [(1301, 901, 3), (777, 1283, 1)])
+def test_parallel_matches_tiffsave(session, width, height, bands):
+  src = session.path('source.jpg')
+  _source(src, width, height, bands)
+
+  single = session.path('single.tif')
+  pyvips.Image.new_from_file(src).tiffsave(single, tile=True, compression='jpeg', pyramid=True, Q=QUALITY, tile_width=TILE_SIZE, tile_height=TILE_SIZE)
+  parallel = session.path('parallel.tif')
+  levels = tiler.tile_parallel(src, parallel, session, QUALITY, TILE_SIZE)
+
+  pages = pyvips.Image.new_from_file(single).get('n-pages')
+  assert pyvips.Image.new_from_file(parallel).get('n-pages') == pages == levels
+  for page in range(pages):
+    a = pyvips.Image.new_from_file(single, page=page)
+    b = pyvips.Image.new_from_file(parallel, page=page)
+    assert (b.width, b.height, b.bands) == (a.width, a.height, a.bands), f'page {page}'
+    # both are JPEG at the same quality from the same pixels; differences are encoder rounding
+    assert (a.cast('float') - b.cast('float')).abs().avg() < 2, f'page {page}'
@@ -0,0 +1,56 @@
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+for module in ('requests', 'bs4', 'expiringdict'):
+  pytest.importorskip(module)
+wc = pytest.importorskip('wc')
+
+class _Response(object):
+
+  def __init__(self, data):
+    self.status_code = 200
+    self._data = data
+
+  def json(self):
+    return self._data
+
+def _imageinfo(title, width, height):
+  return {'title': f'File:{title.replace("_", " ")}', 'imageinfo': [{'width': width, 'height': height, 'mime': 'image/jpeg'}]}
+
+@pytest.fixture
+def commons(monkeypatch):
+  """Commons API stand-in recording the query string of every request"""
+  calls = []
+
+  def get(url, headers=None):
+    params = parse_qs(urlparse(url).query)
+    calls.append(params)
+    if 'cmtitle' in params:
+      return _Response({'query': {'categorymembers': [{'title': f'File:Photo_{idx}.jpg'} for idx in range(120)]}})
+    titles = params['titles'][0].split('|')
+    width = int(params['iiurlwidth'][0])
+    return _Response({'query': {'pages': dict([(str(idx), {'title': title, 'imageinfo': [{'thumburl': f'https://thumbs.example/{width}/{title[5:]}'}]}) for idx, title in enumerate(titles)])}})
+
+  monkeypatch.setattr(wc.requests, 'get', get)
+  for cache in (wc.wc_metadata, wc.renditions, wc.category_members):
+    cache.clear()
+  return calls
+
+def test_renditions_are_fetched_in_batches(commons):
+  titles = [f'Photo_{idx}.jpg' for idx in range(120)] + ['Plan.svg']
+  for title in titles:
+    wc.wc_metadata[title] = _imageinfo(title, 6000, 4000)
+  wc.prefetch_renditions(dict([(title, 1000 if title.endswith('.svg') else 3000) for title in titles]))
+  # 120 photos at the 3840px rendition in 3 requests, the SVG at 1280px in one more
+  assert sorted([len(params['titles'][0].split('|')) for params in commons]) == [1, 20, 50, 50]
+  assert wc.rendition_url('Photo_7.jpg', 3000) == 'https://thumbs.example/3840/Photo_7.jpg'
+  assert wc.rendition_url('Plan.svg', 1000) == 'https://thumbs.example/1280/Plan.svg'
+  assert len(commons) == 4
+
+def test_category_titles_are_cached(commons):
+  titles = wc.category_titles('Photos')
+  assert len(titles) == 120 and wc.category_titles('Category:Photos') == titles
+  assert len(commons) == 1
+  wc.category_titles('Photos', refresh=True)
+  assert len(commons) == 2
@@ -0,0 +1,32 @@
+import io
+import json
+
+import pytest
+
+for module in ('boto3', 'pyvips', 'PIL', 'magic', 'exif', 'requests'):
+  pytest.importorskip(module)
+manifest = pytest.importorskip('manifest')
+wc = manifest.wc
+
+TITLE = 'Flag_of_Paris.svg'
+CACHED_INFO = {'type': 'Image', 'format': 'image/png', 'width': 1280, 'height': 853, 'size': 40960}
+
+class _ImageInfoBucket(object):
+  """juncture-image-info holding the image info of an ingested source"""
+
+  def get_object(self, Bucket, Key):
+    return {'Body': io.BytesIO(json.dumps(CACHED_INFO).encode('utf-8'))}
+
+  def put_object(self, **kwargs):
+    pass
+
+def test_svg_identity_url_is_not_the_painting_body(monkeypatch):
+  identity = wc.identity_url(TITLE)
+  download_url = wc.wc_title_to_url(TITLE, width=1280)
+  assert '/1000px-' in identity # kept so the imageid of already ingested SVGs does not change
+
+  monkeypatch.setattr(manifest, 's3', _ImageInfoBucket())
+  monkeypatch.setattr(manifest, 'exists', lambda key, bucket=None: key.endswith('.json'))
+  monkeypatch.setattr(manifest, 'iiif_info', lambda url_hash, width, height, refresh=False: {'width': width, 'height': height})
+  info = manifest.get_image_data(manifestid=f'wc:{TITLE}', url=identity, download_url=download_url)
+  assert info['url'] == download_url
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import argparse
+import concurrent.futures
+import math
+import multiprocessing
+import os
+import struct
+import threading
+from time import time as now
+
+import pyvips
+logging.getLogger('pyvips').setLevel(logging.ERROR)
+
+# Multi-process pyramid tiling for very large images.  A single tiffsave JPEG encodes every tile
+# on one libvips write thread, which dominates cold ingest of gigapixel sources.  Here the source
+# is decoded once into uncompressed vips files, one per pyramid level (each a 2x2 box reduction
+# of the previous, as tiffsave builds its pyramid), the tiles of every level are JPEG encoded by
+# a pool of processes, one tile row per task, and the encoded tiles are written in the layout
+# tiffsave produces: one tiled, JPEG compressed IFD per level, full resolution first.
+#
+# Process pools need POSIX semaphores, which Lambda does not provide, and only 8-bit grey or RGB
+# images are handled (see eligible).  manifest.tile does not call this module yet: it is wired in
+# once the output matches tiffsave (tests/test_tiler.py) and the benchmark (run this module with
+# --sizes) shows a gain on the target hardware.  PARALLEL_TILE_MIN_MEGAPIXELS=0 disables eligible.
+
+PARALLEL_TILE_WORKERS = int(os.environ.get('PARALLEL_TILE_WORKERS', str(os.cpu_count() or 1)))
+PARALLEL_TILE_MIN_MEGAPIXELS = int(os.environ.get('PARALLEL_TILE_MIN_MEGAPIXELS', '0')) # 0 disables parallel tiling
+MAX_TIFF_BYTES = 2 ** 32 - 2 ** 24 # classic TIFF offsets are 32-bit; larger pyramids are left to tiffsave, which writes BigTIFF
+
+SHORT, LONG = 3, 4
+
+_pool = None
+_pool_failed = False
+_pool_lock = threading.Lock()
+
+def _get_pool():
+  global _pool, _pool_failed
+  with _pool_lock:
+    if _pool is None and not _pool_failed:
+      try:
+        _pool = concurrent.futures.ProcessPoolExecutor(max_workers=PARALLEL_TILE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+      except (OSError, ImportError, NotImplementedError) as e:
+        logger.warning(f'tiler: process pool unavailable, using tiffsave error={e}')
+        _pool_failed = True
+    return _pool
+
+def _reset_pool():
+  """Drops a pool broken by a worker dying (typically killed for memory), so the next image gets a new one"""
+  global _pool
+  with _pool_lock:
+    _pool = None
+
+def eligible(img):
+  """True when img is large enough to be worth tiling in parallel and in a format this module writes"""
+  return (
+    PARALLEL_TILE_MIN_MEGAPIXELS > 0 and
+    PARALLEL_TILE_WORKERS > 1 and
+    img.width * img.height >= PARALLEL_TILE_MIN_MEGAPIXELS * 1000000 and
+    img.bands in (1, 3) and img.format == 'uchar' and
+    img.width * img.height * img.bands // 3 < MAX_TIFF_BYTES and
+    _get_pool() is not None
+  )
+
+# Worker process state: the level file most recently opened, as consecutive tasks read the same level
+_level = {'path': None, 'image': None}
+
+def _encode_row(level_path, row, tile_size, quality):
+  """JPEG encodes one row of tiles of a level, padding edge tiles to full size as TIFF requires"""
+  if _level['path'] != level_path:
+    _level.update({'path': level_path, 'image': pyvips.Image.new_from_file(level_path, access='random')})
+  img = _level['image']
+  top = row * tile_size
+  height = min(tile_size, img.height - top)
+  tiles = []
+  for left in range(0, img.width, tile_size):
+    width = min(tile_size, img.width - left)
+    region = img.crop(left, top, width, height)
+    if (width, height) != (tile_size, tile_size):
+      region = region.embed(0, 0, tile_size, tile_size, extend='copy')
+    # a bare copy of the pixels, so EXIF and ICC metadata are not repeated in every tile
+    region = pyvips.Image.new_from_memory(region.write_to_memory(), tile_size, tile_size, img.bands, 'uchar')
+    # 4:2:0 chroma subsampling, matching the YCbCrSubSampling tag written with each IFD
+    tiles.append(region.jpegsave_buffer(Q=quality, subsample_mode='on' if img.bands == 3 else 'off'))
+  return tiles
+
+def _write_levels(src_path, session, name, tile_size):
+  """Decodes the source once and writes every pyramid level as an uncompressed vips file, returning their paths"""
+  paths = []
+  level = pyvips.Image.new_from_file(src_path, access='sequential')
+  while True:
+    path = session.path(f'{name}-{len(paths)}.v', level.width * level.height * level.bands)
+    level.write_to_file(path)
+    paths.append(path)
+    level = pyvips.Image.new_from_file(path, access='sequential')
+    if not ((level.width > tile_size or level.height > tile_size) and level.width > 1 and level.height > 1):
+      return paths
+    # like tiffsave, an odd last row or column is dropped so each level is floor(width / 2) x floor(height / 2),
+    # see image_server.pyramid_sizes
+    level = level.crop(0, 0, level.width - level.width % 2, level.height - level.height % 2).shrink(2, 2)
+
+def _ifd(offset, width, height, bands, tile_size, tile_offsets, tile_counts, reduced, next_offset=0):
+  """A TIFF IFD to be written at offset, followed by its out-of-line values"""
+  entries = [
+    (254, LONG, [1 if reduced else 0]),     # NewSubfileType
+    (256, LONG, [width]),
+    (257, LONG, [height]),
+    (258, SHORT, [8] * bands),              # BitsPerSample
+    (259, SHORT, [7]),                      # Compression: JPEG
+    (262, SHORT, [6 if bands == 3 else 1]), # Photometric: YCbCr or min-is-black
+    (277, SHORT, [bands]),                  # SamplesPerPixel
+    (284, SHORT, [1]),                      # PlanarConfiguration: contiguous
+    (322, SHORT, [tile_size]),
+    (323, SHORT, [tile_size]),
+    (324, LONG, tile_offsets),
+    (325, LONG, tile_counts)
+  ] + ([(530, SHORT, [2, 2])] if bands == 3 else []) # YCbCrSubSampling
+  head = 2 + 12 * len(entries) + 4
+  body, extra = struct.pack('<H', len(entries)), b''
+  for tag, kind, values in entries:
+    packed = struct.pack('<' + ('H' if kind == SHORT else 'I') * len(values), *values)
+    if len(packed) <= 4:
+      body += struct.pack('<HHI', tag, kind, len(values)) + packed.ljust(4, b'\0')
+    else:
+      body += struct.pack('<HHII', tag, kind, len(values), offset + head + len(extra))
+      extra += packed + (b'\0' if len(packed) % 2 else b'')
+  return body + struct.pack('<I', next_offset) + extra
+
+def tile_parallel(src_path, dest_path, session, quality=50, tile_size=512):
+  """Writes the tiled JPEG pyramid TIFF of src_path to dest_path, encoding tiles in the process pool"""
+  start = now()
+  pool = _get_pool()
+  paths = _write_levels(src_path, session, os.path.basename(dest_path), tile_size)
+  decoded = now() - start
+  futures = []
+  try:
+    levels = []
+    for path in paths:
+      level = pyvips.Image.new_from_file(path)
+      levels.append((level.width, level.height, level.bands))
+      futures.append([pool.submit(_encode_row, path, row, tile_size, quality) for row in range(math.ceil(level.height / tile_size))])
+
+    with open(dest_path, 'wb') as out:
+      out.write(b'II*\0' + struct.pack('<I', 0)) # the first IFD offset is filled in once the tiles are written
+      layout = []
+      for rows in futures:
+        offsets, counts = [], []
+        for future in rows:
+          for data in future.result():
+            offsets.append(out.tell())
+            counts.append(len(data))
+            out.write(data + (b'\0' if len(data) % 2 else b''))
+        layout.append((offsets, counts))
+        if out.tell() > MAX_TIFF_BYTES:
+          raise ValueError(f'pyramid exceeds {MAX_TIFF_BYTES} bytes')
+
+      ifd_offset = out.tell()
+      out.seek(4)
+      out.write(struct.pack('<I', ifd_offset))
+      out.seek(ifd_offset)
+      for idx, ((width, height, bands), (offsets, counts)) in enumerate(zip(levels, layout)):
+        ifd = _ifd(ifd_offset, width, height, bands, tile_size, offsets, counts, idx > 0)
+        if idx < len(levels) - 1:
+          ifd = _ifd(ifd_offset, width, height, bands, tile_size, offsets, counts, idx > 0, ifd_offset + len(ifd))
+        out.write(ifd)
+        ifd_offset += len(ifd)
+  except concurrent.futures.process.BrokenProcessPool:
+    _reset_pool()
+    raise
+  finally:
+    for future in [future for rows in futures for future in rows]:
+      future.cancel()
+    for path in paths:
+      session.remove(path)
+  logger.debug(f'tile_parallel: dest={dest_path} levels={len(paths)} workers={PARALLEL_TILE_WORKERS} decode={round(decoded,3)} elapsed={round(now()-start,3)}')
+  return len(paths)
+
+if __name__ == '__main__':
+  # Benchmark: single tiffsave vs tile_parallel on synthetic square images
+  logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s', level=logging.INFO)
+  from scratch import ScratchSpace
+
+  parser = argparse.ArgumentParser(description='Benchmark parallel pyramid tiling against a single tiffsave')
+  parser.add_argument('--sizes', nargs='+', type=int, default=[20000, 30000], help='Edge lengths of the synthetic test images')
+  parser.add_argument('--quality', type=int, default=50)
+  parser.add_argument('--tile-size', type=int, default=512)
+  parser.add_argument('--dir', default=os.environ.get('SCRATCH_DIR', '/tmp'), help='Directory for the test images and pyramids')
+  parser.add_argument('--scratch-mb', type=int, default=32768, help='Scratch budget for the benchmark')
+  args = parser.parse_args()
+
+  space = ScratchSpace(root=args.dir, budget=args.scratch_mb * 1024 * 1024)
+  for size in args.sizes:
+    with space.session(f'bench-{size}') as session:
+      src = session.path(f'source-{size}.jpg', size * size)
+      # gradients plus noise, so the source decodes and the tiles compress like a photograph rather than a flat fill
+      xy = pyvips.Image.xyz(size, size)
+      rgb = (xy[0] * (255 / size)).bandjoin([xy[1] * (255 / size), (xy[0] + xy[1]) * (127 / size)])
+      (rgb + pyvips.Image.gaussnoise(size, size, sigma=24, mean=0)).cast('uchar').jpegsave(src, Q=90)
+
+      single = session.path(f'single-{size}.tif', size * size)
+      start = now()
+      pyvips.Image.new_from_file(src).tiffsave(single, tile=True, compression='jpeg', pyramid=True, Q=args.quality, tile_width=args.tile_size, tile_height=args.tile_size)
+      single_elapsed = now() - start
+
+      parallel = session.path(f'parallel-{size}.tif', size * size)
+      start = now()
+      tile_parallel(src, parallel, session, args.quality, args.tile_size)
+      parallel_elapsed = now() - start
+
+      a, b = pyvips.Image.new_from_file(single), pyvips.Image.new_from_file(parallel)
+      pages = (a.get('n-pages'), b.get('n-pages'))
+      last = pages[0] - 1
+      diff = (pyvips.Image.new_from_file(single, page=last) - pyvips.Image.new_from_file(parallel, page=last)).abs().avg() if pages[0] == pages[1] else None
+      logger.info(
+        f'benchmark: size={size}x{size} workers={PARALLEL_TILE_WORKERS} '
+        f'single={round(single_elapsed,2)}s parallel={round(parallel_elapsed,2)}s speedup={round(single_elapsed/parallel_elapsed,2)} '
+        f'bytes={os.path.getsize(single)}/{os.path.getsize(parallel)} pages={pages[0]}/{pages[1]} smallest_level_mean_diff={diff}'
+      )
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import io
+import re
+
+from PIL import Image, ImageOps
+
+try:
+  import pillow_avif # registers the AVIF codec with Pillow when installed
+except ImportError:
+  pass
+
+# Transformation strings are comma-separated `<key>_<value>` segments, e.g. "w_300,h_200,c_fill,q_80,f_webp,dpr_2"
+#   w_   target width in CSS pixels
+#   h_   target height in CSS pixels
+#   c_   crop/fit mode (see CROP_MODES)
+#   q_   encoder quality (1-100)
+#   f_   output format (see FORMATS) or "auto" for Accept header negotiation
+#   dpr_ device pixel ratio, multiplies w and h
+SEGMENT_PATTERN = re.compile(r'^(?P<key>[A-Za-z]+)_(?P<value>[A-Za-z0-9.]+)$')
+
+CROP_MODES = (
+  'scale', # force exact w x h (distorts aspect ratio), the default when both w and h are given
+  'fit',   # fit within w x h preserving aspect ratio, may upscale
+  'limit', # like fit, but never upscale
+  'fill',  # cover w x h and center crop the overflow
+  'pad'    # fit within w x h and pad to exact size
+)
+
+FORMATS = {
+  'avif': 'image/avif',
+  'webp': 'image/webp',
+  'jpeg': 'image/jpeg',
+  'png': 'image/png'
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+
+# Formats the upstream IIIF image server can emit directly, mapped to IIIF file extensions
+IIIF_FORMATS = {'jpeg': 'jpg', 'png': 'png', 'webp': 'webp'}
+
+# Negotiation preference when the client accepts several formats, smallest typical encoding first
+NEGOTIATION_ORDER = ('avif', 'webp', 'jpeg')
+
+PIL_FORMATS = {'avif': 'AVIF', 'webp': 'WEBP', 'jpeg': 'JPEG', 'png': 'PNG'}
+
+DEFAULT_WIDTH = 1000
+MAX_DPR = 3.0
+MAX_DIMENSION = 4096
+
+def supported_formats():
+  Image.init()
+  registered = set(Image.SAVE.keys())
+  return [fmt for fmt in FORMATS if PIL_FORMATS[fmt] in registered or fmt in IIIF_FORMATS]
+
+def is_valid(transform_str: str) -> bool:
+  """
+  Returns True if transform_str is a comma-separated list of key_value pairs
+  using known keys and values, e.g. "w_300", "w_300,h_200,c_fill,f_webp,dpr_2"
+  """
+  try:
+    parse(transform_str)
+    return True
+  except ValueError:
+    return False
+
+def parse(transform_str: str) -> dict:
+  """
+  Parses a transformation string into a normalized spec dict.  Raises ValueError on
+  unknown keys or malformed values.
+  """
+  spec = {'w': None, 'h': None, 'c': None, 'q': None, 'f': None, 'dpr': 1.0}
+  for part in [p for p in (transform_str or '').split(',') if p]:
+    match = SEGMENT_PATTERN.match(part)
+    if not match:
+      raise ValueError(f'invalid transformation segment: {part}')
+    key, val = match.group('key').lower(), match.group('value').lower()
+    if key in ('w', 'h', 'q'):
+      if not val.isdigit() or int(val) == 0:
+        raise ValueError(f'invalid {key} value: {val}')
+      spec[key] = int(val)
+    elif key == 'c':
+      if val not in CROP_MODES:
+        raise ValueError(f'invalid crop mode: {val}')
+      spec['c'] = val
+    elif key == 'f':
+      val = FORMAT_ALIASES.get(val, val)
+      if val != 'auto' and val not in FORMATS:
+        raise ValueError(f'invalid format: {val}')
+      spec['f'] = None if val == 'auto' else val
+    elif key == 'dpr':
+      try:
+        spec['dpr'] = min(max(float(val), 0.1), MAX_DPR)
+      except ValueError:
+        raise ValueError(f'invalid dpr value: {val}')
+    else:
+      raise ValueError(f'unknown transformation key: {key}')
+  if spec['q'] is not None and spec['q'] > 100:
+    raise ValueError(f'invalid q value: {spec["q"]}')
+  return spec
+
+def negotiate_format(spec: dict, accept: str = '') -> str:
+  """Returns the explicitly requested format or, for f_auto, the smallest format the client accepts"""
+  if spec.get('f'):
+    return spec['f']
+  accepted = [media_range.split(';')[0].strip().lower() for media_range in (accept or '').split(',')]
+  supported = supported_formats()
+  for fmt in NEGOTIATION_ORDER:
+    if fmt in supported and FORMATS[fmt] in accepted:
+      return fmt
+  return 'jpeg'
+
+def resolve(spec: dict, accept: str = '') -> dict:
+  """
+  Applies DPR and defaults to a parsed spec and negotiates the output format.  The resolved
+  spec is what gets rendered and cached, so two requests resolving to the same spec share
+  a cache entry.
+  """
+  resolved = dict(spec)
+  dpr = spec.get('dpr') or 1.0
+  for dim in ('w', 'h'):
+    if resolved[dim]:
+      resolved[dim] = min(round(resolved[dim] * dpr), MAX_DIMENSION)
+  if not resolved['w'] and not resolved['h']:
+    resolved['w'] = min(round(DEFAULT_WIDTH * dpr), MAX_DIMENSION)
+  if resolved['w'] and resolved['h']:
+    resolved['c'] = resolved['c'] or 'scale'
+  else:
+    resolved['c'] = 'limit' if resolved['c'] == 'limit' else 'fit'
+  resolved['f'] = negotiate_format(spec, accept)
+  resolved['dpr'] = 1.0
+  resolved['negotiated'] = not spec.get('f')
+  return resolved
+
+def cache_key(resolved: dict) -> str:
+  """Canonical transformation string for a resolved spec, e.g. "w_600,c_fit,f_webp" """
+  parts = [f'{key}_{resolved[key]}' for key in ('w', 'h', 'c', 'q') if resolved.get(key)]
+  parts.append(f'f_{resolved["f"]}')
+  return ','.join(parts)
+
+def media_type(resolved: dict) -> str:
+  return FORMATS[resolved['f']]
+
+def iiif_request(resolved: dict, width: int = None, height: int = None):
+  """
+  Maps a resolved spec to IIIF Image API 3 (region, size, extension) path segments.  When the
+  output cannot be produced by the IIIF server alone (see needs_local_render) the request
+  returns a lossless intermediate that is close to the target size.
+  """
+  w, h, mode = resolved['w'], resolved['h'], resolved['c']
+  region = 'full'
+  if w and h:
+    if mode == 'scale':
+      size = f'{w},{h}'
+    elif mode == 'fit':
+      size = f'^!{w},{h}'
+    elif mode in ('limit', 'pad'):
+      size = f'!{w},{h}'
+    elif width and height:
+      crop_w, crop_h = (width, round(width * h / w)) if width / height < w / h else (round(height * w / h), height)
+      region = f'{(width - crop_w) // 2},{(height - crop_h) // 2},{crop_w},{crop_h}'
+      size = f'{w},{h}'
+    else:
+      size = 'max'
+  else:
+    size = f'{w},' if w else f',{h}'
+  ext = IIIF_FORMATS.get(resolved['f']) if not needs_local_render(resolved, width, height) else 'png'
+  return region, size, ext
+
+def needs_local_render(resolved: dict, width: int = None, height: int = None) -> bool:
+  """True when the upstream IIIF response must be post-processed before it is returned"""
+  return (
+    resolved['f'] not in IIIF_FORMATS or
+    resolved.get('q') is not None or
+    resolved['c'] == 'pad' or
+    (resolved['c'] == 'fill' and resolved['w'] and resolved['h'] and not (width and height))
+  )
+
+def render(img: Image.Image, resolved: dict) -> bytes:
+  """Resizes/crops a PIL image according to a resolved spec and encodes it"""
+  w, h, mode = resolved['w'], resolved['h'], resolved['c']
+  if w and h:
+    if mode == 'scale':
+      img = img.resize((w, h), resample=Image.LANCZOS)
+    elif mode == 'fit':
+      img = ImageOps.contain(img, (w, h), method=Image.LANCZOS)
+    elif mode == 'limit':
+      img = img.copy()
+      img.thumbnail((w, h), resample=Image.LANCZOS)
+    elif mode == 'fill':
+      img = ImageOps.fit(img, (w, h), method=Image.LANCZOS)
+    elif mode == 'pad':
+      img = ImageOps.pad(img if img.mode == 'RGB' else img.convert('RGB'), (w, h), method=Image.LANCZOS, color=(255, 255, 255))
+  elif w or h:
+    scale = (w / img.width) if w else (h / img.height)
+    if mode != 'limit' or scale < 1:
+      img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), resample=Image.LANCZOS)
+  return encode(img, resolved['f'], resolved.get('q'))
+
+def encode(img: Image.Image, fmt: str, quality: int = None) -> bytes:
+  buf = io.BytesIO()
+  if fmt in ('jpeg',) and img.mode not in ('RGB', 'L'):
+    img = img.convert('RGB')
+  options = {'quality': quality} if quality and fmt != 'png' else {}
+  img.save(buf, format=PIL_FORMATS[fmt], **options)
+  return buf.getvalue()
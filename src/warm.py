@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+logging.basicConfig(format='%(asctime)s : %(filename)s : %(levelname)s : %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import argparse
+import concurrent.futures
+from hashlib import sha256
+import json
+import sys
+import threading
+from time import time as now, sleep
+from urllib.parse import urlparse
+
+import gh
+from manifest import generate, manifestid_to_url, prefetch_wc, RefreshMode
+from s3 import Bucket
+import wc
+
+# Bulk warming of the manifest cache, e.g. a whole gh repo or a list of Commons titles before a
+# launch.  Manifest ids are read from a file, a GitHub directory or stdin and generated by a pool
+# of workers, each starting at most --rate manifests a second per source host.  Every id that
+# completes is appended to the resume file, so an interrupted run continues where it stopped.
+#
+#   python warm.py ids.txt --workers 8 --rate upload.wikimedia.org=2 --resume warm.done
+#   python warm.py --gh acct/repo/images --recursive
+#   cat ids.txt | python warm.py -
+
+manifest_cache = Bucket(bucket='juncture-manifests')
+
+def gh_dir_ids(spec, ref=None, recursive=False):
+  """Manifest ids of the images in a GitHub directory given as acct/repo[/path]"""
+  acct, repo, *path = spec.strip('/').split('/')
+  index = gh.repo_index(acct, repo, ref)
+  if index is None:
+    raise ValueError(f'Repository not found: {acct}/{repo}')
+  dirs, ids = ['/'.join(path)], []
+  while dirs:
+    path = dirs.pop(0)
+    ids += [f'gh:{acct}/{repo}/{ref + "/" if ref else ""}{entry["path"]}' for entry in index.images(path)]
+    if recursive:
+      dirs += [f'{path}/{name}'.strip('/') for name in index.subdirs(path)]
+  return ids
+
+def read_ids(fp):
+  return [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+
+class RateLimiter(object):
+  """Spaces out starts per host to at most rate a second; hosts without a rate are not limited"""
+
+  def __init__(self, rates, default_rate=None):
+    self.rates = rates
+    self.default_rate = default_rate
+    self._next = {}
+    self._lock = threading.Lock()
+
+  def wait(self, host):
+    rate = self.rates.get(host, self.default_rate)
+    if not rate:
+      return 0
+    with self._lock:
+      start = max(now(), self._next.get(host, 0))
+      self._next[host] = start + 1 / rate
+    delay = start - now()
+    if delay > 0:
+      sleep(delay)
+    return max(delay, 0)
+
+class Stats(object):
+
+  def __init__(self, total):
+    self.total = total
+    self.start = now()
+    self.latencies = []
+    self.failed = []
+    self.statuses = {}
+    self.hosts = {}
+    self._lock = threading.Lock()
+
+  def record(self, manifestid, host, elapsed, status):
+    """status is generated, cached or failed"""
+    ok = status != 'failed'
+    with self._lock:
+      self.latencies.append(elapsed)
+      self.statuses[status] = self.statuses.get(status, 0) + 1
+      host_stats = self.hosts.setdefault(host, {'done': 0, 'failed': 0, 'seconds': 0.0})
+      host_stats['done' if ok else 'failed'] += 1
+      host_stats['seconds'] = round(host_stats['seconds'] + elapsed, 3)
+      if not ok:
+        self.failed.append(manifestid)
+
+  def summary(self):
+    with self._lock:
+      latencies = sorted(self.latencies)
+      elapsed = now() - self.start
+      pct = lambda p: round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 3) if latencies else None
+      return {
+        'completed': len(latencies) - len(self.failed),
+        'failed': len(self.failed),
+        'statuses': dict(self.statuses),
+        'remaining': self.total - len(latencies),
+        'elapsed': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 3) if elapsed else None, # manifests a second
+        'latency': {'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99), 'max': latencies[-1] if latencies else None},
+        'hosts': dict([(host, dict(host_stats)) for host, host_stats in self.hosts.items()])
+      }
+
+class ResumeFile(object):
+  """Completed manifest ids, one per line, appended as they complete"""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    try:
+      with open(path) as fp:
+        self.completed = set(read_ids(fp))
+    except FileNotFoundError:
+      self.completed = set()
+    self._fp = open(path, 'a')
+
+  def checkpoint(self, manifestid):
+    with self._lock:
+      self._fp.write(f'{manifestid}\n')
+      self._fp.flush()
+
+  def close(self):
+    self._fp.close()
+
+def warm(manifestid, limiter, stats, resume, refresh=None, skip_cached=True):
+  start = now()
+  host = None
+  try:
+    resolved = manifestid_to_url(manifestid)
+    if not resolved or not resolved[1]:
+      raise ValueError(f'Unrecognized manifest id: {manifestid}')
+    normalized, url = resolved
+    host = urlparse(url).hostname
+    imageid = sha256(url.encode('utf-8')).hexdigest()
+    if skip_cached and not refresh and imageid in manifest_cache:
+      status = 'cached'
+    else:
+      limiter.wait(host)
+      manifest = generate(manifestid=normalized, refresh=refresh, enrich=True)
+      if not manifest:
+        raise ValueError('Manifest could not be generated')
+      manifest_cache[imageid] = json.dumps(manifest)
+      status = 'generated'
+    if resume:
+      resume.checkpoint(manifestid)
+    stats.record(manifestid, host, now() - start, status)
+  except Exception as e:
+    status = 'failed'
+    logger.warning(f'warm: manifestid={manifestid} error={e}')
+    stats.record(manifestid, host, now() - start, status)
+  logger.debug(f'warm: manifestid={manifestid} status={status} elapsed={round(now()-start,3)}')
+  return status
+
+def _parse_rates(values):
+  rates = {}
+  for value in values or []:
+    host, _, rate = value.rpartition('=')
+    rates[host] = float(rate)
+  return rates
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Generate and cache manifests in bulk')
+  parser.add_argument('source', nargs='?', help='File of manifest ids, one per line, or - for stdin')
+  parser.add_argument('--gh', help='GitHub directory to warm, as acct/repo[/path]')
+  parser.add_argument('--ref', help='Branch or commit of the --gh directory')
+  parser.add_argument('--recursive', default=False, action='store_true', help='Include subdirectories of the --gh directory')
+  parser.add_argument('--workers', type=int, default=4, help='Manifests generated concurrently')
+  parser.add_argument('--rate', action='append', metavar='HOST=N', help='Start at most N manifests a second for sources on HOST (repeatable)')
+  parser.add_argument('--default-rate', type=float, help='Rate for hosts without a --rate')
+  parser.add_argument('--resume', help='File of completed ids; ids in it are skipped and new completions are appended')
+  parser.add_argument('--refresh', nargs='?', const='all', default=None, choices=[mode.value for mode in RefreshMode], help='Regenerate even if cached (metadata, image, derivatives or all)')
+  parser.add_argument('--report', type=float, default=30, help='Seconds between progress reports')
+  args = parser.parse_args()
+
+  if args.gh:
+    ids = gh_dir_ids(args.gh, args.ref, args.recursive)
+  elif args.source in (None, '-'):
+    ids = read_ids(sys.stdin)
+  else:
+    with open(args.source) as fp:
+      ids = read_ids(fp)
+
+  # categories are warmed as their member files, with member metadata and renditions fetched in batches up front
+  categories = [manifestid for manifestid in ids if wc.is_category(manifestid)]
+  for category in categories:
+    titles = wc.category_titles(category[3:], refresh=bool(args.refresh))
+    prefetch_wc(titles)
+    ids += [f'wc:{title}' for title in titles]
+  ids = [manifestid for manifestid in ids if manifestid not in categories]
+
+  resume = ResumeFile(args.resume) if args.resume else None
+  ids = list(dict.fromkeys([manifestid for manifestid in ids if not resume or manifestid not in resume.completed]))
+  logger.info(f'warm: ids={len(ids)} skipped={len(resume.completed) if resume else 0} workers={args.workers}')
+
+  limiter = RateLimiter(_parse_rates(args.rate), args.default_rate)
+  stats = Stats(len(ids))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='warm') as executor:
+    futures = [executor.submit(warm, manifestid, limiter, stats, resume, args.refresh) for manifestid in ids]
+    pending = set(futures)
+    while pending:
+      _, pending = concurrent.futures.wait(pending, timeout=args.report)
+      if pending:
+        logger.info(f'warm: {json.dumps(stats.summary())}')
+  if resume:
+    resume.close()
+  summary = stats.summary()
+  print(json.dumps({**summary, 'failed_ids': stats.failed}, indent=2))
+  sys.exit(1 if stats.failed else 0)
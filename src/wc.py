@@ -8,6 +8,8 @@ logger = logging.getLogger(__name__)
 import hashlib
 
 import json
+import math
+import os
 from time import time as now
 from urllib.parse import quote, unquote
 import re
@@ -19,7 +21,20 @@ logging.getLogger('requests').setLevel(logging.INFO)
 
 from expiringdict import ExpiringDict
 wd_entities = ExpiringDict(max_len=100, max_age_seconds=1800) # cache entities for 30 minutes
-wc_entities = ExpiringDict(max_len=100, max_age_seconds=1800)
+wc_entities = ExpiringDict(max_len=1000, max_age_seconds=1800) # MediaInfo entities by pageid
+wc_metadata = ExpiringDict(max_len=1000, max_age_seconds=1800) # Commons API imageinfo by title
+renditions = ExpiringDict(max_len=1000, max_age_seconds=1800) # (title, width) -> Commons thumburl
+enrichments = ExpiringDict(max_len=1000, max_age_seconds=1800) # Wikidata enrichment by title, see get_enrichment
+category_members = ExpiringDict(max_len=100, max_age_seconds=600) # (category, limit) -> file titles, so membership changes show within 10 minutes
+
+# Thumbnail widths Commons pre-renders and caches at the edge, so requests for them are cheap
+COMMONS_THUMB_WIDTHS = (250, 330, 500, 960, 1280, 1920, 3840)
+# Formats that are always ingested from a Commons rendition rather than the original
+RENDERED_FORMATS = ('svg', 'tif', 'tiff')
+
+CATEGORY_PREFIX = 'Category:'
+CATEGORY_MAX_MEMBERS = int(os.environ.get('WC_CATEGORY_MAX_MEMBERS', '500')) # files per category collection
+API_BATCH_SIZE = 50 # titles or ids per imageinfo and wbgetentities request, the API limit for clients without apihighlimits
 
 licenses = {
   # Creative Commons Licenses
@@ -57,11 +72,20 @@ def _extract_text(val, lang='en'):
   return (_elem.text if _elem else soup.text).strip()
   
 def _get_wc_metadata(title):
+  if title in wc_metadata:
+    return wc_metadata[title]
   url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&titles=File:{quote(title)}&prop=imageinfo&iiprop=extmetadata|size|mime'
   resp = requests.get(url, headers={'User-agent': 'Juncture client'})
   logger.info(f'{url} {resp.status_code}')
   if resp.status_code == 200:
-    return list(resp.json()['query']['pages'].values())[0]
+    wc_metadata[title] = list(resp.json()['query']['pages'].values())[0]
+    return wc_metadata[title]
+
+def get_imageinfo(title):
+  """Size, dimensions and MIME type of a Commons file from the imageinfo API (shared with the metadata lookup)"""
+  title = unquote(title).replace(' ','_')
+  page = _get_wc_metadata(title) or {}
+  return page['imageinfo'][0] if page.get('imageinfo') else None
   
 def _get_wc_entity(pageid):
   if pageid not in wc_entities:
@@ -72,6 +96,66 @@ def _get_wc_entity(pageid):
       wc_entities[pageid] = resp.json()['entities'][f'M{pageid}']
   return wc_entities.get(pageid)
 
+def is_category(manifestid):
+  return (manifestid or '').startswith(f'wc:{CATEGORY_PREFIX}')
+
+def _api_query(params):
+  """Results of a Commons API query, following continuation and merging the pages of every batch"""
+  pages, cont = {}, {}
+  while True:
+    url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&{"&".join([f"{key}={quote(str(val))}" for key, val in {**params, **cont}.items()])}'
+    resp = requests.get(url, headers={'User-agent': 'Juncture client'})
+    logger.debug(f'_api_query: url={url} status={resp.status_code}')
+    if resp.status_code != 200:
+      break
+    results = resp.json()
+    for pageid, page in results.get('query', {}).get('pages', {}).items():
+      pages.setdefault(pageid, {}).update(page)
+    if 'continue' not in results:
+      break
+    cont = results['continue']
+  return pages
+
+def category_titles(category, limit=CATEGORY_MAX_MEMBERS, refresh=False):
+  """Titles (without the File: prefix) of the files in a Commons category, in category order"""
+  category = unquote(category).replace(' ','_')
+  category = category if category.startswith(CATEGORY_PREFIX) else f'{CATEGORY_PREFIX}{category}'
+  if not refresh and (category, limit) in category_members:
+    return list(category_members[(category, limit)])
+  titles, cont = [], {}
+  while len(titles) < limit:
+    url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&list=categorymembers&cmtitle={quote(category)}&cmtype=file&cmlimit={min(500, limit)}{"".join([f"&{key}={quote(val)}" for key, val in cont.items()])}'
+    resp = requests.get(url, headers={'User-agent': 'Juncture client'})
+    logger.debug(f'category_titles: url={url} status={resp.status_code}')
+    if resp.status_code != 200:
+      return titles[:limit] # a partial listing is not cached
+    results = resp.json()
+    titles += [member['title'].split(':', 1)[1].replace(' ','_') for member in results.get('query', {}).get('categorymembers', [])]
+    if 'continue' not in results:
+      break
+    cont = results['continue']
+  category_members[(category, limit)] = titles[:limit]
+  return list(titles[:limit])
+
+def prefetch_metadata(titles):
+  """Fills the imageinfo and MediaInfo entity caches for many files, API_BATCH_SIZE per request"""
+  start = now()
+  titles = [title for title in titles if title not in wc_metadata]
+  for idx in range(0, len(titles), API_BATCH_SIZE):
+    pages = _api_query({'titles': '|'.join([f'File:{title}' for title in titles[idx:idx + API_BATCH_SIZE]]), 'prop': 'imageinfo', 'iiprop': 'extmetadata|size|mime'})
+    for page in pages.values():
+      wc_metadata[page['title'].split(':', 1)[1].replace(' ','_')] = page
+  pageids = [str(page['pageid']) for page in [wc_metadata.get(title) for title in titles] if page and 'pageid' in page and page['pageid'] not in wc_entities]
+  for idx in range(0, len(pageids), API_BATCH_SIZE):
+    url = f'https://commons.wikimedia.org/w/api.php?format=json&action=wbgetentities&ids={quote("|".join([f"M{pageid}" for pageid in pageids[idx:idx + API_BATCH_SIZE]]))}'
+    resp = requests.get(url, headers={'User-agent': 'Juncture client'})
+    logger.debug(f'prefetch_metadata: url={url} status={resp.status_code}')
+    if resp.status_code == 200:
+      for entity_id, entity in resp.json().get('entities', {}).items():
+        if 'missing' not in entity:
+          wc_entities[int(entity_id[1:])] = entity
+  logger.debug(f'prefetch_metadata: titles={len(titles)} entities={len(pageids)} elapsed={round(now()-start,3)}')
+
 def _get_wd_entity(qid):
   if qid not in wd_entities:
     resp = requests.get(f'https://www.wikidata.org/wiki/Special:EntityData/{qid}.json')
@@ -121,35 +205,109 @@ def _get_location_data(qid, lang='en'):
   return label, description, coords
 
 def wc_title_to_url(title, width=None):
+  """Commons original for a file title, or its width px rendition (SVG renditions are PNG, TIFF renditions JPEG)"""
   title = unquote(title).replace(' ','_')
   md5 = hashlib.md5(title.encode('utf-8')).hexdigest()
   logger.debug(f'wc_title_to_url: title={title} md5={md5}')
-  ext = title.split('.')[-1]
+  ext = title.split('.')[-1].lower()
   baseurl = 'https://upload.wikimedia.org/wikipedia/commons/'
-  if ext == 'svg':
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width or 1000}px-${quote(title)}.png'
-  elif ext in ('tif', 'tiff'):
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width or 1000}px-${quote(title)}.jpg'
-  else:
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width or 1000}px-${quote(title)}' if width is not None else f'{baseurl}{md5[:1]}/{md5[:2]}/{quote(title.replace(" ","_"))}'
+  if width is None:
+    return f'{baseurl}{md5[:1]}/{md5[:2]}/{quote(title)}'
+  suffix = '.png' if ext == 'svg' else '.jpg' if ext in ('tif', 'tiff') else ''
+  return f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width}px-{quote(title)}{suffix}'
+
+def _get_rendition_url(title, width):
+  """Commons-rendered thumbnail URL for a file at the given width, through the imageinfo API (iiurlwidth)"""
+  if (title, width) not in renditions:
+    url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&titles=File:{quote(title)}&prop=imageinfo&iiprop=url&iiurlwidth={width}'
+    resp = requests.get(url, headers={'User-agent': 'Juncture client'})
+    logger.debug(f'_get_rendition_url: url={url} status={resp.status_code}')
+    if resp.status_code == 200:
+      imageinfo = (list(resp.json()['query']['pages'].values())[0].get('imageinfo') or [{}])[0]
+      if imageinfo.get('thumburl'):
+        renditions[(title, width)] = imageinfo['thumburl']
+  return renditions.get((title, width))
+
+def _rendition_width(title, max_dimension):
+  """Width of the Commons thumbnail to download for a file, None when the original is used"""
+  ext = title.split('.')[-1].lower()
+  imageinfo = get_imageinfo(title) or {}
+  width, height = imageinfo.get('width'), imageinfo.get('height')
+  if not width or not height:
+    return None
+  if ext not in RENDERED_FORMATS and (not max_dimension or max(width, height) <= max_dimension):
+    return None
+  target = math.ceil(max_dimension * width / max(width, height)) if max_dimension else width
+  thumb_width = next((w for w in COMMONS_THUMB_WIDTHS if w >= target), target)
+  if ext != 'svg':
+    thumb_width = min(thumb_width, width)
+  if thumb_width >= width and ext not in RENDERED_FORMATS:
+    return None
+  return thumb_width
+
+def rendition_url(title, max_dimension):
+  """
+  Source to download for a Commons file: the smallest pre-rendered thumbnail whose longest edge
+  is at least max_dimension, or the original when it is no larger (SVG and TIFF always use a
+  rendition).  max_dimension of 0 or None means no limit.
+  """
+  title = unquote(title).replace(' ','_')
+  thumb_width = _rendition_width(title, max_dimension)
+  if thumb_width is None:
+    return wc_title_to_url(title)
+  url = _get_rendition_url(title, thumb_width) or wc_title_to_url(title, width=thumb_width)
+  logger.debug(f'rendition_url: title={title} max_dimension={max_dimension} width={thumb_width}')
   return url
 
+def prefetch_renditions(max_dimensions):
+  """
+  Fills the rendition cache for many files, given as {title: max_dimension}, API_BATCH_SIZE per
+  request.  iiurlwidth takes one width per request, so titles are grouped by rendition width;
+  imageinfo is read from the metadata cache, see prefetch_metadata.
+  """
+  start = now()
+  by_width = {}
+  for title, max_dimension in max_dimensions.items():
+    title = unquote(title).replace(' ','_')
+    thumb_width = _rendition_width(title, max_dimension)
+    if thumb_width is not None and (title, thumb_width) not in renditions:
+      by_width.setdefault(thumb_width, []).append(title)
+  for width, titles in by_width.items():
+    for idx in range(0, len(titles), API_BATCH_SIZE):
+      pages = _api_query({'titles': '|'.join([f'File:{title}' for title in titles[idx:idx + API_BATCH_SIZE]]), 'prop': 'imageinfo', 'iiprop': 'url', 'iiurlwidth': width})
+      for page in pages.values():
+        imageinfo = (page.get('imageinfo') or [{}])[0]
+        if imageinfo.get('thumburl'):
+          renditions[(page['title'].split(':', 1)[1].replace(' ','_'), width)] = imageinfo['thumburl']
+  logger.debug(f'prefetch_renditions: titles={sum([len(titles) for titles in by_width.values()])} widths={len(by_width)} elapsed={round(now()-start,3)}')
+
+def identity_url(title):
+  """
+  URL a wc: manifest is keyed by (its imageid is the sha256 of it).  SVG and TIFF files have always
+  been keyed by their 1000px rendition URL, in its historical form, so that form is kept to leave
+  their cached manifests, pyramids and image info valid; what is downloaded is rendition_url.
+  """
+  title = unquote(title).replace(' ','_')
+  ext = title.split('.')[-1].lower()
+  if ext not in RENDERED_FORMATS:
+    return wc_title_to_url(title)
+  md5 = hashlib.md5(title.encode('utf-8')).hexdigest()
+  suffix = '.png' if ext == 'svg' else '.jpg'
+  return f'https://upload.wikimedia.org/wikipedia/commons/thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/1000px-${quote(title)}{suffix}'
+
 def manifestid_to_url(manifestid):
-  return wc_title_to_url(manifestid[3:])
+  return identity_url(manifestid[3:])
 
 def get_iiif_metadata(**kwargs):
   manifestid = kwargs.get('manifestid')
   title = unquote(manifestid[3:]).replace(' ','_')
   start = now()
   
-  dro_qid = None
   props = {}
   props['wc_metadata'] = _get_wc_metadata(title)
   print(props['wc_metadata'])
   if 'pageid' in props['wc_metadata']:
     props['wc_entity'] = _get_wc_entity(props['wc_metadata']['pageid'])
-    dro_qid = _digital_representation_of(props['wc_entity'])
-    props['dro_entity'] = _get_wd_entity(dro_qid) if dro_qid else None
   
   imageinfo = props['wc_metadata']['imageinfo'][0] if 'imageinfo' in props['wc_metadata'] else {}
   extmetadata = imageinfo['extmetadata'] if 'extmetadata' in imageinfo else {}
@@ -203,38 +361,13 @@ def get_iiif_metadata(**kwargs):
   elif 'P1259' in entity_data['statements']: # coordinates of the point of view
     prop = entity_data['statements']['P1259'][0]['mainsnak']['datavalue']['value']
     location_coords = [prop['latitude'], prop['longitude']]
-  elif 'P1071' in entity_data['statements']: # location of creation
-    location_id = entity_data['statements']['P1071'][0]['mainsnak']['datavalue']['value']['id']
-    location_label, location_description, location_coords = _get_location_data(location_id, lang)
-  elif 'P921' in entity_data['statements']: # main subject
-    location_id = entity_data['statements']['P921'][0]['mainsnak']['datavalue']['value']['id']
-    location_label, location_description, location_coords = _get_location_data(location_id, lang)
-
-  dro = None
-  if dro_qid:
-      dro_label = _get_entity_labels([dro_qid], lang).get(dro_qid, dro_qid)
-      dro = f'<a href="https://www.wikidata.org/entity/{dro_qid}">{dro_label}</a>'
-    
-  # camera, exposure, mode, size
-  make = None
-  if 'P4082' in entity_data['statements']:
-    make_qids = [item['mainsnak']['datavalue']['value']['id'] for item in entity_data['statements']['P4082']]
-    make_labels = _get_entity_labels(make_qids, lang)
-    make = '; '.join([make_labels[qid] for qid in make_qids if qid in make_labels])
+
+  # exposure, mode, size (camera make is an enrichment)
   focal_length =  int(float(entity_data['statements']['P2151'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-',''))) if 'P2151' in entity_data['statements'] else None
   exposure_time = float(entity_data['statements']['P6757'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6757' in entity_data['statements'] else None
   f_number = float(entity_data['statements']['P6790'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6790' in entity_data['statements'] else None
   iso = int(entity_data['statements']['P6789'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6789' in entity_data['statements'] else None
   
-  depicts = []
-  if 'P180' in entity_data['statements']:
-    for item in entity_data['statements']['P180']:
-      if 'datavalue' in item['mainsnak']:
-        depicts.append(item['mainsnak']['datavalue']['value']['id'])
-  if len(depicts) > 0:
-    labels = _get_entity_labels(depicts, lang)
-    depicts = [f'<a href="https://www.wikidata.org/entity/{qid}">{labels[qid]}</a>' for qid in depicts]
-    
   metadata = {
     'language': lang,
     'label': label,
@@ -254,21 +387,12 @@ def get_iiif_metadata(**kwargs):
       'value': { lang: [ attribution_statement ] }
     }
   
-  if depicts:
-    metadata['metadata'].append({ 'label': { lang: [ 'depicts' ] }, 'value': { lang: depicts }})
-    
-  if dro:
-    metadata['metadata'].append({ 'label': { lang: [ 'digital_representation_of' ] }, 'value': { lang: [ dro ] }})
-
   if created:
     metadata['created'] = created
   
   if location_coords:
     metadata['location'] = {'coords': location_coords, 'id': location_id, 'label': location_label, 'description': location_description}
 
-  if make:
-    metadata['metadata'].append({ 'label': { lang: [ 'camera' ] }, 'value': { lang: [ make ] }})
-  
   exposure = []
   if focal_length: exposure.append(f"{focal_length}mm")
   if exposure_time: exposure.append(f"1/{round(1/exposure_time)}s")
@@ -277,5 +401,60 @@ def get_iiif_metadata(**kwargs):
   if len(exposure) > 0:
     metadata['metadata'].append({ 'label': { lang: [ 'exposure' ] }, 'value': { lang: [ ' '.join(exposure) ] }})
 
-  logger.debug(f'get_iiif_metadata: manifestid={manifestid} elapsed={round(now()-start,3)}')
+  enrichment = get_enrichment(title, props.get('wc_entity'), lang) if kwargs.get('enrich') else enrichments.get(title)
+  if enrichment:
+    apply_enrichment(metadata, enrichment)
+
+  logger.debug(f'get_iiif_metadata: manifestid={manifestid} enriched={enrichment is not None} elapsed={round(now()-start,3)}')
+  return metadata
+
+def get_enrichment(title, entity=None, lang='none'):
+  """
+  Metadata that needs Wikidata lookups beyond the Commons API and entity: depicts, digital
+  representation of, camera make and location labels.  All labels are fetched in one SPARQL
+  query.  Results are cached by title so later core lookups include them.
+  """
+  start = now()
+  title = unquote(title).replace(' ','_')
+  if entity is None:
+    wc_metadata = _get_wc_metadata(title) or {}
+    entity = _get_wc_entity(wc_metadata['pageid']) if 'pageid' in wc_metadata else None
+  statements = entity.get('statements', {}) if entity else {}
+
+  depicts = [item['mainsnak']['datavalue']['value']['id'] for item in statements.get('P180', []) if 'datavalue' in item['mainsnak']]
+  dro_qid = _digital_representation_of(entity)
+  make_qids = [item['mainsnak']['datavalue']['value']['id'] for item in statements.get('P4082', []) if 'datavalue' in item['mainsnak']]
+  qids = depicts + make_qids + ([dro_qid] if dro_qid else [])
+  labels = _get_entity_labels(qids, lang) if qids else {}
+
+  enrichment = {'metadata': []}
+  if depicts:
+    enrichment['metadata'].append({ 'label': { lang: [ 'depicts' ] }, 'value': { lang: [f'<a href="https://www.wikidata.org/entity/{qid}">{labels.get(qid, qid)}</a>' for qid in depicts] }})
+  if dro_qid:
+    enrichment['metadata'].append({ 'label': { lang: [ 'digital_representation_of' ] }, 'value': { lang: [ f'<a href="https://www.wikidata.org/entity/{dro_qid}">{labels.get(dro_qid, dro_qid)}</a>' ] }})
+  make = '; '.join([labels[qid] for qid in make_qids if qid in labels])
+  if make:
+    enrichment['metadata'].append({ 'label': { lang: [ 'camera' ] }, 'value': { lang: [ make ] }})
+
+  if 'P9149' not in statements and 'P1259' not in statements:
+    for prop in ('P1071', 'P921'): # location of creation, main subject
+      if prop in statements:
+        location_id = statements[prop][0]['mainsnak']['datavalue']['value']['id']
+        location_label, location_description, location_coords = _get_location_data(location_id, lang)
+        if location_coords:
+          enrichment['location'] = {'coords': location_coords, 'id': location_id, 'label': location_label, 'description': location_description}
+        break
+
+  enrichments[title] = enrichment
+  logger.debug(f'get_enrichment: title={title} elapsed={round(now()-start,3)}')
+  return enrichment
+
+def apply_enrichment(metadata, enrichment):
+  """Adds enrichment entries to core metadata, skipping any labels already present"""
+  existing = [next(iter(rec['label'].values()))[0] for rec in metadata.get('metadata', [])]
+  for rec in enrichment.get('metadata', []):
+    if next(iter(rec['label'].values()))[0] not in existing:
+      metadata.setdefault('metadata', []).append(rec)
+  if enrichment.get('location') and not metadata.get('location'):
+    metadata['location'] = enrichment['location']
   return metadata
\ No newline at end of file
@@ -18,9 +18,13 @@ import requests
 logging.getLogger('requests').setLevel(logging.INFO)
 
 from expiringdict import ExpiringDict
+
+from wc import enrichments, get_enrichment, apply_enrichment # shared with Commons titles, so one cache serves both
+
 image_urls = ExpiringDict(max_len=100, max_age_seconds=1800) # cache image urls for 30 minutes
 wd_entities = ExpiringDict(max_len=100, max_age_seconds=1800) # cache entities for 30 minutes
 wc_entities = ExpiringDict(max_len=100, max_age_seconds=1800)
+wc_metadata = ExpiringDict(max_len=1000, max_age_seconds=1800) # Commons API imageinfo by title
 
 licenses = {
   # Creative Commons Licenses
@@ -58,11 +62,14 @@ def _extract_text(val, lang='en'):
   return (_elem.text if _elem else soup.text).strip()
   
 def _get_wc_metadata(title):
+  if title in wc_metadata:
+    return wc_metadata[title]
   url = f'https://commons.wikimedia.org/w/api.php?format=json&action=query&titles=File:{quote(title)}&prop=imageinfo&iiprop=extmetadata|size|mime'
   resp = requests.get(url)
   logger.debug(f'{url} {resp.status_code}')
   if resp.status_code == 200:
-    return list(resp.json()['query']['pages'].values())[0]
+    wc_metadata[title] = list(resp.json()['query']['pages'].values())[0]
+    return wc_metadata[title]
   
 def _get_wc_entity(pageid):
   if pageid not in wc_entities:
@@ -122,18 +129,16 @@ def _get_location_data(qid, lang='en'):
   return label, description, coords
 
 def wc_title_to_url(title, width=None):
+  """Commons original for a file title, or its width px rendition (SVG renditions are PNG, TIFF renditions JPEG)"""
   title = unquote(title).replace(' ','_')
   md5 = hashlib.md5(title.encode('utf-8')).hexdigest()
   logger.debug(f'wc_title_to_url: title={title} md5={md5}')
-  ext = title.split('.')[-1]
+  ext = title.split('.')[-1].lower()
   baseurl = 'https://upload.wikimedia.org/wikipedia/commons/'
-  if ext == 'svg':
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width}px-${quote(title)}.png'
-  elif ext in ('tif', 'tiff'):
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width}px-${quote(title)}.jpg'
-  else:
-    url = f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width}px-${quote(title)}' if width is None else f'{baseurl}{md5[:1]}/{md5[:2]}/{quote(title)}'
-  return url
+  if width is None:
+    return f'{baseurl}{md5[:1]}/{md5[:2]}/{quote(title)}'
+  suffix = '.png' if ext == 'svg' else '.jpg' if ext in ('tif', 'tiff') else ''
+  return f'{baseurl}thumb/{md5[:1]}/{md5[:2]}/{quote(title)}/{width}px-{quote(title)}{suffix}'
 
 def _get_wd_image_url(qid):
   url = image_urls.get(qid)
@@ -167,13 +172,10 @@ def get_iiif_metadata(**kwargs):
   title = unquote(image_url.split('/')[-1]).replace(' ','_')
   start = now()
   
-  dro_qid = None
   props = {}
   props['wc_metadata'] = _get_wc_metadata(title)
   if 'pageid' in props['wc_metadata']:
     props['wc_entity'] = _get_wc_entity(props['wc_metadata']['pageid'])
-    dro_qid = _digital_representation_of(props['wc_entity'])
-    props['dro_entity'] = _get_wd_entity(dro_qid) if dro_qid else None
   
   imageinfo = props['wc_metadata']['imageinfo'][0] if 'imageinfo' in props['wc_metadata'] else {}
   extmetadata = imageinfo['extmetadata'] if 'extmetadata' in imageinfo else {}
@@ -225,34 +227,13 @@ def get_iiif_metadata(**kwargs):
   elif 'P1259' in entity_data['statements']: # coordinates of the point of view
     prop = entity_data['statements']['P1259'][0]['mainsnak']['datavalue']['value']
     location_coords = [prop['latitude'], prop['longitude']]
-  elif 'P1071' in entity_data['statements']: # location of creation
-    location_id = entity_data['statements']['P1071'][0]['mainsnak']['datavalue']['value']['id']
-    location_label, location_description, location_coords = _get_location_data(location_id, lang)
-  elif 'P921' in entity_data['statements']: # main subject
-    location_id = entity_data['statements']['P921'][0]['mainsnak']['datavalue']['value']['id']
-    location_label, location_description, location_coords = _get_location_data(location_id, lang)
 
-  dro = None
-  if dro_qid:
-      dro_label = _get_entity_labels([dro_qid], lang).get(dro_qid, dro_qid)
-      dro = f'<a href="https://www.wikidata.org/entity/{dro_qid}">{dro_label}</a>'
-    
-  # camera, exposure, mode, size
-  make = None
-  if 'P4082' in entity_data['statements']:
-    make_qids = [item['mainsnak']['datavalue']['value']['id'] for item in entity_data['statements']['P4082']]
-    make_labels = _get_entity_labels(make_qids, lang)
-    make = '; '.join([make_labels[qid] for qid in make_qids])
+  # exposure, mode, size (camera make is an enrichment)
   focal_length =  int(float(entity_data['statements']['P2151'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-',''))) if 'P2151' in entity_data['statements'] else None
   exposure_time = float(entity_data['statements']['P6757'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6757' in entity_data['statements'] else None
   f_number = float(entity_data['statements']['P6790'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6790' in entity_data['statements'] else None
   iso = int(entity_data['statements']['P6789'][0]['mainsnak']['datavalue']['value']['amount'].replace('+','').replace('-','')) if 'P6789' in entity_data['statements'] else None
   
-  depicts = [item['mainsnak']['datavalue']['value']['id'] for item in entity_data['statements']['P180']] if 'P180' in entity_data['statements'] else []
-  if len(depicts) > 0:
-    labels = _get_entity_labels(depicts, lang)
-    depicts = [f'<a href="https://www.wikidata.org/entity/{qid}">{labels[qid]}</a>' for qid in depicts]
-    
   metadata = {
     'language': lang,
     'label': label,
@@ -272,21 +253,12 @@ def get_iiif_metadata(**kwargs):
       'value': { lang: [ attribution_statement ] }
     }
   
-  if depicts:
-    metadata['metadata'].append({ 'label': { lang: [ 'depicts' ] }, 'value': { lang: depicts }})
-    
-  if dro:
-    metadata['metadata'].append({ 'label': { lang: [ 'digital_representation_of' ] }, 'value': { lang: [ dro ] }})
-
   if created:
     metadata['created'] = created
   
   if location_coords:
     metadata['location'] = {'coords': location_coords, 'id': location_id, 'label': location_label, 'description': location_description}
 
-  if make:
-    metadata['metadata'].append({ 'label': { lang: [ 'camera' ] }, 'value': { lang: [ make ] }})
-  
   exposure = []
   if focal_length: exposure.append(f"{focal_length}mm")
   if exposure_time: exposure.append(f"1/{round(1/exposure_time)}s")
@@ -295,5 +267,9 @@ def get_iiif_metadata(**kwargs):
   if len(exposure) > 0:
     metadata['metadata'].append({ 'label': { lang: [ 'exposure' ] }, 'value': { lang: [ ' '.join(exposure) ] }})
 
-  logger.debug(f'get_iiif_metadata: manifestid={manifestid} elapsed={round(now()-start,3)}')
-  return metadata
\ No newline at end of file
+  enrichment = get_enrichment(title, props.get('wc_entity'), lang) if kwargs.get('enrich') else enrichments.get(title)
+  if enrichment:
+    apply_enrichment(metadata, enrichment)
+
+  logger.debug(f'get_iiif_metadata: manifestid={manifestid} enriched={enrichment is not None} elapsed={round(now()-start,3)}')
+  return metadata